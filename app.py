@@ -1,11 +1,41 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import csv
+import hashlib
+import hmac
+import io
+import mimetypes
+import time
+from functools import lru_cache, wraps
+
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort
+from flask import jsonify, make_response, url_for, send_from_directory
+from flask import Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Follows, Likes, TimelineEntry
+from passwords import PasswordHasherBusy
+from ratelimit import LoginLimiter
+from querystats import QueryStats
+from profiler import Profiler
+from jobs import JobQueue
+from current_user import CurrentUserCache
+from search import make_user_search
+from migrate import upgrade
+from loader import load as load_csvs, BATCH_SIZE
+from fragments import FragmentCache
+from pagination import keyset_page, id_page
+from cache import make_cache, make_cache_server
+from timelines import RecentMessages, MergeTimeline, HybridTimeline, make_timeline
+from assets import Manifest, build as build_assets
+from snapshots import (snapshot_user, restore_user, snapshot_message,
+                       restore_message)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +50,125 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = 20
+app.config['CURRENT_USER_TTL'] = 10
+app.config['CURRENT_USER_CACHE_SIZE'] = 10000
+app.config['USERS_PER_PAGE'] = 30
+app.config['EXPORT_BATCH_SIZE'] = 1000
+app.config['MESSAGE_CARD_CACHE_SIZE'] = 10000
+
+# password hashing (see passwords.py): bcrypt cost, and how many hashes
+# may run (in worker processes) and queue before logins are turned away
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_WORKERS'] = int(
+    os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_MAX_PENDING'] = None
+
+# page data cache: memory:// (per process) or socket://... (shared; see
+# cache.py). TTLs bound how stale a page someone else changed can get.
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'memory://')
+app.config['PAGE_CACHE_SIZE'] = 10000
+app.config['TIMELINE_CACHE_TTL'] = 15
+app.config['PROFILE_CACHE_TTL'] = 60
+app.config['DIRECTORY_CACHE_TTL'] = 60
+
+# home timelines (see timelines.py): 'push' reads precomputed rows,
+# 'merge' merges per-author buffers of each one's newest messages,
+# 'hybrid' pushes most authors' messages and merges in those of authors
+# with CELEBRITY_FOLLOWERS or more followers. The buffers have to be in
+# a shared (socket://) cache, so without one the default is 'push'.
+app.config['TIMELINE_ENGINE'] = os.environ.get(
+    'TIMELINE_ENGINE',
+    'hybrid' if app.config['CACHE_URL'].startswith('socket://') else 'push')
+app.config['CELEBRITY_FOLLOWERS'] = int(os.environ.get('CELEBRITY_FOLLOWERS', 10000))
+app.config['TIMELINE_BUFFER_SIZE'] = 50
+app.config['TIMELINE_BUFFER_TTL'] = 300
+
+# failed logins allowed per username / per client IP in a sliding
+# window (seconds); counts are shared between processes when the
+# cache URL is a socket:// one
+app.config['LOGIN_FAILURES_PER_USERNAME'] = 5
+app.config['LOGIN_FAILURES_PER_IP'] = 20
+app.config['LOGIN_FAILURE_WINDOW'] = 300
+app.config['RATE_LIMIT_CACHE_URL'] = os.environ.get(
+    'RATE_LIMIT_CACHE_URL', app.config['CACHE_URL'])
+
+# reverse proxies in front of the app whose X-Forwarded-For / -Proto
+# headers are trusted for the client's address; 0 trusts none
+app.config['PROXY_HOPS'] = int(os.environ.get('PROXY_HOPS', 0))
+
+# SQL statements a request may run before it's logged (or, with
+# 'raise', fails); views can set their own with @query_budget
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
+app.config['QUERY_BUDGET_ACTION'] = os.environ.get('QUERY_BUDGET_ACTION', 'log')
+
+# sampling profiler (see profiler.py): the fraction of requests profiled
+# without an X-Profile header, and where the collapsed stacks go
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+
+# background jobs (see jobs.py): run by `flask worker`, or with
+# JOBS_EAGER=1 as each request finishes (no worker needed)
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '') == '1'
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 2
+app.config['JOB_TIMEOUT'] = 300
+
+# usernames allowed to download the full user export (and see the
+# stats endpoints)
+app.config['ADMIN_USERNAMES'] = set(
+    filter(None, os.environ.get('ADMIN_USERNAMES', '').split(',')))
+
+# bearer token for scraping /metrics and the other stats endpoints;
+# unset, only admins can see them
+app.config['STATS_TOKEN'] = os.environ.get('STATS_TOKEN')
+
+# 'postgresql' uses the database's search indexes, 'prefix' an in-memory
+# index; by default, whichever suits the database we're connected to.
+app.config['USER_SEARCH_BACKEND'] = os.environ.get(
+    'USER_SEARCH_BACKEND',
+    make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name())
 toolbar = DebugToolbarExtension(app)
 
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'],
+                            x_proto=app.config['PROXY_HOPS'])
+
 connect_db(app)
+query_stats = QueryStats(app, db.engine)
+profiler = Profiler(app)
+jobs = JobQueue(app)
+
+current_users = CurrentUserCache(ttl=app.config['CURRENT_USER_TTL'],
+                                 max_size=app.config['CURRENT_USER_CACHE_SIZE'])
+user_search = make_user_search(app.config['USER_SEARCH_BACKEND'])
+
+# message cards are rendered once and reused across pages; templates get
+# them from message_card(msg) and only render the like button live
+message_cards = FragmentCache(max_size=app.config['MESSAGE_CARD_CACHE_SIZE'])
+app.jinja_env.globals['message_card'] = message_cards.message_card
+
+static_assets = Manifest(app.static_folder)
+
+page_cache = make_cache(app.config['CACHE_URL'],
+                        max_size=app.config['PAGE_CACHE_SIZE'])
+
+# newest messages per author, for the 'merge' and 'hybrid' timeline engines
+recent_messages = RecentMessages(page_cache,
+                                 size=app.config['TIMELINE_BUFFER_SIZE'],
+                                 ttl=app.config['TIMELINE_BUFFER_TTL'])
+timeline = make_timeline(app.config['TIMELINE_ENGINE'], recent_messages,
+                         celebrity_followers=app.config['CELEBRITY_FOLLOWERS'])
+
+if isinstance(timeline, MergeTimeline) and not page_cache.shared:
+    raise RuntimeError(f"The {app.config['TIMELINE_ENGINE']!r} timeline engine "
+                       "needs a shared cache: set CACHE_URL to a socket:// one.")
+
+login_limiter = LoginLimiter(
+    make_cache(app.config['RATE_LIMIT_CACHE_URL']),
+    per_username=app.config['LOGIN_FAILURES_PER_USERNAME'],
+    per_ip=app.config['LOGIN_FAILURES_PER_IP'],
+    window=app.config['LOGIN_FAILURE_WINDOW'])
 
 
 ##############################################################################
@@ -31,15 +177,29 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is a slim CurrentUser (see current_user.py), not a full User;
+    static files don't get one at all.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = current_users.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+@app.after_request
+def forget_changed_user(resp):
+    """Anything posted may have changed the current user's cached row."""
+
+    if request.method == 'POST' and g.get('user'):
+        current_users.forget(g.user.id)
+
+    return resp
+
+
 def do_login(user):
     """Log in user."""
 
@@ -53,6 +213,137 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def message_page(query, timestamp_col, id_col):
+    """Get the page of `query` named by the `?before=` cursor.
+
+    Returns (messages, next_cursor); a garbled cursor is a 400.
+    """
+
+    try:
+        return keyset_page(query, timestamp_col, id_col,
+                           before=request.args.get('before'),
+                           per_page=app.config['MESSAGES_PER_PAGE'])
+    except ValueError:
+        abort(400)
+
+
+def page_etag(*parts):
+    """An ETag for a page made from `parts`, as seen by the current user."""
+
+    viewer = (g.user.id, g.user.username, g.user.image_url) if g.user else None
+    return hashlib.sha1(repr((viewer, static_assets.version) + parts)
+                        .encode()).hexdigest()
+
+
+def conditional(etag, render):
+    """Answer 304 if the client's copy of the page is current, else render().
+
+    Only the ETag validates: no single timestamp covers everything a
+    page shows (profile edits, counts, the viewer's follow), so there's
+    no Last-Modified and If-Modified-Since alone never gets a 304.
+
+    A page with flashed messages waiting is always rendered, and sent
+    without validators (the flashes only show once).
+    """
+
+    if session.get('_flashes'):
+        return render()
+
+    if is_resource_modified(request.environ, etag=etag):
+        resp = make_response(render())
+    else:
+        resp = Response(status=304)
+
+    resp.set_etag(etag)
+    return resp
+
+
+def cache_policy(cache_control):
+    """Send `cache_control` as the Cache-Control header of a view."""
+
+    def decorate(view):
+        view.cache_control = cache_control
+        return view
+
+    return decorate
+
+
+def stats_endpoint(view):
+    """Only serve `view` to admins, or with `Authorization: Bearer
+    <STATS_TOKEN>`; it shows internals (endpoints, login failures)."""
+
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        token = app.config['STATS_TOKEN']
+        sent = request.headers.get('Authorization', '')
+
+        if not ((token and hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()))
+                or (g.user and g.user.username in app.config['ADMIN_USERNAMES'])):
+            abort(403)
+
+        return view(*args, **kwargs)
+
+    return guarded
+
+
+@lru_cache(maxsize=None)
+def static_fingerprint(filename):
+    """Short content hash of a file in static/."""
+
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+@app.template_global()
+def static_url(filename):
+    """URL of a static file that changes whenever its content does.
+
+    That's its built copy (see assets.py) if there is one, otherwise the
+    plain file with a content hash in the query string.
+    """
+
+    return (static_assets.url(filename)
+            or url_for('static', filename=filename, v=static_fingerprint(filename)))
+
+
+@app.template_global()
+def hero_image(url, width):
+    """Sources ('src', and 'webp' or None) for header image `url` at `width`."""
+
+    return static_assets.hero(url, width)
+
+
+def send_static(filename):
+    """Serve a static file, pre-compressed if the build made a copy the
+    browser accepts."""
+
+    encoding, path = static_assets.encoding_for(filename, request.accept_encodings)
+
+    if encoding is None:
+        resp = app.send_static_file(filename)
+    else:
+        resp = send_from_directory(app.static_folder, path,
+                                   mimetype=mimetypes.guess_type(filename)[0])
+        resp.headers['Content-Encoding'] = encoding
+
+    if filename in static_assets.encodings:
+        resp.vary.add('Accept-Encoding')
+
+    return resp
+
+
+app.view_functions['static'] = send_static
+
+
+def followed_among(users):
+    """Ids of the `users` the logged-in user follows, in one query."""
+
+    if not g.user:
+        return set()
+
+    return g.user.following_among([user.id for user in users])
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -82,6 +373,7 @@ def signup():
             # print('')
 
             db.session.commit()
+            page_cache.bump('users')
 
             do_login(user)
 
@@ -105,19 +397,47 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        # remote_addr is the client's own address when PROXY_HOPS is set
+        username, ip = form.username.data, request.remote_addr
+
+        # too many recent failures for this name or address: refuse
+        # without spending a lookup and a bcrypt check on it
+        reservation = login_limiter.attempt(username, ip)
+        if reservation is None:
+            flash("Too many failed logins. Please wait a few minutes and try again.",
+                  'danger')
+            return render_template('users/login.html', form=form), 429
+
+        started = time.perf_counter()
+        try:
+            user = User.authenticate(username, form.password.data)
+        except PasswordHasherBusy:
+            login_limiter.refund(reservation)
+            raise
 
         if user:
+            login_limiter.refund(reservation)
+            # authenticate may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        login_limiter.failed(time.perf_counter() - started)
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins / signups in flight: ask the user to retry."""
+
+    db.session.rollback()
+    flash("We're very busy right now. Please try again in a moment.", "danger")
+    return redirect(request.path)
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -135,34 +455,140 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username (prefix)
+    or bio words; results are ranked and capped at USERS_PER_PAGE.
+
+    Without 'q', pages through everyone in id order; 'after' is the last
+    id of the previous page.
     """
 
     search = request.args.get('q')
+    next_after = None
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', type=int)
+
+        def directory_page():
+            users, next_after = id_page(
+                User.query, User.id, after=after,
+                per_page=app.config['USERS_PER_PAGE'])
+            return {'users': [snapshot_user(user) for user in users],
+                    'next_after': next_after}
+
+        page = page_cache.get_or_set(page_cache.key('users', after),
+                                     directory_page,
+                                     ttl=app.config['DIRECTORY_CACHE_TTL'])
+        users = [restore_user(data) for data in page['users']]
+        next_after = page['next_after']
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = user_search.search(search, limit=app.config['USERS_PER_PAGE'])
+
+    return render_template('users/index.html', users=users,
+                           following_ids=followed_among(users),
+                           next_after=next_after)
 
-    return render_template('users/index.html', users=users)
+
+EXPORT_COLUMNS = ['id', 'username', 'email', 'location', 'messages_count',
+                  'following_count', 'followers_count', 'likes_count']
+
+
+@app.route('/users/export.csv')
+def export_users():
+    """Stream every user as CSV (admins only).
+
+    Users are read in EXPORT_BATCH_SIZE chunks by id and written out as
+    they're read, so memory stays flat however big the table is.
+    """
+
+    if not g.user or g.user.username not in app.config['ADMIN_USERNAMES']:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    columns = [getattr(User, column) for column in EXPORT_COLUMNS]
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        after = 0
+
+        while True:
+            rows = (db.session
+                    .query(*columns)
+                    .filter(User.id > after)
+                    .order_by(User.id)
+                    .limit(app.config['EXPORT_BATCH_SIZE'])
+                    .all())
+            if not rows:
+                break
+
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+            after = rows[-1].id
+
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition':
+                             'attachment; filename=users.csv'})
+
+
+PROFILE_FIELDS = ['username', 'image_url', 'header_image_url', 'bio',
+                  'location', 'messages_count', 'following_count',
+                  'followers_count', 'likes_count']
 
 
 @app.route('/users/<int:user_id>')
+@cache_policy('private, no-cache')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Revalidated with an ETag over the profile, the page of messages that
+    would be rendered and whether the viewer follows it; an unchanged
+    page is a bodiless 304. The messages are the (possibly cached) ones
+    the body is made from, so the ETag can't vouch for a page this
+    process hasn't got.
+    """
 
     user = User.query.get_or_404(user_id)
+    page = profile_messages(user_id)
+
+    etag = page_etag(user.id, [getattr(user, field) for field in PROFILE_FIELDS],
+                     page, request.args.get('before'),
+                     bool(g.user) and g.user.is_following(user))
+
+    return conditional(etag, lambda: render_profile(user, page))
+
+
+def profile_messages(user_id):
+    """The page of `user_id`'s messages for `?before=`, from the page cache."""
+
+    def profile_page():
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages, next_cursor = message_page(
+            Message.query.filter(Message.user_id == user_id),
+            Message.timestamp, Message.id)
+        return {'messages': [snapshot_message(msg, with_author=False)
+                             for msg in messages],
+                'next_cursor': next_cursor}
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    return page_cache.get_or_set(
+        page_cache.key(f"profile:{user_id}", request.args.get('before', '')),
+        profile_page, ttl=app.config['PROFILE_CACHE_TTL'])
+
+
+def render_profile(user, page):
+    """Render the profile page of `user` with `page` of their messages."""
+
+    messages = [restore_message(data, author=user) for data in page['messages']]
+    next_cursor = page['next_cursor']
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -174,7 +600,8 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html', user=user,
+                           following_ids=followed_among(user.following))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -186,7 +613,8 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html', user=user,
+                           following_ids=followed_among(user.followers))
 
 
 @app.route('/users/<int:user_id>/likes')
@@ -198,8 +626,20 @@ def users_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    likes = [msg.id for msg in g.user.likes]
-    return render_template('users/likes.html', user=user, likes=likes)
+
+    # authors are loaded in the same query so the template doesn't fire
+    # a SELECT per message for msg.user
+    messages, next_cursor = message_page(
+        (Message
+         .query
+         .join(Likes, Likes.message_id == Message.id)
+         .filter(Likes.user_id == user_id)
+         .options(db.joinedload(Message.user))),
+        Message.timestamp, Message.id)
+
+    likes = g.user.liked_among([msg.id for msg in messages])
+    return render_template('users/likes.html', user=user, messages=messages,
+                           likes=likes, next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -211,8 +651,18 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    # following someone twice is a no-op, not a duplicate row
+    if not g.user.is_following(followed_user):
+        db.session.add(Follows(user_being_followed_id=followed_user.id,
+                               user_following_id=g.user.id))
+        User.bump_counts(g.user.id, following_count=1)
+        User.bump_counts(followed_user.id, followers_count=1)
+        jobs.enqueue('apply_follow', follower_id=g.user.id,
+                     followed_id=followed_user.id)
+        db.session.commit()
+        current_users.forget(followed_user.id)
+        page_cache.bump(f"timeline:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -225,40 +675,43 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+    removed = (Follows.query
+               .filter_by(user_being_followed_id=followed_user.id,
+                          user_following_id=g.user.id)
+               .delete())
+
+    # a repeated (or stale) unfollow mustn't count the follow twice
+    if removed:
+        User.bump_counts(g.user.id, following_count=-1)
+        User.bump_counts(followed_user.id, followers_count=-1)
+        jobs.enqueue('apply_follow', follower_id=g.user.id,
+                     followed_id=followed_user.id)
+        db.session.commit()
+        current_users.forget(followed_user.id)
+        page_cache.bump(f"timeline:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
 def likes(message_id):
+    """Like a message, or unlike it if the current user already does."""
 
-    # if the message that the user is trying to like is the user's own message,
-    # redirect to the home page with a flash message telling the user they can
-    # only like OTHE PEOPLE'S warbles
-    # if the current message_id is in the user likes table, delete it
-    # but if not, then we add it to the likes table
-    # like = Likes.query.filter_by(session(CURR_USER_KEY))    
-
-    curr_message = Message.query.get(message_id)
-
-    if curr_message.user_id == g.user.id:
-        flash("You cannot like your own warble!", "danger")
-        return redirect('/')
-
-
-    curr_like = Likes.query.filter_by(user_id=session[CURR_USER_KEY]).filter_by(message_id=message_id).first()
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    if not curr_like:
-        g.user.likes.append(Message.query.get(message_id))
-        db.session.commit()
+    change = Likes.toggle(g.user.id, message_id)
+    db.session.commit()
 
-    else:
-        db.session.delete(curr_like)
-        db.session.commit()
+    # the toggle refuses to like the user's own (or a missing) message;
+    # only then is it worth looking the message up to say why
+    if not change:
+        curr_message = Message.query.get_or_404(message_id)
 
+        if curr_message.user_id == g.user.id:
+            flash("You cannot like your own warble!", "danger")
 
     return redirect('/')
 
@@ -268,28 +721,30 @@ def profile():
     """Update profile for current user."""
 
     # if a user is logged in, we have the user object on the global Flask variable
-    # g.user -> currently logged in User instance
+    # g.user -> currently logged in user (slim CurrentUser, not a User)
     # session[CURR_USER_KEY]) -> curretly logged in user's ID
 
     if not g.user:
         return redirect("/login")
 
-    form = UserEditForm(obj=g.user)
+    # the edit form needs the full row (email, bio, location...)
+    user = User.query.get(g.user.id)
+    form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
 
-        u = User.authenticate(g.user.username, form.password.data)
-
         # if authenticated, add the changes from our form and commig
-        if u:
-            u.name = form.username.data
-            u.email = form.email.data
-            u.image_url = form.image_url.data
-            u.header_image_url = form.header_image_url.data
-            u.bio = form.bio.data
-            u.location = form.location.data
+        if user.check_password(form.password.data):
+            user.name = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
+            user.location = form.location.data
 
             db.session.commit()
+            message_cards.forget_author(user.id)
+            page_cache.bump('users')
 
             flash("User profile updated!", "success")
             return redirect(f"/users/{g.user.id}")
@@ -311,8 +766,12 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = User.query.get(g.user.id)
+    user.release_counts()
+    db.session.delete(user)
     db.session.commit()
+    page_cache.bump('users')
+    page_cache.bump(f"profile:{g.user.id}")
 
     return redirect("/signup")
 
@@ -334,9 +793,21 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        timeline.posted(msg)
+        User.bump_counts(g.user.id, messages_count=1)
+        jobs.enqueue('deliver_message', key=f"deliver_message:{msg.id}",
+                     message_id=msg.id)
         db.session.commit()
+        recent_messages.add(msg)
+
+        # the author sees their new message at once; followers get it
+        # when the job has run and their cached timelines expire
+        page_cache.bump(f"profile:{g.user.id}")
+        page_cache.bump(f"timeline:{g.user.id}")
 
         return redirect(f"/users/{g.user.id}")
 
@@ -344,11 +815,20 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cache_policy('private, no-cache')
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    Messages never change, so the ETag only has to cover the author's
+    card and the viewer's follow button.
+    """
+
+    msg = Message.query.get_or_404(message_id)
+    etag = page_etag(msg.id, msg.timestamp, msg.user.username, msg.user.image_url,
+                     bool(g.user) and g.user.is_following(msg.user))
+
+    return conditional(etag,
+                       lambda: render_template('messages/show.html', message=msg))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -360,8 +840,16 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    TimelineEntry.remove_message(msg.id)
+    User.bump_counts(msg.user_id, messages_count=-1)
+    likers = msg.release_counts()
     db.session.delete(msg)
     db.session.commit()
+    recent_messages.remove(msg)
+    current_users.forget(msg.user_id, *likers)
+    message_cards.forget_message(message_id)
+    page_cache.bump(f"profile:{msg.user_id}")
+    page_cache.bump(f"timeline:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}")
 
@@ -375,52 +863,239 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
 
-        following_ids = [user.id for user in g.user.following]
+        def timeline_page():
+            # see timelines.py: either a range read of the precomputed
+            # timeline or a merge of each followed author's newest messages
+            try:
+                messages, next_cursor = timeline.page(
+                    g.user, before=request.args.get('before'),
+                    per_page=app.config['MESSAGES_PER_PAGE'])
+            except ValueError:
+                abort(400)
+
+            return {'messages': [snapshot_message(msg) for msg in messages],
+                    'next_cursor': next_cursor}
+
+        page = page_cache.get_or_set(
+            page_cache.key(f"timeline:{g.user.id}",
+                           request.args.get('before', '')),
+            timeline_page, ttl=app.config['TIMELINE_CACHE_TTL'])
+        messages = [restore_message(data) for data in page['messages']]
+        next_cursor = page['next_cursor']
+
+        # the set of message ID's on this page the global user likes,
+        # so the template can light up the like buttons
+        likes = g.user.liked_among([msg.id for msg in messages])
+
+        return render_template('home.html', messages=messages, likes=likes,
+                               next_cursor=next_cursor)
+
+    else:
+        return render_template('home-anon.html')
+
+
+@app.route('/cache/stats')
+@stats_endpoint
+def cache_stats():
+    """Page cache hit / miss / eviction counters, as JSON."""
+
+    return jsonify(page_cache.stats())
+
+
+@app.route('/login/stats')
+@stats_endpoint
+def login_stats():
+    """Login throttling counters (and checking time saved), as JSON."""
+
+    return jsonify(login_limiter.stats())
+
+
+@app.route('/metrics')
+@stats_endpoint
+def metrics():
+    """Per-endpoint SQL statistics, in the Prometheus text format."""
+
+    return Response(query_stats.metrics() + jobs.metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+##############################################################################
+# Background jobs (see jobs.py)
+
+
+@jobs.task('deliver_message')
+def deliver_message(message_id):
+    """Push a new message to its author's followers' timelines."""
+
+    msg = Message.query.get(message_id)
+
+    # deleted before we got to it
+    if msg is not None:
+        timeline.deliver(msg)
 
-        messages = (Message
-                    .query
-                    .filter((Message.user_id.in_(following_ids)) | (Message.user_id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        # create a list of message ID's from the global user's likes
-        # g.user.likes-> list of messages.  loop over the returned
-        # messages and get the id for each message then pass the list
-        # to our home template.
-        likes = [msg.id for msg in g.user.likes]
 
-        return render_template('home.html', messages=messages, likes=likes)
+@jobs.task('apply_follow')
+def apply_follow(follower_id, followed_id):
+    """Bring a timeline in line with a follow or unfollow.
 
+    Reads whether the follow exists now, so if a follow and unfollow's
+    jobs run out of order, the later state still wins.
+    """
+
+    if Follows.is_following(follower_id, followed_id):
+        TimelineEntry.add_follow(follower_id, followed_id)
     else:
-        return render_template('home-anon.html')
+        TimelineEntry.remove_follow(follower_id, followed_id)
+
+    timeline.followers_changed(followed_id)
+
+    # the route bumped its own process's cache; a shared one can be
+    # bumped again now the timeline has changed
+    if page_cache.shared:
+        page_cache.bump(f"timeline:{follower_id}")
+
+
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('worker')
+@click.option('--processes', default=1, help="Worker processes to run.")
+@click.option('--once', is_flag=True, help="Exit once the queue is empty.")
+def worker(processes, once):
+    """Run background jobs as they're queued."""
+
+    if processes == 1:
+        jobs.work(once=once)
+    else:
+        jobs.run_workers(processes, once=once)
+
+
+@app.cli.command('jobs-stats')
+def jobs_stats():
+    """Print the job queue's depth by status."""
+
+    for name, value in jobs.stats().items():
+        print(f"{name}: {value}")
+
+
+@app.cli.command('migrate')
+def migrate_schema():
+    """Apply pending SQL migrations from migrations/."""
+
+    applied = upgrade(db.engine)
+
+    for version, name in applied:
+        print(f"Applied {version:04d}_{name}")
+
+    if not applied:
+        print("Schema is up to date.")
+
+
+@app.cli.command('load-csv')
+@click.argument('directory', default='generator')
+@click.option('--batch-size', default=BATCH_SIZE,
+              help="Rows per INSERT when not using COPY.")
+@click.option('--copy/--no-copy', default=True,
+              help="Use COPY FROM STDIN on Postgres.")
+@click.option('--reset/--append', default=True,
+              help="Drop and recreate the tables first.")
+def load_csv(directory, batch_size, copy, reset):
+    """Bulk-load users / messages / follows / likes CSVs from DIRECTORY."""
+
+    load_csvs(directory, batch_size=batch_size, use_copy=copy, reset=reset)
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Backfill every home timeline from the follows and messages tables."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+    print(f"Rebuilt {TimelineEntry.query.count()} timeline entries.")
+
+
+@app.cli.command('reclassify-authors')
+def reclassify_authors():
+    """Sort authors into pushed and merged by CELEBRITY_FOLLOWERS."""
+
+    if not isinstance(timeline, HybridTimeline):
+        raise SystemExit("Only the hybrid timeline engine classifies authors.")
+
+    promoted, demoted = timeline.reclassify_all()
+    db.session.commit()
+    print(f"{promoted} authors now merged on read, {demoted} now pushed.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every user's message/follow/like counters from scratch."""
+
+    User.reconcile_counts()
+    db.session.commit()
+    print(f"Reconciled counters for {User.query.count()} users.")
+
+
+@app.cli.command('build-static')
+def build_static():
+    """Fingerprint, compress and resize static/ into static/dist/."""
+
+    manifest = build_assets(app.static_folder)
+    static_assets.reload()
+
+    print(f"Built {len(manifest['files'])} files "
+          f"({len(manifest['encodings'])} pre-compressed, "
+          f"{len(manifest['variants'])} resized).")
+
+
+@app.cli.command('profile-token')
+def profile_token():
+    """Print an X-Profile header value that profiles a request."""
+
+    print(f"X-Profile: {profiler.token()}")
+
+
+@app.cli.command('cache-server')
+def cache_server():
+    """Serve the shared page cache at CACHE_URL (a socket:// URL)."""
+
+    url = app.config['CACHE_URL']
+    if not url.startswith('socket://'):
+        raise SystemExit("Set CACHE_URL to socket://... to run a shared cache.")
+
+    server = make_cache_server(url)
+    print(f"Serving the page cache at {url}")
+    server.serve_forever()
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Caching headers
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages are personal and change often, so by default nothing is cached.
+# Views opt in to revalidation with @cache_policy; fingerprinted static
+# files (see static_url and assets.py) are cached for good, since a new
+# version gets a new URL.
+
+NO_CACHE = "no-cache, no-store, must-revalidate"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+def add_header(resp):
+    """Add each route's caching headers."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    if request.endpoint == 'static':
+        built = request.view_args['filename'].startswith('dist/')
+        resp.headers['Cache-Control'] = (
+            IMMUTABLE if built or request.args.get('v') else "public, no-cache")
 
+    else:
+        view = app.view_functions.get(request.endpoint)
+        resp.headers['Cache-Control'] = getattr(view, 'cache_control', NO_CACHE)
 
-    # print('')
-    # print('*************')
-    # print('curr_message')
-    # print('*************')
-    # print('')
\ No newline at end of file
+    return resp
@@ -0,0 +1,239 @@
+"""Fingerprinted, pre-compressed static assets.
+
+`flask build-static` runs build() over static/ and writes static/dist/:
+
+- a copy of every file, named with a hash of its content, so it can be
+  cached forever (a new version is a new URL);
+- .gz (and, with the `brotli` package, .br) copies of text assets,
+  served in place of the original when the browser accepts them;
+- resized JPEG and WebP versions of the hero images (needs Pillow);
+- stylesheets whose url(/static/...) references point at the hashed
+  copies;
+- manifest.json, which Manifest reads to map a file in static/ to its
+  built copy.
+
+Without a build (or for a file the build doesn't know) Manifest.url()
+returns None and the app falls back to plain static URLs.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+
+TEXT_EXTENSIONS = {'.css', '.js', '.svg', '.txt', '.ico'}
+
+# pre-compressed copies, most preferred first
+ENCODING_EXTENSIONS = {'br': 'br', 'gzip': 'gz'}
+
+# big photos shown as page / card headers; built at these widths
+HERO_IMAGES = {'images/warbler-hero.jpg', 'images/signed-out-home.jpg'}
+HERO_WIDTHS = (640, 1280, 1920)
+
+STATIC_URL = re.compile(r'''url\(\s*(['"]?)/static/([^'")]+)\1\s*\)''')
+
+
+def hashed_name(filename, data, suffix=''):
+    """`images/a.png` -> `dist/images/a<suffix>.<hash>.png`."""
+
+    stem, ext = os.path.splitext(filename)
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    return f"{DIST_DIR}/{stem}{suffix}.{digest}{ext}"
+
+
+def compress(data):
+    """{encoding: bytes} for each encoding that actually shrinks `data`."""
+
+    encoded = {'gzip': gzip.compress(data, 9, mtime=0)}
+
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data)
+
+    return {encoding: body for encoding, body in encoded.items()
+            if len(body) < len(data)}
+
+
+def image_width(data):
+    """Width in pixels of image `data`."""
+
+    return Image.open(io.BytesIO(data)).width
+
+
+def resize(data, width):
+    """(jpeg, webp) bytes of image `data` scaled to `width` pixels wide."""
+
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    height = round(image.height * width / image.width)
+    image = image.resize((width, height), Image.LANCZOS)
+
+    jpeg, webp = io.BytesIO(), io.BytesIO()
+    image.save(jpeg, 'JPEG', quality=82, optimize=True, progressive=True)
+    image.save(webp, 'WEBP', quality=80)
+    return jpeg.getvalue(), webp.getvalue()
+
+
+def source_files(static_dir):
+    """Every file under `static_dir` (except built ones), stylesheets last."""
+
+    found = []
+
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.relpath(root, static_dir) == '.' and DIST_DIR in dirs:
+            dirs.remove(DIST_DIR)
+
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_dir)
+            found.append(path.replace(os.sep, '/'))
+
+    return sorted(found, key=lambda path: (path.endswith('.css'), path))
+
+
+def build(static_dir, hero_widths=HERO_WIDTHS):
+    """Build static_dir/dist from static_dir; returns the manifest."""
+
+    dist = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    manifest = {'files': {}, 'encodings': {}, 'variants': {}}
+
+    def write(path, data):
+        full = os.path.join(static_dir, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as f:
+            f.write(data)
+
+    def add(filename, data, suffix=''):
+        path = hashed_name(filename, data, suffix)
+        write(path, data)
+
+        if os.path.splitext(filename)[1] in TEXT_EXTENSIONS:
+            encoded = compress(data)
+            for encoding, body in encoded.items():
+                write(f"{path}.{ENCODING_EXTENSIONS[encoding]}", body)
+            if encoded:
+                manifest['encodings'][path] = sorted(encoded)
+
+        return path
+
+    def rewrite_urls(css):
+        def built(match):
+            path = manifest['files'].get(match.group(2))
+            return f'url("/static/{path}")' if path else match.group(0)
+
+        return STATIC_URL.sub(built, css.decode()).encode()
+
+    for filename in source_files(static_dir):
+        with open(os.path.join(static_dir, filename), 'rb') as f:
+            data = f.read()
+
+        if filename.endswith('.css'):
+            data = rewrite_urls(data)
+
+        if filename in HERO_IMAGES and Image is not None:
+            manifest['variants'][filename] = variants = {}
+
+            # never scale up: the widest copy is at most the original's width
+            original = image_width(data)
+            widths = sorted({width for width in hero_widths if width < original}
+                            | {min(original, max(hero_widths))})
+
+            for width in widths:
+                jpeg, webp = resize(data, width)
+                variants[str(width)] = {
+                    'jpeg': add(filename, jpeg, suffix=f"-{width}"),
+                    'webp': add(os.path.splitext(filename)[0] + '.webp', webp,
+                                suffix=f"-{width}"),
+                }
+
+            # the widest re-encoded copy stands in for the original
+            manifest['files'][filename] = variants[str(widths[-1])]['jpeg']
+
+        else:
+            manifest['files'][filename] = add(filename, data)
+
+    write(f"{DIST_DIR}/{MANIFEST_FILE}", json.dumps(manifest, indent=2).encode())
+    return manifest
+
+
+class Manifest:
+    """Lookups into static_dir/dist/manifest.json (empty if unbuilt)."""
+
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(os.path.join(self.static_dir, DIST_DIR, MANIFEST_FILE), 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b'{}'
+
+        manifest = json.loads(raw)
+
+        # changes with every build; pages that link to built files can
+        # fold it into their ETags
+        self.version = hashlib.sha1(raw).hexdigest()[:12]
+
+        self.files = manifest.get('files', {})
+        self.encodings = manifest.get('encodings', {})
+        self.variants = manifest.get('variants', {})
+
+    def url(self, filename):
+        """/static/ URL of the built copy of `filename`, or None."""
+
+        path = self.files.get(filename)
+        return f"/static/{path}" if path else None
+
+    def hero(self, url, width):
+        """{'src': ..., 'webp': ...} for showing image `url` `width` wide.
+
+        Uses the narrowest built variant at least `width` wide (or the
+        widest there is); images that weren't built (including anything
+        not under /static/) come back as-is, with no WebP.
+        """
+
+        filename = url[len('/static/'):] if url and url.startswith('/static/') else None
+        variants = self.variants.get(filename)
+
+        if not variants:
+            return {'src': self.url(filename) or url, 'webp': None}
+
+        widths = sorted(int(w) for w in variants)
+        chosen = next((w for w in widths if w >= width), widths[-1])
+        variant = variants[str(chosen)]
+
+        return {'src': f"/static/{variant['jpeg']}",
+                'webp': f"/static/{variant['webp']}"}
+
+    def encoding_for(self, path, accept_encodings):
+        """Best pre-compressed encoding of built `path` the client accepts.
+
+        Returns (encoding, file path) or (None, path).
+        """
+
+        available = self.encodings.get(path)
+        if available:
+            encoding = accept_encodings.best_match(
+                [encoding for encoding in ENCODING_EXTENSIONS
+                 if encoding in available])
+            if encoding:
+                return encoding, f"{path}.{ENCODING_EXTENSIONS[encoding]}"
+
+        return None, path
@@ -0,0 +1,72 @@
+"""Measure login throughput (password checks per second) by pool size.
+
+    python bench_passwords.py
+    python bench_passwords.py --workers 0 1 2 4 --logins 64 --clients 16 --rounds 12
+
+For each pool size, `clients` threads (standing in for concurrent login
+requests) check `logins` passwords between them through a PasswordHasher.
+A pool size of 0 checks inline, as the app used to. Prints one line per
+pool size; no database is involved.
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passwords import PasswordHasher, PasswordHasherBusy, hash_password
+
+
+def run(workers, logins, clients, rounds, max_pending):
+    """(seconds, rejected) to check `logins` passwords on a pool of `workers`."""
+
+    hasher = PasswordHasher()
+    hasher.configure(rounds=rounds, workers=workers, max_pending=max_pending)
+    hashed = hash_password("password", rounds)
+
+    # start the worker processes before the clock does
+    for _ in range(max(workers, 1)):
+        hasher.check(hashed, "password")
+
+    def login(_):
+        try:
+            hasher.check(hashed, "password")
+            return 0
+        except PasswordHasherBusy:
+            return 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as threads:
+        rejected = sum(threads.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+
+    hasher.shutdown()
+    return elapsed, rejected
+
+
+def main():
+    cpus = os.cpu_count() or 1
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({0, 1, max(cpus // 2, 1), cpus}))
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--clients', type=int, default=2 * cpus)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help="queue limit (default: enough for every client)")
+    args = parser.parse_args()
+
+    print(f"{args.logins} logins from {args.clients} clients at cost {args.rounds} "
+          f"({cpus} CPUs)")
+    print(f"{'workers':>8} {'seconds':>9} {'logins/s':>9} {'rejected':>9}")
+
+    for workers in args.workers:
+        elapsed, rejected = run(workers, args.logins, args.clients, args.rounds,
+                                args.max_pending or args.clients)
+        done = args.logins - rejected
+        print(f"{workers:>8} {elapsed:>9.2f} {done / elapsed:>9.1f} {rejected:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Latency / throughput benchmark for Warbler's main routes.
+
+    createdb warbler-bench
+    python bench_routes.py --users 10000 --messages 200000 --output bench.json
+    python bench_routes.py --no-seed --server --concurrency 8 --compare bench.json
+
+Seeds a dataset of the given size (generator/create_csvs.py, then
+loader.py) into --database, then sends --requests requests to each
+route as a busy logged-in user: through the Flask test client, or with
+--server over HTTP to a local threaded WSGI server. For each route it
+reports p50/p95/p99 latency, throughput and SQL queries per request.
+
+--output writes the results as JSON; --compare reads an earlier
+results file and exits 1 if any route's p95 got worse by more than
+--tolerance (a fraction).
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not ordered:
+        return 0.0
+
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def seed(args):
+    """Generate and load a dataset of the requested size."""
+
+    from loader import load
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, os.path.join(HERE, 'generator', 'create_csvs.py'),
+                        '--users', str(args.users), '--messages', str(args.messages),
+                        '--follows', str(args.follows), '--likes', str(args.likes),
+                        '--seed', str(args.seed), '--out', directory],
+                       check=True)
+        load(directory)
+
+
+class Client:
+    """Sends requests as one logged-in user and times them.
+
+    Works against the test client or a server URL; either way the
+    response carries the request's SQL query count (from querystats.py).
+    """
+
+    def __init__(self, app, user_id, base_url=None):
+        self.app = app
+        self.base_url = base_url
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        self.session = serializer.dumps({'curr_user': user_id})
+        self.local = threading.local()
+
+    def test_client(self):
+        """This thread's test client, logged in."""
+
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+            self.local.client.set_cookie('localhost', self.app.session_cookie_name,
+                                         self.session)
+        return self.local.client
+
+    def request(self, method, path, data=None):
+        """(seconds, status, queries) for one request."""
+
+        started = time.perf_counter()
+
+        if self.base_url is None:
+            resp = self.test_client().open(path, method=method, data=data)
+            resp.get_data()
+            status, headers = resp.status_code, resp.headers
+
+        else:
+            body = urllib.parse.urlencode(data).encode() if data else None
+            req = urllib.request.Request(self.base_url + path, data=body, method=method,
+                                         headers={'Cookie': f"{self.app.session_cookie_name}={self.session}"})
+            try:
+                with NoRedirects.open(req) as resp:
+                    resp.read()
+                    status, headers = resp.status, resp.headers
+            except urllib.error.HTTPError as error:
+                status, headers = error.code, error.headers
+
+        elapsed = time.perf_counter() - started
+        return elapsed, status, int(headers.get('X-Query-Count', 0))
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+NoRedirects = urllib.request.build_opener(_NoRedirect)
+
+
+def count_queries(app):
+    """Have every response say how many SQL statements it ran."""
+
+    from flask import g
+
+    # registered after app's QueryStats, so this runs before it pops g.queries
+    @app.after_request
+    def report_count(resp):
+        queries = g.get('queries')
+        resp.headers['X-Query-Count'] = str(queries.count if queries else 0)
+        return resp
+
+
+def benchmark(client, name, requests, concurrency, warmup):
+    """Run `requests` (method, path, data) tuples; a summary dict."""
+
+    for method, path, data in requests[:warmup]:
+        client.request(method, path, data)
+
+    timed = requests[warmup:]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        results = list(threads.map(lambda r: client.request(*r), timed))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(seconds for seconds, _, _ in results)
+    errors = sum(1 for _, status, _ in results if status >= 400)
+
+    summary = {
+        'requests': len(results),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+        'requests_per_second': round(len(results) / wall, 1),
+        'queries_per_request': round(sum(q for _, _, q in results) / len(results), 2),
+    }
+
+    print(f"{name:<36} p50 {summary['p50_ms']:>8.1f}ms  p95 {summary['p95_ms']:>8.1f}ms  "
+          f"p99 {summary['p99_ms']:>8.1f}ms  {summary['requests_per_second']:>7.1f} req/s  "
+          f"{summary['queries_per_request']:>5.1f} queries  {errors} errors")
+    return summary
+
+
+def route_requests(n, warmup, viewer, user_ids, message_ids, rng):
+    """{route name: [(method, path, data), ...]} for every benchmarked route."""
+
+    total = n + warmup
+    users = lambda: rng.choice(user_ids)
+    others = rng.sample([i for i in user_ids if i != viewer],
+                        min(total, len(user_ids) - 1))
+    messages = rng.sample(message_ids, min(total, len(message_ids)))
+
+    return {
+        'GET /': [('GET', '/', None)] * total,
+        'GET /users': [('GET', '/users', None)] * total,
+        'GET /users/<id>': [('GET', f'/users/{users()}', None) for _ in range(total)],
+        'GET /users/<id>/followers': [('GET', f'/users/{users()}/followers', None)
+                                      for _ in range(total)],
+        'GET /users/<id>/likes': [('GET', f'/users/{users()}/likes', None)
+                                  for _ in range(total)],
+        'GET /messages/new': [('GET', '/messages/new', None)] * total,
+        'POST /messages/new': [('POST', '/messages/new', {'text': f"benchmark {i}"})
+                               for i in range(total)],
+        'POST /users/add_like/<id>': [('POST', f'/users/add_like/{m}', None)
+                                      for m in messages],
+        'POST /users/follow/<id>': [('POST', f'/users/follow/{u}', None)
+                                    for u in others],
+        'POST /users/stop-following/<id>': [('POST', f'/users/stop-following/{u}', None)
+                                            for u in others],
+    }
+
+
+def compare(results, previous, tolerance):
+    """Print p95 changes against `previous`; True if none regressed."""
+
+    ok = True
+
+    for setting in ('mode', 'concurrency', 'dataset'):
+        if previous['meta'].get(setting) != results['meta'][setting]:
+            print(f"note: {setting} differs from the earlier run "
+                  f"({previous['meta'].get(setting)} -> {results['meta'][setting]})")
+
+    for name, summary in results['routes'].items():
+        before = previous['routes'].get(name)
+        if not before or not before['p95_ms']:
+            continue
+
+        change = summary['p95_ms'] / before['p95_ms'] - 1
+        regressed = change > tolerance
+        ok = ok and not regressed
+
+        print(f"{name:<36} p95 {before['p95_ms']:>8.1f}ms -> {summary['p95_ms']:>8.1f}ms "
+              f"({change:+.0%}){'  REGRESSED' if regressed else ''}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='postgresql:///warbler-bench')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=50000)
+    parser.add_argument('--likes', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help="use the data already in --database")
+    parser.add_argument('--requests', type=int, default=200, help="per route")
+    parser.add_argument('--warmup', type=int, default=10, help="per route, untimed")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--server', action='store_true',
+                        help="go over HTTP to a local WSGI server")
+    parser.add_argument('--output', help="write results here as JSON")
+    parser.add_argument('--compare', help="earlier results JSON to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed p95 slowdown before --compare fails")
+    args = parser.parse_args()
+
+    # the app connects when it's imported
+    os.environ['DATABASE_URL'] = args.database
+
+    from sqlalchemy import func
+    from app import app
+    from models import db, User, Message, Follows
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    count_queries(app)
+
+    if not args.no_seed:
+        seed(args)
+
+    # the user following the most people has the heaviest home page
+    viewer, = (db.session
+               .query(Follows.user_following_id)
+               .group_by(Follows.user_following_id)
+               .order_by(func.count().desc())
+               .first())
+    user_ids = [id for id, in db.session.query(User.id)]
+    message_ids = [id for id, in db.session.query(Message.id)
+                   .filter(Message.user_id != viewer)]
+    db.session.remove()
+
+    server = None
+    base_url = None
+    if args.server:
+        from werkzeug.serving import make_server
+
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    client = Client(app, viewer, base_url)
+    rng = random.Random(args.seed)
+
+    results = {
+        'meta': {
+            'started': datetime.utcnow().isoformat(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                     capture_output=True, text=True).stdout.strip(),
+            'python': platform.python_version(),
+            'mode': 'server' if args.server else 'test-client',
+            'seeded': not args.no_seed,
+            'dataset': {name: getattr(args, name)
+                        for name in ('users', 'messages', 'follows', 'likes', 'seed')},
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'routes': {},
+    }
+
+    for name, requests in route_requests(args.requests, args.warmup, viewer,
+                                         user_ids, message_ids, rng).items():
+        results['routes'][name] = benchmark(client, name, requests,
+                                            args.concurrency, args.warmup)
+
+    if server:
+        server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Compare the home timeline engines by how many users a reader follows.
+
+    createdb warbler-bench
+    python bench_timelines.py
+    python bench_timelines.py --follows 10 100 1000 5000 --messages-per-author 50
+
+Loads a synthetic network into --database (replacing what's there): one
+reader per --follows count, following that many authors, each of whom
+has posted --messages-per-author messages spread over a year. Then, for
+each reader, times the first page of their home timeline with the
+'push' engine and with the 'merge' engine (with the per-author buffers
+cold, then warm), plus a page deep enough to be past the buffers.
+Prints milliseconds (median of --repeat) and queries per page.
+"""
+
+import argparse
+import csv
+import json
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PASSWORD = 'not-a-real-hash'
+
+
+def write_dataset(directory, follows, messages_per_author, until=datetime(2019, 1, 1)):
+    """CSVs for loader.load; returns the reader ids by follow count."""
+
+    authors = max(follows)
+    readers = {count: authors + i + 1 for i, count in enumerate(follows)}
+
+    with open(os.path.join(directory, 'users.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'email', 'username', 'password'])
+        for user_id in range(1, authors + len(follows) + 1):
+            writer.writerow([user_id, f"user{user_id}@example.com",
+                             f"user{user_id}", PASSWORD])
+
+    # every author posts at a steady rate, offset from the others, so
+    # the merged timeline interleaves them all
+    step = timedelta(days=365) / messages_per_author
+    with open(os.path.join(directory, 'messages.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['text', 'timestamp', 'user_id'])
+        for author in range(1, authors + 1):
+            offset = step * author / authors
+            for i in range(messages_per_author):
+                writer.writerow([f"message {i} from {author}",
+                                 until - step * i - offset, author])
+
+    with open(os.path.join(directory, 'follows.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['user_being_followed_id', 'user_following_id'])
+        for count, reader in readers.items():
+            for author in range(1, count + 1):
+                writer.writerow([author, reader])
+
+    return readers
+
+
+def timed(function, repeat, queries):
+    """(median milliseconds, queries per call) of `repeat` calls."""
+
+    times = []
+    counted = 0
+
+    for _ in range(repeat):
+        before = len(queries)
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+        counted += len(queries) - before
+
+    return round(statistics.median(times), 2), counted / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='postgresql:///warbler-bench')
+    parser.add_argument('--follows', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--messages-per-author', type=int, default=20)
+    parser.add_argument('--buffer-size', type=int, default=50)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--deep-page', type=int, default=5,
+                        help="which page to time as the deep one")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help="write results here as JSON")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database
+
+    from sqlalchemy import event
+    from app import app
+    from cache import LRUCache
+    from current_user import CurrentUser
+    from loader import load
+    from models import db
+    from timelines import RecentMessages, PushTimeline, MergeTimeline
+
+    with tempfile.TemporaryDirectory() as directory:
+        readers = write_dataset(directory, args.follows, args.messages_per_author)
+        load(directory, report=lambda *_: None)
+
+    queries = []
+    event.listen(db.engine, 'before_cursor_execute',
+                 lambda conn, cursor, statement, *rest: queries.append(statement))
+
+    recent = RecentMessages(LRUCache(), size=args.buffer_size, ttl=None)
+    push = PushTimeline()
+    merge = MergeTimeline(recent)
+
+    print(f"{args.messages_per_author} messages per author, buffers of "
+          f"{args.buffer_size}, {args.per_page} per page; ms (queries)")
+    print(f"{'follows':>8} {'push':>14} {'merge cold':>14} {'merge warm':>14} "
+          f"{'push deep':>14} {'merge deep':>14}")
+
+    results = []
+
+    for count, reader_id in readers.items():
+        reader = CurrentUser.load(reader_id)
+        reader.following_ids
+
+        # the cursor for the deep page, the same for either engine
+        before = None
+        for _ in range(args.deep_page - 1):
+            _, before = push.page(reader, before=before, per_page=args.per_page)
+
+        def cold():
+            recent.cache.clear()
+            merge.page(reader, per_page=args.per_page)
+
+        row = {
+            'follows': count,
+            'push': timed(lambda: push.page(reader, per_page=args.per_page),
+                          args.repeat, queries),
+            'merge_cold': timed(cold, args.repeat, queries),
+            'merge_warm': timed(lambda: merge.page(reader, per_page=args.per_page),
+                                args.repeat, queries),
+            'push_deep': timed(lambda: push.page(reader, before=before,
+                                                 per_page=args.per_page),
+                               args.repeat, queries),
+            'merge_deep': timed(lambda: merge.page(reader, before=before,
+                                                   per_page=args.per_page),
+                                args.repeat, queries),
+        }
+        db.session.remove()
+        results.append(row)
+
+        print(f"{count:>8}" + "".join(
+            f"{f'{ms:.1f} ({n:.0f})':>15}"
+            for ms, n in (row[column] for column in
+                          ['push', 'merge_cold', 'merge_warm', 'push_deep', 'merge_deep'])))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(vars(args), results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
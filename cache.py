@@ -0,0 +1,358 @@
+"""Pluggable cache for Warbler pages.
+
+Two backends share one interface (get / get_many / set / incr / delete
+/ stats):
+
+- LRUCache: in-process, bounded, with per-entry TTLs.
+- SocketCache: a client for make_cache_server()'s server, which serves
+  an LRUCache over a local (unix or TCP) socket so every gunicorn worker
+  shares one cache. Start it with `flask cache-server`.
+
+Values must be JSON-serializable so either backend can hold them. Cache
+trouble is never fatal: a SocketCache that can't reach its server just
+misses.
+
+Pick a backend with make_cache(url):
+
+    memory://                       in-process
+    socket:///tmp/warbler-cache     unix socket
+    socket://127.0.0.1:11311        TCP on localhost
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+
+class Cache(ABC):
+    """What every backend provides, plus generation-based invalidation.
+
+    A generation is a token stored under `gen:<namespace>`; keys built
+    with key() include it, so bump() invalidates every key in the
+    namespace at once without having to know what they are.
+    """
+
+    # whether every web process sees the same entries
+    shared = False
+
+    @abstractmethod
+    def get(self, key):
+        """The value at `key`, or None if it's missing."""
+
+    def get_many(self, keys):
+        """{key: value} for those of `keys` that are cached."""
+
+        values = {key: self.get(key) for key in keys}
+        return {key: value for key, value in values.items() if value is not None}
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        """Store `value` at `key`, for `ttl` seconds (None: the default)."""
+
+    @abstractmethod
+    def incr(self, key, amount=1, ttl=None):
+        """Add `amount` to the number at `key` (0 if missing); the new value.
+
+        `ttl` only applies when this creates the key.
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """Drop `key`, if it's there."""
+
+    @abstractmethod
+    def stats(self):
+        """Counters, as a JSON-serializable dict."""
+
+    def generation(self, namespace):
+        """Current generation token for `namespace`."""
+
+        token = self.get(f"gen:{namespace}")
+
+        if token is None:
+            token = self.bump(namespace)
+
+        return token
+
+    def bump(self, namespace):
+        """Start a new generation of `namespace`; old keys stop matching."""
+
+        token = uuid.uuid4().hex[:12]
+        self.set(f"gen:{namespace}", token)
+        return token
+
+    def key(self, namespace, *parts):
+        """A key in the current generation of `namespace`."""
+
+        return ":".join([namespace, self.generation(namespace)]
+                        + [str(part) for part in parts])
+
+    def get_or_set(self, key, compute, ttl=None):
+        """Get `key`, or store and return compute() if it's missing."""
+
+        value = self.get(key)
+
+        if value is None:
+            value = compute()
+            self.set(key, value, ttl)
+
+        return value
+
+
+class LRUCache(Cache):
+    """Bounded in-process cache; least recently used entries go first.
+
+    `default_ttl` (seconds) applies when set() isn't given one; None
+    means entries only leave by eviction.
+    """
+
+    def __init__(self, max_size=10000, default_ttl=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = dict(hits=0, misses=0, evictions=0, expirations=0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self._counts['misses'] += 1
+                return None
+
+            expires, value = entry
+
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self._counts['expirations'] += 1
+                self._counts['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._counts['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or (entry[0] is not None and entry[0] <= time.monotonic()):
+                ttl = self.default_ttl if ttl is None else ttl
+                entry = (None if ttl is None else time.monotonic() + ttl, 0)
+
+            expires, value = entry
+            self._entries[key] = (expires, value + amount)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._counts['evictions'] += 1
+
+            return value + amount
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry (counters are kept)."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, size=len(self._entries),
+                        max_size=self.max_size)
+
+
+##############################################################################
+# Shared cache over a local socket
+#
+# One JSON object per line each way:
+#   {"op": "get", "key": k}                     -> {"value": v}
+#   {"op": "get_many", "keys": [k, ...]}        -> {"value": {k: v, ...}}
+#   {"op": "set", "key": k, "value": v, "ttl": t} -> {}
+#   {"op": "incr", "key": k, "amount": n, "ttl": t} -> {"value": n}
+#   {"op": "delete", "key": k}                  -> {}
+#   {"op": "stats"}                             -> {"value": {...}}
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+    """Answer cache requests on one client connection until it closes."""
+
+    def handle(self):
+        cache = self.server.cache
+
+        for line in self.rfile:
+            request = json.loads(line)
+            op = request['op']
+
+            if op == 'get':
+                reply = {'value': cache.get(request['key'])}
+            elif op == 'get_many':
+                reply = {'value': cache.get_many(request['keys'])}
+            elif op == 'set':
+                cache.set(request['key'], request['value'], request.get('ttl'))
+                reply = {}
+            elif op == 'incr':
+                reply = {'value': cache.incr(request['key'], request['amount'],
+                                             request.get('ttl'))}
+            elif op == 'delete':
+                cache.delete(request['key'])
+                reply = {}
+            elif op == 'stats':
+                reply = {'value': cache.stats()}
+            else:
+                reply = {'error': f"unknown op {op!r}"}
+
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class _UnixCacheServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPCacheServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_address(url):
+    """socket://host:port -> (host, port); socket:///path -> path."""
+
+    parsed = urlparse(url)
+
+    if parsed.hostname:
+        return (parsed.hostname, parsed.port)
+
+    return parsed.path
+
+
+def make_cache_server(url, cache=None):
+    """A threaded socket server sharing `cache` (a new LRUCache by default).
+
+    Call serve_forever() on it (or run `flask cache-server`).
+    """
+
+    address = parse_address(url)
+
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixCacheServer(address, _CacheRequestHandler)
+    else:
+        server = _TCPCacheServer(address, _CacheRequestHandler)
+
+    server.cache = cache if cache is not None else LRUCache()
+    return server
+
+
+class SocketCache(Cache):
+    """Client for a make_cache_server() server; one connection per thread.
+
+    Connection problems count as `errors` and make the call a miss (or a
+    no-op), so a dead cache server slows pages down rather than breaking
+    them.
+    """
+
+    shared = True
+
+    def __init__(self, url, timeout=0.5):
+        self.address = parse_address(url)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._counts = dict(hits=0, misses=0, errors=0)
+
+    def _connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        return sock, sock.makefile('rb')
+
+    def _call(self, **request):
+        try:
+            if getattr(self._local, 'conn', None) is None:
+                self._local.conn = self._connect()
+
+            sock, replies = self._local.conn
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            line = replies.readline()
+            if not line:
+                raise ConnectionError("cache server closed the connection")
+
+            return json.loads(line)
+
+        except (OSError, ValueError):
+            self._counts['errors'] += 1
+            conn, self._local.conn = getattr(self._local, 'conn', None), None
+            if conn:
+                conn[0].close()
+            return None
+
+    def get(self, key):
+        reply = self._call(op='get', key=key)
+        value = reply and reply.get('value')
+
+        self._counts['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def get_many(self, keys):
+        """In one round trip."""
+
+        keys = list(keys)
+        reply = self._call(op='get_many', keys=keys)
+        values = (reply and reply.get('value')) or {}
+
+        self._counts['hits'] += len(values)
+        self._counts['misses'] += len(keys) - len(values)
+        return values
+
+    def set(self, key, value, ttl=None):
+        self._call(op='set', key=key, value=value, ttl=ttl)
+
+    def incr(self, key, amount=1, ttl=None):
+        """The new value, or None if the server couldn't be reached."""
+
+        reply = self._call(op='incr', key=key, amount=amount, ttl=ttl)
+        return reply and reply.get('value')
+
+    def delete(self, key):
+        self._call(op='delete', key=key)
+
+    def stats(self):
+        """This client's counters, plus the server's under 'server'."""
+
+        reply = self._call(op='stats')
+        return dict(self._counts, server=reply and reply.get('value'))
+
+
+def make_cache(url, max_size=10000):
+    """Make the cache backend described by `url` (see module docstring)."""
+
+    if url.startswith('socket://'):
+        return SocketCache(url)
+
+    return LRUCache(max_size=max_size)
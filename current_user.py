@@ -0,0 +1,141 @@
+"""Slim, cacheable stand-in for the logged-in user."""
+
+from cache import LRUCache
+from models import db, User, Follows, Likes
+
+
+class CurrentUser:
+    """The logged-in user, as the routes and templates need to see it.
+
+    Only the handful of columns used on every page are loaded (no password
+    hash, bio, etc.), and the follow/like id sets are only queried if a
+    page actually asks for them. Anything that needs the full row (editing
+    the profile, deleting the account) should load the `User` itself.
+    """
+
+    COLUMNS = (
+        'id',
+        'username',
+        'image_url',
+        'header_image_url',
+        'messages_count',
+        'following_count',
+        'followers_count',
+        'likes_count',
+    )
+
+    def __init__(self, **columns):
+        for column in self.COLUMNS:
+            setattr(self, column, columns[column])
+
+        self._following_ids = None
+        self._liked_ids = None
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @classmethod
+    def load(cls, user_id):
+        """Fetch just our columns for user `user_id`; None if no such user."""
+
+        row = (db.session
+               .query(*[getattr(User, column) for column in cls.COLUMNS])
+               .filter(User.id == user_id)
+               .first())
+
+        return cls(**row._asdict()) if row else None
+
+    def as_dict(self):
+        """The loaded columns, suitable for caching."""
+
+        return {column: getattr(self, column) for column in self.COLUMNS}
+
+    @property
+    def following_ids(self):
+        """Ids of everyone this user follows (queried once, on first use)."""
+
+        if self._following_ids is None:
+            rows = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id))
+            self._following_ids = {followed_id for (followed_id,) in rows}
+
+        return self._following_ids
+
+    @property
+    def liked_ids(self):
+        """Ids of every message this user likes (queried once, on first use)."""
+
+        if self._liked_ids is None:
+            rows = (db.session
+                    .query(Likes.message_id)
+                    .filter(Likes.user_id == self.id))
+            self._liked_ids = {message_id for (message_id,) in rows}
+
+        return self._liked_ids
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`?"""
+
+        if self._following_ids is not None:
+            return other_user.id in self._following_ids
+
+        return Follows.is_following(self.id, other_user.id)
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` does this user follow? Returns a set of ids."""
+
+        if self._following_ids is not None:
+            return self._following_ids.intersection(user_ids)
+
+        return Follows.followed_among(self.id, user_ids)
+
+    def liked_among(self, message_ids):
+        """Which of `message_ids` does this user like? Returns a set of ids."""
+
+        if self._liked_ids is not None:
+            return self._liked_ids.intersection(message_ids)
+
+        return Likes.liked_among(self.id, message_ids)
+
+
+class CurrentUserCache:
+    """Short-lived, in-process cache of CurrentUser columns by user id.
+
+    Hot users are served without a database round trip for up to `ttl`
+    seconds; writes should `forget` the users they touch. A ttl of 0
+    turns caching off. At most `max_size` users are held; the least
+    recently seen go first.
+    """
+
+    def __init__(self, ttl=10, max_size=10000):
+        self.ttl = ttl
+        self._entries = LRUCache(max_size=max_size)
+
+    def get(self, user_id):
+        """Get the CurrentUser for `user_id`, from cache if fresh enough."""
+
+        entry = self._entries.get(user_id)
+
+        if entry is not None:
+            return CurrentUser(**entry)
+
+        current = CurrentUser.load(user_id)
+
+        if current and self.ttl > 0:
+            self._entries.set(user_id, current.as_dict(), ttl=self.ttl)
+        else:
+            self._entries.delete(user_id)
+
+        return current
+
+    def forget(self, *user_ids):
+        """Drop cached entries so the next request reloads them."""
+
+        for user_id in user_ids:
+            self._entries.delete(user_id)
+
+    def clear(self):
+        """Drop every cached entry."""
+
+        self._entries.clear()
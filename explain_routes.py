@@ -0,0 +1,211 @@
+"""EXPLAIN every query the main read routes run; fail on sequential scans.
+
+Run against a seeded database:
+
+    python explain_routes.py
+
+Each route is requested through the test client as a real user, the SQL
+it runs is captured, and each SELECT is EXPLAINed with sequential scans
+(and merge/hash joins) disabled. Postgres then still picks a Seq Scan
+only when no index can serve the query at all, so any Seq Scan in a plan
+is a missing index -- however small the tables are. Index scans that walk a
+whole index (see full_scans) count too. Deeper pages (`?before=`) must
+also seek to their cursor: the timestamp has to be in an Index Cond, not
+a Filter applied while reading from the newest row. Exits 1 if any of
+that fails.
+"""
+
+import re
+import sys
+
+from sqlalchemy import event, func
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message
+from pagination import encode_cursor
+
+
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'}
+
+# keyset_page's cursor condition: (<table>.timestamp, <table>.id) < (...)
+CURSOR_CONDITION = re.compile(r"\(\w+\.timestamp, \w+\.\w+\) <")
+
+
+def leading_column(cursor, index_name):
+    """First column of index `index_name` (None for expression indexes)."""
+
+    cursor.execute("""
+        SELECT attribute.attname
+          FROM pg_index
+          JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+          LEFT JOIN pg_attribute attribute
+                 ON attribute.attrelid = pg_index.indrelid
+                AND attribute.attnum = pg_index.indkey[0]
+         WHERE pg_class.relname = %s
+    """, (index_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def full_scans(plan, cursor, under_limit=False):
+    """Yield a description of every scan in a JSON plan that reads a whole
+    table or index.
+
+    That's any Seq Scan, and any index scan whose condition doesn't pin
+    the index's leading column (Postgres will happily walk all of a
+    composite index to test its second column). An unconditioned index
+    scan straight under a Limit is just reading the first rows in order,
+    so it's allowed.
+    """
+
+    node = plan.get('Node Type')
+
+    if node == 'Seq Scan':
+        yield plan.get('Relation Name')
+
+    elif node in INDEX_SCANS:
+        index = plan.get('Index Name')
+        condition = plan.get('Index Cond', '')
+        leading = leading_column(cursor, index)
+
+        if not condition and not under_limit:
+            yield f"all of {index}"
+        elif condition and leading and f"{leading} " not in condition:
+            yield f"all of {index} (nothing on {leading})"
+
+    for child in plan.get('Plans', []):
+        yield from full_scans(child, cursor, under_limit=(node == 'Limit'))
+
+
+def index_conditions(plan):
+    """Yield the Index Cond of every index scan in a JSON plan."""
+
+    if plan.get('Node Type') in INDEX_SCANS:
+        yield plan.get('Index Cond', '')
+
+    for child in plan.get('Plans', []):
+        yield from index_conditions(child)
+
+
+def explain(statement, parameters):
+    """(full scans, index conditions) in the plan for `statement`, with
+    seq scans disabled."""
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # steer the planner to index lookups wherever one could work, so
+        # whatever full scans remain are ones no index can avoid
+        for setting in ('enable_seqscan', 'enable_mergejoin', 'enable_hashjoin'):
+            cursor.execute(f"SET {setting} = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        (plans,), = cursor.fetchall()
+        plan = plans[0]['Plan']
+        return sorted(set(full_scans(plan, cursor))), list(index_conditions(plan))
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def capture(client, url):
+    """Request `url`, returning the (statement, parameters) it ran."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+    if resp.status_code != 200:
+        raise SystemExit(f"{url} returned {resp.status_code}")
+
+    return statements
+
+
+def main():
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    # the busiest author makes for the most realistic plans
+    busiest = (db.session
+               .query(Message.user_id)
+               .group_by(Message.user_id)
+               .order_by(func.count().desc())
+               .first())
+    if not busiest:
+        raise SystemExit("No messages to explain against; seed the database first.")
+
+    user = User.query.get(busiest.user_id)
+    message = Message.query.filter_by(user_id=user.id).first()
+
+    # somewhere in the middle of their messages, for the deep pages
+    middle = (Message.query
+              .filter_by(user_id=user.id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .offset(user.messages_count // 2)
+              .first()) or message
+    before = encode_cursor(middle)
+
+    urls = [
+        '/',
+        '/users',
+        f'/users?after={user.id}',
+        f'/users?q={user.username[:3]}',
+        f'/users/{user.id}',
+        f'/users/{user.id}/following',
+        f'/users/{user.id}/followers',
+        f'/users/{user.id}/likes',
+        f'/messages/{message.id}',
+    ]
+
+    deep_urls = [
+        f'/?before={before}',
+        f'/users/{user.id}?before={before}',
+    ]
+
+    failures = 0
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+        for url in urls + deep_urls:
+            seeks = 0
+
+            for statement, parameters in capture(client, url):
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+
+                scanned, conditions = explain(statement, parameters)
+                if scanned:
+                    failures += 1
+                    print(f"FAIL {url}: full scan of {', '.join(scanned)}")
+                    print("    " + " ".join(statement.split()))
+
+                if CURSOR_CONDITION.search(statement):
+                    if any('timestamp' in condition for condition in conditions):
+                        seeks += 1
+                    else:
+                        failures += 1
+                        print(f"FAIL {url}: cursor filtered, not seeked to")
+                        print("    " + " ".join(statement.split()))
+
+            if url in deep_urls and not seeks:
+                failures += 1
+                print(f"FAIL {url}: no query seeked to the cursor")
+
+            print(f"checked {url}")
+
+    if failures:
+        print(f"{failures} queries need an index (or a seekable cursor).")
+        sys.exit(1)
+
+    print("No sequential scans; deep pages seek to their cursor.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Cache of rendered message-card HTML fragments."""
+
+from flask import render_template
+from markupsafe import Markup
+
+from cache import LRUCache
+
+
+class FragmentCache:
+    """Bounded LRU of rendered message cards.
+
+    Cards are keyed by message id and the author's profile version (the
+    author fields the card shows), so an edited profile simply misses.
+    Keys also carry a generation per message and per author (see
+    Cache.key), so `forget_message` / `forget_author` drop a message's
+    or an author's cards by bumping one generation; the old cards then
+    age out of the LRU.
+    """
+
+    def __init__(self, max_size=10000):
+        self._cards = LRUCache(max_size=max_size)
+
+    @staticmethod
+    def author_version(user):
+        """What about `user` a message card shows."""
+
+        return (user.username, user.image_url)
+
+    def _key(self, msg):
+        return self._cards.key(f"message:{msg.id}",
+                               self._cards.generation(f"author:{msg.user_id}"),
+                               *self.author_version(msg.user))
+
+    def message_card(self, msg):
+        """The card markup (avatar, username, date, text) for `msg`."""
+
+        return self._cards.get_or_set(
+            self._key(msg),
+            lambda: Markup(render_template('messages/_card.html', msg=msg)))
+
+    def forget_message(self, message_id):
+        """Drop the cached card(s) for a deleted message."""
+
+        self._cards.bump(f"message:{message_id}")
+
+    def forget_author(self, user_id):
+        """Drop every cached card by `user_id` (e.g. after a profile edit)."""
+
+        self._cards.bump(f"author:{user_id}")
+
+    def clear(self):
+        """Drop every card."""
+
+        self._cards.clear()
+
+    def stats(self):
+        return self._cards.stats()
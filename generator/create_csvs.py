@@ -1,77 +1,212 @@
 """Generate CSVs of random data for Warbler.
 
-Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --likes 20000000 --seed 7 --out /data/warbler
+
+Writes users.csv, messages.csv, follows.csv and likes.csv for
+`flask load-csv` (see loader.py). The defaults make a dataset the size
+of the sample one in this directory.
+
+Everything is streamed to disk row by row; the only per-row state kept
+is each message's author (4 bytes a message) so likes can skip a user's
+own messages. Runs are offline and, for a given --seed and --until,
+reproducible.
+
+The data is shaped like a real network: who gets followed, who posts
+and which messages get liked all follow power laws (a few very popular
+users, a long tail of quiet ones); posting picks up over time and is
+busiest in the evenings; messages are in time order.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import sys
+import time
+from array import array
+from datetime import datetime
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import ZipfSampler, ActivityClock, sorted_fractions
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 2000
 
-fake = Faker()
+# bcrypt of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Profile image URLs to use for users (built, never fetched)
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+# power-law exponents: how lopsided follows, posting and likes are
+FOLLOW_EXPONENT = 1.1
+POSTING_EXPONENT = 0.8
+LIKE_EXPONENT = 1.0
+
+
+def progress(name, rows, started):
+    print(f"{name}: {rows} rows in {time.perf_counter() - started:.1f}s",
+          file=sys.stderr)
+
+
+def write_csv(directory, name, headers, rows):
+    """Stream `rows` (tuples in `headers` order) to directory/name.csv."""
+
+    started = time.perf_counter()
+    count = 0
+
+    with open(os.path.join(directory, f"{name}.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+
+    progress(name, count, started)
+
+
+def users(count, fake, rng):
+    # Faker is slow, so draw from pools of its values; the id suffix
+    # keeps names and emails unique at any scale
+    pool = range(min(count, 5000))
+    names = [fake.user_name() for _ in pool]
+    bios = [fake.sentence() for _ in pool]
+    cities = [fake.city() for _ in pool]
+    domains = [fake.free_email_domain() for _ in range(20)]
+
+    for i in range(1, count + 1):
+        username = f"{rng.choice(names)}{i}"
+        yield (f"{username}@{rng.choice(domains)}",
+               username,
+               rng.choice(IMAGE_URLS),
+               PASSWORD,
+               rng.choice(bios),
+               HEADER_IMAGE_URL,
+               rng.choice(cities))
+
+
+def messages(count, num_users, until, days, words, authors, rng):
+    """Messages in time order; records each one's author in `authors`."""
+
+    pick_author = ZipfSampler(num_users, POSTING_EXPONENT, rng)
+    clock = ActivityClock(until, days)
+
+    for fraction in sorted_fractions(count, rng):
+        author = pick_author()
+        authors.append(author)
+
+        text = " ".join(rng.choices(words, k=rng.randint(3, 24))).capitalize()
+        yield (text[:MAX_WARBLER_LENGTH - 1] + ".", clock.at(fraction), author)
+
+
+def degrees(total, num_users, rng):
+    """(user id, how many) spreading about `total` over every user.
+
+    Out-degrees are exponentially distributed: most users do a little,
+    some do a lot.
+    """
+
+    mean = total / num_users
+
+    for user_id in range(1, num_users + 1):
+        yield user_id, int(rng.expovariate(1 / mean)) if mean else 0
+
+
+def follows(total, num_users, rng):
+    pick_followed = ZipfSampler(num_users, FOLLOW_EXPONENT, rng)
+
+    for follower, count in degrees(total, num_users, rng):
+        count = min(count, num_users - 1)
+        followed = set()
+
+        # the popular few come up again and again; give up on a user
+        # rather than draw forever
+        for _ in range(count * 4):
+            if len(followed) == count:
+                break
+            user_id = pick_followed()
+            if user_id != follower:
+                followed.add(user_id)
+
+        for user_id in sorted(followed):
+            yield user_id, follower
+
+
+def likes(total, num_users, authors, rng):
+    pick_message = ZipfSampler(len(authors), LIKE_EXPONENT, rng)
+
+    for liker, count in degrees(total, num_users, rng):
+        count = min(count, len(authors))
+        liked = set()
+
+        for _ in range(count * 4):
+            if len(liked) == count:
+                break
+            message_id = pick_message()
+            if authors[message_id - 1] != liker:
+                liked.add(message_id)
+
+        for message_id in sorted(liked):
+            yield liker, message_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="about how many follows")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="about how many likes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime(2019, 1, 1),
+                        help="latest timestamp (YYYY-MM-DD[THH:MM])")
+    parser.add_argument('--days', type=int, default=365,
+                        help="how far back messages go")
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)))
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    rng = random.Random(args.seed)
+    fake = Faker()
+    fake.seed_instance(args.seed)
+
+    words = fake.words(500)
+    authors = array('i')
+
+    write_csv(args.out, 'users', USERS_CSV_HEADERS,
+              users(args.users, fake, rng))
+    write_csv(args.out, 'messages', MESSAGES_CSV_HEADERS,
+              messages(args.messages, args.users, args.until, args.days,
+                       words, authors, rng))
+    write_csv(args.out, 'follows', FOLLOWS_CSV_HEADERS,
+              follows(args.follows, args.users, rng))
+    if authors:
+        write_csv(args.out, 'likes', LIKES_CSV_HEADERS,
+                  likes(args.likes, args.users, authors, rng))
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
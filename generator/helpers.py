@@ -1,14 +1,89 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import math
+from bisect import bisect
+from datetime import timedelta
+from itertools import accumulate
 
+# relative posting activity by hour of day: quiet overnight, busy evenings
+HOURLY_ACTIVITY = [2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 7, 8,
+                   9, 8, 7, 7, 8, 9, 10, 11, 11, 10, 7, 4]
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+class ZipfSampler:
+    """Draw ids 1..n with probability falling off as rank ** -exponent.
 
-    return datetime.fromtimestamp(random_timestamp)
+    Ranks come from the inverse of the continuous power-law CDF, so no
+    per-id table is needed, and are mapped to ids by a seeded affine
+    permutation, so the most popular id isn't always 1.
+    """
+
+    def __init__(self, n, exponent, rng):
+        self.n = n
+        self.exponent = exponent
+        self.rng = rng
+
+        self.step = rng.randrange(1, n + 1) if n > 1 else 1
+        while math.gcd(self.step, n) != 1:
+            self.step += 1
+        self.offset = rng.randrange(n)
+
+    def rank(self):
+        """A rank in 1..n (1 the most likely)."""
+
+        u = self.rng.random()
+
+        if self.exponent == 1:
+            rank = (self.n + 1) ** u
+        else:
+            power = 1 - self.exponent
+            rank = ((self.n + 1) ** power * u + (1 - u)) ** (1 / power)
+
+        return min(int(rank), self.n)
+
+    def __call__(self):
+        """A random id in 1..n."""
+
+        return (self.rank() * self.step + self.offset) % self.n + 1
+
+
+class ActivityClock:
+    """Timestamps over `days` days ending at `until`, busier in the
+    evenings and growing linearly (by `growth` times) from start to end.
+    """
+
+    def __init__(self, until, days, growth=3.0):
+        self.start = until - timedelta(days=days)
+
+        weights = [(1 + (growth - 1) * day / max(days - 1, 1)) * activity
+                   for day in range(days)
+                   for activity in HOURLY_ACTIVITY]
+        self.cumulative = list(accumulate(weights))
+
+    def at(self, fraction):
+        """The timestamp `fraction` (0..1) of the way through all activity.
+
+        Monotonic, so sorted fractions give sorted timestamps.
+        """
+
+        target = fraction * self.cumulative[-1]
+        hour = min(bisect(self.cumulative, target), len(self.cumulative) - 1)
+
+        before = self.cumulative[hour - 1] if hour else 0
+        into = (target - before) / (self.cumulative[hour] - before)
+
+        return self.start + timedelta(hours=hour + into)
+
+
+def sorted_fractions(count, rng):
+    """`count` uniform random numbers in 0..1, in increasing order.
+
+    Generated one at a time (as order statistics), so they needn't all be
+    held and sorted.
+    """
+
+    largest = 1.0
+
+    for remaining in range(count, 0, -1):
+        largest *= rng.random() ** (1 / remaining)
+        yield 1 - largest
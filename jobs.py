@@ -0,0 +1,299 @@
+"""Background jobs for the side effects of writes.
+
+A route enqueues a job in the same transaction as its write
+
+    jobs.enqueue('deliver_message', key=f"deliver_message:{msg.id}",
+                 message_id=msg.id)
+    db.session.commit()
+
+so the job is stored exactly when the write is, and returns without
+waiting for it. Worker processes (`flask worker`) claim due jobs from
+the jobs table: on Postgres with SELECT ... FOR UPDATE SKIP LOCKED, so
+workers never wait on each other's rows; on SQLite, which has a single
+writer anyway, the claiming UPDATE alone decides who gets a job.
+
+A job's work and its being marked done are one transaction: it either
+all happens or is rolled back and retried after a backoff, up to
+JOB_MAX_ATTEMPTS, then marked failed. Jobs whose worker died are
+requeued after JOB_TIMEOUT. Enqueueing again under an existing
+idempotency key does nothing.
+
+With JOBS_EAGER, a request's jobs run in the web process as it
+finishes, for tests and development without a worker.
+
+Workers don't share the web processes' in-process caches, so cache
+invalidation that has to be immediate stays in the routes.
+
+Done jobs are kept for JOB_KEEP_DONE seconds, then pruned by the
+workers; stats() only counts the jobs that aren't done, so it stays
+cheap however many those are.
+"""
+
+import json
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context
+from sqlalchemy.dialects import postgresql
+
+from models import db, Job
+
+# the statuses stats() counts ('done' jobs are only pruned)
+STATUSES = ['queued', 'running', 'failed']
+
+# seconds between a worker's prunes of old done jobs
+PRUNE_INTERVAL = 60
+
+# longest wait between retries, in seconds
+MAX_RETRY_DELAY = 600
+
+
+class JobQueue:
+    """Tasks by name, and the means to enqueue and run them."""
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        self._last_prune = 0.0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('JOBS_EAGER', False)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOB_RETRY_DELAY', 2)
+        app.config.setdefault('JOB_TIMEOUT', 300)
+        app.config.setdefault('JOB_KEEP_DONE', 86400)
+
+        app.after_request(self._run_eager)
+
+    def task(self, name):
+        """Register the decorated function as the task `name`."""
+
+        def register(function):
+            self.tasks[name] = function
+            return function
+
+        return register
+
+    def enqueue(self, task, key=None, delay=0, **payload):
+        """Add a job running `task(**payload)` to the current transaction.
+
+        Returns the job's id, or None if `key` was already used.
+        """
+
+        if task not in self.tasks:
+            raise ValueError(f"No such task: {task}")
+
+        now = datetime.utcnow()
+        values = dict(task=task, payload=json.dumps(payload), idempotency_key=key,
+                      status='queued', attempts=0, created_at=now,
+                      run_at=now + timedelta(seconds=delay))
+
+        if db.engine.dialect.name == 'postgresql':
+            job_id = db.session.execute(
+                postgresql.insert(Job.__table__)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=['idempotency_key'])
+                .returning(Job.id)).scalar()
+        else:
+            result = db.session.execute(
+                Job.__table__.insert()
+                .prefix_with('OR IGNORE', dialect='sqlite')
+                .values(**values))
+            job_id = result.inserted_primary_key[0] if result.rowcount else None
+
+        if job_id and self.app.config['JOBS_EAGER'] and has_request_context():
+            g.setdefault('eager_jobs', []).append(job_id)
+
+        return job_id
+
+    def _run_eager(self, resp):
+        for job_id in g.pop('eager_jobs', []):
+            if self._claim(job_id, 'eager', datetime.utcnow()):
+                db.session.commit()
+                self.run(job_id)
+
+        return resp
+
+    def _claim(self, job_id, worker, now):
+        """Mark job `job_id` running for `worker`, if it's still queued."""
+
+        return Job.query.filter(Job.id == job_id, Job.status == 'queued').update({
+            Job.status: 'running',
+            Job.attempts: Job.attempts + 1,
+            Job.locked_at: now,
+            Job.locked_by: worker,
+        }, synchronize_session=False)
+
+    def claim(self, worker, limit=1):
+        """Claim up to `limit` due jobs for `worker`; returns their ids."""
+
+        now = datetime.utcnow()
+        self.requeue_stale(now)
+
+        due = (db.session
+               .query(Job.id)
+               .filter(Job.status == 'queued')
+               .filter(Job.run_at <= now)
+               .order_by(Job.run_at, Job.id)
+               .limit(limit)
+               .with_for_update(skip_locked=True))
+
+        claimed = [job_id for job_id, in due.all()
+                   if self._claim(job_id, worker, now)]
+        db.session.commit()
+
+        return claimed
+
+    def requeue_stale(self, now):
+        """Requeue (or fail, if out of attempts) jobs running too long."""
+
+        stale = (Job.query
+                 .filter(Job.status == 'running')
+                 .filter(Job.locked_at < now - timedelta(
+                     seconds=self.app.config['JOB_TIMEOUT'])))
+
+        stale.filter(Job.attempts >= self.app.config['JOB_MAX_ATTEMPTS']).update(
+            {Job.status: 'failed', Job.finished_at: now,
+             Job.last_error: "worker timed out"}, synchronize_session=False)
+        stale.update({Job.status: 'queued', Job.locked_by: None},
+                     synchronize_session=False)
+
+    def run(self, job_id):
+        """Run claimed job `job_id`; True if it succeeded."""
+
+        job = Job.query.get(job_id)
+
+        try:
+            self.tasks[job.task](**json.loads(job.payload))
+            job.status = 'done'
+            job.finished_at = datetime.utcnow()
+            job.last_error = None
+            db.session.commit()
+            return True
+
+        except Exception:
+            db.session.rollback()
+            self._failed(job_id, traceback.format_exc())
+            return False
+
+    def _failed(self, job_id, error):
+        job = Job.query.get(job_id)
+        now = datetime.utcnow()
+
+        if job.attempts >= self.app.config['JOB_MAX_ATTEMPTS'] or job.task not in self.tasks:
+            job.status = 'failed'
+            job.finished_at = now
+        else:
+            delay = self.app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+            job.status = 'queued'
+            job.run_at = now + timedelta(seconds=min(delay, MAX_RETRY_DELAY))
+
+        job.last_error = error
+        db.session.commit()
+
+        self.app.logger.warning("Job %s (%s) attempt %s %s:\n%s", job.id, job.task,
+                                job.attempts, job.status, error)
+
+    def prune(self):
+        """Delete done jobs older than JOB_KEEP_DONE seconds."""
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['JOB_KEEP_DONE'])
+        (Job.query
+         .filter(Job.status == 'done')
+         .filter(Job.finished_at < cutoff)
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+    def work(self, worker=None, once=False, poll=1.0, batch=10):
+        """Run jobs as they come due; with `once`, until none are left."""
+
+        worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+
+        while True:
+            # however busy the queue is
+            if time.monotonic() - self._last_prune > PRUNE_INTERVAL:
+                self._last_prune = time.monotonic()
+                self.prune()
+
+            claimed = self.claim(worker, batch)
+            for job_id in claimed:
+                self.run(job_id)
+
+            if claimed:
+                continue
+            if once:
+                return
+
+            time.sleep(poll)
+
+    def run_workers(self, processes, once=False):
+        """Run `processes` worker processes until they exit (or ^C)."""
+
+        # forked, so each has the app (and the registered tasks) loaded
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=self._worker_process, args=(once,))
+                   for _ in range(processes)]
+
+        for process in workers:
+            process.start()
+
+        try:
+            for process in workers:
+                process.join()
+        except KeyboardInterrupt:
+            for process in workers:
+                process.terminate()
+
+    def _worker_process(self, once):
+        with self.app.app_context():
+            # the parent's pooled connections mustn't be shared
+            db.engine.dispose()
+            self.work(once=once)
+
+    def stats(self):
+        """Jobs that aren't done by status, how many are retrying, and how
+        late the oldest due job is (seconds)."""
+
+        now = datetime.utcnow()
+        counts = dict.fromkeys(STATUSES, 0)
+        # matches ix_jobs_pending, so done jobs aren't read
+        counts.update(db.session
+                      .query(Job.status, db.func.count(Job.id))
+                      .filter(Job.status != 'done')
+                      .group_by(Job.status))
+
+        queued = Job.query.filter(Job.status == 'queued')
+        oldest = (queued
+                  .filter(Job.run_at <= now)
+                  .with_entities(db.func.min(Job.run_at))
+                  .scalar())
+
+        return dict(counts,
+                    retrying=queued.filter(Job.attempts > 0).count(),
+                    oldest_due_seconds=round((now - oldest).total_seconds(), 3)
+                    if oldest else 0.0)
+
+    def metrics(self):
+        """stats() in the Prometheus text exposition format."""
+
+        stats = self.stats()
+
+        lines = ["# HELP warbler_jobs Jobs not yet done, by status.",
+                 "# TYPE warbler_jobs gauge"]
+        lines += [f'warbler_jobs{{status="{status}"}} {stats[status]}'
+                  for status in STATUSES]
+        lines += ["# HELP warbler_jobs_retrying Queued jobs that have failed before.",
+                  "# TYPE warbler_jobs_retrying gauge",
+                  f"warbler_jobs_retrying {stats['retrying']}",
+                  "# HELP warbler_jobs_oldest_due_seconds How long the oldest due job has waited.",
+                  "# TYPE warbler_jobs_oldest_due_seconds gauge",
+                  f"warbler_jobs_oldest_due_seconds {stats['oldest_due_seconds']}"]
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,223 @@
+"""Bulk-load Warbler's tables from CSV files.
+
+    flask load-csv generator/
+    flask load-csv big-dataset/ --batch-size 50000 --no-copy
+
+Reads users.csv, messages.csv, follows.csv and likes.csv (whichever
+exist) from a directory; each file's header names the columns it fills.
+Rows are streamed, never held in memory all at once:
+
+- on Postgres, each file goes straight to COPY ... FROM STDIN;
+- elsewhere (or with --no-copy) rows are inserted `batch_size` at a time.
+
+Secondary indexes on the loaded tables are dropped first and rebuilt
+once the data is in, which is much faster than maintaining them row by
+row. Then the derived data (timelines, user counters) is rebuilt and
+the tables analyzed. Each step reports its rows per second.
+"""
+
+import csv
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from models import db, User, TimelineEntry
+
+# in load order: later files refer to rows in earlier ones
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+BATCH_SIZE = 10000
+
+
+def report_rate(step, rows, seconds):
+    """Print how fast `step` went (`rows` is None for steps without rows)."""
+
+    if rows is None:
+        print(f"{step}: {seconds:.1f}s")
+    else:
+        rate = rows / seconds if seconds else 0
+        print(f"{step}: {rows} rows in {seconds:.1f}s ({rate:,.0f} rows/s)")
+
+
+def python_defaults(table, columns):
+    """Columns missing from `columns` whose default only SQLAlchemy knows.
+
+    COPY can't apply those, so a file without them is loaded in batches.
+    """
+
+    return [column.name for column in table.columns
+            if column.name not in columns
+            and column.default is not None
+            and column.server_default is None]
+
+
+def copy_csv(connection, table, path):
+    """COPY the CSV at `path` into `table`; returns the row count."""
+
+    with open(path, newline='') as f:
+        columns = next(csv.reader(f))
+        f.seek(0)
+
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv, HEADER true)", f)
+        return cursor.rowcount
+
+
+def parse_bool(value):
+    return value.lower() in ('t', 'true', '1', 'yes')
+
+
+def converters(table, columns):
+    """{column: function turning a CSV field into the column's Python type}.
+
+    Postgres would take the strings as they are (as COPY does), but
+    other databases' drivers want real datetimes, ints and so on.
+    """
+
+    converts = {}
+
+    for column in columns:
+        try:
+            python_type = table.c[column].type.python_type
+        except NotImplementedError:
+            python_type = str
+
+        converts[column] = {datetime: datetime.fromisoformat,
+                            bool: parse_bool}.get(python_type, python_type)
+
+    return converts
+
+
+def insert_csv(connection, table, path, batch_size=BATCH_SIZE):
+    """Insert the CSV at `path` into `table`, `batch_size` rows at a time.
+
+    Empty fields are NULLs, as they are to COPY. Returns the row count.
+    """
+
+    rows = 0
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        convert = converters(table, reader.fieldnames or [])
+
+        while True:
+            batch = [{column: convert[column](value) if value != '' else None
+                      for column, value in row.items()}
+                     for row in islice(reader, batch_size)]
+            if not batch:
+                break
+
+            connection.execute(table.insert(), batch)
+            rows += len(batch)
+
+    return rows
+
+
+def secondary_indexes(connection, tables):
+    """(name, definition) of the indexes on `tables` not backing a
+    primary key or unique constraint."""
+
+    return list(connection.execute("""
+        SELECT indexes.indexname, indexes.indexdef
+          FROM pg_indexes indexes
+         WHERE indexes.schemaname = current_schema()
+           AND indexes.tablename = ANY(%(tables)s)
+           AND NOT EXISTS (
+                 SELECT 1 FROM pg_constraint
+                  WHERE pg_constraint.conindid = (quote_ident(indexes.indexname))::regclass)
+    """, {'tables': list(tables)}))
+
+
+@contextmanager
+def indexes_dropped(engine, tables, report=report_rate):
+    """Drop the secondary indexes on `tables` for the `with` block
+    (Postgres only), then rebuild them."""
+
+    if engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    with engine.begin() as connection:
+        indexes = secondary_indexes(connection, tables)
+        for name, _ in indexes:
+            connection.execute(f'DROP INDEX "{name}"')
+
+    try:
+        yield
+    finally:
+        for name, definition in indexes:
+            started = time.perf_counter()
+            with engine.begin() as connection:
+                connection.execute(definition)
+            report(f"index {name}", None, time.perf_counter() - started)
+
+
+def reset_sequences(connection, tables):
+    """Move `tables`' id sequences past ids loaded from the files."""
+
+    for table in tables:
+        connection.execute(f"""
+            SELECT setval(pg_get_serial_sequence('{table}', 'id'),
+                          coalesce(max(id), 0) + 1, false)
+              FROM {table}
+        """)
+
+
+def load(directory, batch_size=BATCH_SIZE, use_copy=True, reset=True,
+         report=report_rate):
+    """Load the CSVs in `directory` (see module docstring).
+
+    With `reset`, the schema is dropped and recreated first.
+    """
+
+    engine = db.engine
+    postgres = engine.dialect.name == 'postgresql'
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    files = [(name, os.path.join(directory, f"{name}.csv")) for name in TABLES]
+    files = [(name, path) for name, path in files if os.path.exists(path)]
+    loaded = [name for name, _ in files]
+
+    with indexes_dropped(engine, [TimelineEntry.__tablename__], report):
+        with indexes_dropped(engine, loaded, report):
+            for name, path in files:
+                table = db.metadata.tables[name]
+
+                with open(path, newline='') as f:
+                    columns = next(csv.reader(f), [])
+
+                started = time.perf_counter()
+                with engine.begin() as connection:
+                    if postgres and use_copy and not python_defaults(table, columns):
+                        rows = copy_csv(connection, table, path)
+                    else:
+                        rows = insert_csv(connection, table, path, batch_size)
+                report(name, rows, time.perf_counter() - started)
+
+            if postgres:
+                with engine.begin() as connection:
+                    reset_sequences(connection, [name for name in loaded
+                                                 if 'id' in db.metadata.tables[name].c])
+
+        started = time.perf_counter()
+        TimelineEntry.rebuild()
+        db.session.commit()
+        report("timelines", TimelineEntry.query.count(),
+               time.perf_counter() - started)
+
+    started = time.perf_counter()
+    User.reconcile_counts()
+    db.session.commit()
+    report("user counters", User.query.count(), time.perf_counter() - started)
+
+    if postgres:
+        with engine.begin() as connection:
+            connection.execute(
+                f"ANALYZE {', '.join(loaded + [TimelineEntry.__tablename__])}")
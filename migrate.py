@@ -0,0 +1,103 @@
+"""Versioned schema migrations for Warbler.
+
+Migrations are plain (Postgres) SQL files in migrations/, named
+NNNN_description.sql and applied in version order. Each one is written to
+be safe on a database that `db.create_all()` already brought up to date,
+so a fresh database can be migrated too. Applied versions are recorded
+in the schema_migrations table.
+
+A migration runs in one transaction, unless it has the line
+
+    -- migrate: no-transaction
+
+in which case its statements (split at semicolons ending a line, so
+no DO blocks) run one by one in autocommit mode. That's what CREATE / DROP INDEX
+CONCURRENTLY need, so indexes on big tables can be built without
+locking out writes. Such a migration must be safe to rerun from the
+top if it stops partway; a failed concurrent build leaves an INVALID
+index behind, which has to be dropped by hand before rerunning.
+"""
+
+import os
+import re
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+
+MIGRATION_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+NO_TRANSACTION = re.compile(r'^--\s*migrate:\s*no-transaction\s*$', re.MULTILINE)
+
+
+def available_migrations():
+    """List (version, name, path) for every migration file, in order."""
+
+    migrations = []
+
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                               os.path.join(MIGRATIONS_DIR, filename)))
+
+    return sorted(migrations)
+
+
+def applied_versions(connection):
+    """Set of versions already applied (creating the tracking table)."""
+
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+    """)
+
+    return {version for (version,)
+            in connection.execute("SELECT version FROM schema_migrations")}
+
+
+def statements(sql):
+    """Split a migration's SQL into statements, at `;` ending a line."""
+
+    return [statement.strip() for statement in re.split(r';\s*$', sql, flags=re.MULTILINE)
+            if re.sub(r'--.*$', '', statement, flags=re.MULTILINE).strip()]
+
+
+def upgrade(engine):
+    """Apply every pending migration, each in its own transaction (or
+    statement by statement, if it asks for no transaction).
+
+    Returns the (version, name) pairs applied.
+    """
+
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    applied = []
+
+    for version, name, path in available_migrations():
+        if version in done:
+            continue
+
+        with open(path) as f:
+            sql = f.read()
+
+        if NO_TRANSACTION.search(sql):
+            with engine.connect() as connection:
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                for statement in statements(sql):
+                    connection.execute(statement)
+
+        with engine.begin() as connection:
+            if not NO_TRANSACTION.search(sql):
+                connection.execute(sql)
+            connection.execute(
+                "INSERT INTO schema_migrations (version, name) "
+                "VALUES (%(version)s, %(name)s)",
+                {'version': version, 'name': name})
+
+        applied.append((version, name))
+
+    return applied
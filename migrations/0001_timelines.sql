@@ -0,0 +1,17 @@
+-- Precomputed home timelines (fan-out-on-write); see TimelineEntry.
+-- Backfills from follows and messages, like `flask rebuild-timelines`.
+
+CREATE TABLE IF NOT EXISTS timelines (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (user_id, message_id)
+);
+
+INSERT INTO timelines (user_id, message_id, timestamp)
+SELECT user_id, id, timestamp FROM messages
+UNION
+SELECT follows.user_following_id, messages.id, messages.timestamp
+  FROM messages
+  JOIN follows ON follows.user_being_followed_id = messages.user_id
+ON CONFLICT DO NOTHING;
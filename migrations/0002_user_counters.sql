@@ -0,0 +1,18 @@
+-- Denormalized profile counters on users; see User.bump_counts.
+-- Fills them in like `flask reconcile-counters`.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users SET
+    messages_count = (SELECT count(*) FROM messages
+                       WHERE messages.user_id = users.id),
+    following_count = (SELECT count(*) FROM follows
+                        WHERE follows.user_following_id = users.id),
+    followers_count = (SELECT count(*) FROM follows
+                        WHERE follows.user_being_followed_id = users.id),
+    likes_count = (SELECT count(*) FROM likes
+                    WHERE likes.user_id = users.id);
@@ -0,0 +1,9 @@
+-- Indexes behind /users?q= search; see search.py.
+-- Built concurrently, so users stays writable meanwhile.
+-- migrate: no-transaction
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix
+    ON users (lower(username) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_bio_search
+    ON users USING gin (to_tsvector('simple', coalesce(bio, '')));
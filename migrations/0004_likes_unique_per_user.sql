@@ -0,0 +1,14 @@
+-- A message could only ever be liked by one user (message_id was unique
+-- on its own); make (user_id, message_id) the unique pair instead.
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                    WHERE conname = 'uq_likes_user_message') THEN
+        ALTER TABLE likes ADD CONSTRAINT uq_likes_user_message
+            UNIQUE (user_id, message_id);
+    END IF;
+END
+$$;
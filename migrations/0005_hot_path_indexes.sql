@@ -0,0 +1,24 @@
+-- Indexes for the hot read paths:
+--   profile / likes pages: a user's messages newest first
+--   following pages and follow checks: follows by follower
+--   home timeline: keyset pages on (timestamp, message_id)
+-- likes.user_id is covered by uq_likes_user_message (0004).
+--
+-- Built concurrently, so the tables stay writable meanwhile. The new
+-- timelines index is built before the old one is dropped, so home
+-- pages always have one to read.
+-- migrate: no-transaction
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_user_timestamp
+    ON messages (user_id, timestamp DESC, id DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_follows_following_followed
+    ON follows (user_following_id, user_being_followed_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_timelines_user_timestamp_new
+    ON timelines (user_id, timestamp DESC, message_id DESC);
+
+DROP INDEX CONCURRENTLY IF EXISTS ix_timelines_user_timestamp;
+
+ALTER INDEX IF EXISTS ix_timelines_user_timestamp_new
+    RENAME TO ix_timelines_user_timestamp;
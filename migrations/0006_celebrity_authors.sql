@@ -0,0 +1,6 @@
+-- Authors whose messages are merged into timelines when read rather
+-- than pushed to every follower; see timelines.HybridTimeline.
+-- Everyone starts out pushed; `flask reclassify-authors` sorts them.
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS celebrity BOOLEAN NOT NULL DEFAULT false;
@@ -0,0 +1,19 @@
+-- Background job queue for the side effects of writes; see jobs.py.
+
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    task TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    locked_at TIMESTAMP WITHOUT TIME ZONE,
+    locked_by TEXT,
+    finished_at TIMESTAMP WITHOUT TIME ZONE,
+    last_error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_queued
+    ON jobs (run_at, id) WHERE status = 'queued';
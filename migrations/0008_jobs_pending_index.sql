@@ -0,0 +1,6 @@
+-- Jobs that aren't done, for the queue stats on /metrics; see
+-- JobQueue.stats. Built concurrently, so jobs stays writable.
+-- migrate: no-transaction
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_jobs_pending
+    ON jobs (status) WHERE status <> 'done';
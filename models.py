@@ -2,10 +2,12 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
 
-bcrypt = Bcrypt()
+from passwords import PasswordHasher
+
+passwords = PasswordHasher()
 db = SQLAlchemy()
 
 
@@ -26,6 +28,42 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def is_following(cls, follower_id, followed_id):
+        """Does user `follower_id` follow user `followed_id`?
+
+        A single EXISTS on the primary key, rather than loading everyone
+        the follower follows.
+        """
+
+        follow = cls.query.filter_by(
+            user_being_followed_id=followed_id,
+            user_following_id=follower_id,
+        )
+        return db.session.query(follow.exists()).scalar()
+
+    @classmethod
+    def followed_among(cls, follower_id, user_ids):
+        """Which of `user_ids` does `follower_id` follow? Returns a set of ids.
+
+        Lets a page of user cards get its follow buttons in one query.
+        """
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == follower_id)
+                .filter(cls.user_being_followed_id.in_(user_ids)))
+        return {followed_id for (followed_id,) in rows}
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +83,90 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    # a user likes a message at most once (and many users can like it)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
+    )
+
+    # Delete the like if it's there, otherwise insert it -- unless it's the
+    # liker's own message -- and move the liker's likes_count to match, all
+    # in one statement. Returns +1 (liked), -1 (unliked) or 0 (nothing
+    # changed: own or missing message, or a concurrent click got there
+    # first; ON CONFLICT keeps that race from raising).
+    TOGGLE_SQL = db.text("""
+        WITH removed AS (
+            DELETE FROM likes
+             WHERE user_id = :user_id AND message_id = :message_id
+            RETURNING id
+        ), added AS (
+            INSERT INTO likes (user_id, message_id)
+            SELECT :user_id, id FROM messages
+             WHERE id = :message_id
+               AND user_id != :user_id
+               AND NOT EXISTS (SELECT 1 FROM removed)
+            ON CONFLICT (user_id, message_id) DO NOTHING
+            RETURNING id
+        ), change AS (
+            SELECT (SELECT count(*) FROM added)
+                 - (SELECT count(*) FROM removed) AS delta
+        ), bumped AS (
+            UPDATE users SET likes_count = likes_count + change.delta
+              FROM change
+             WHERE users.id = :user_id AND change.delta != 0
+        )
+        SELECT delta FROM change
+    """)
+
+    @classmethod
+    def liked_among(cls, user_id, message_ids):
+        """Which of `message_ids` does `user_id` like? Returns a set of ids.
+
+        Bounded by the page being shown, not by how much the user has
+        ever liked.
+        """
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user_id)
+                .filter(cls.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` for `user_id`, or unlike it if already liked.
+
+        Also keeps the user's likes_count in step. Returns +1 if the
+        message is now liked, -1 if unliked, 0 if nothing changed.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            return db.session.execute(cls.TOGGLE_SQL, {
+                'user_id': user_id,
+                'message_id': message_id,
+            }).scalar()
+
+        # portable (and racier) version for other databases
+        like = cls.query.filter_by(user_id=user_id, message_id=message_id).first()
+
+        if like:
+            db.session.delete(like)
+            delta = -1
+        elif Message.query.filter(Message.id == message_id,
+                                  Message.user_id != user_id).count():
+            db.session.add(cls(user_id=user_id, message_id=message_id))
+            delta = 1
+        else:
+            return 0
+
+        User.bump_counts(user_id, likes_count=delta)
+        return delta
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +213,45 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counts for the profile stats, kept up to date by the
+    # routes (see bump_counts) and recomputable with reconcile_counts
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # so many followers that their messages are merged into timelines
+    # when read instead of pushed to each follower (see timelines.py)
+    celebrity = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default='false',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,14 +279,87 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.is_following(self.id, other_user.id)
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` does this user follow? Returns a set of ids."""
+
+        return Follows.followed_among(self.id, user_ids)
+
+    @classmethod
+    def bump_counts(cls, user_id, **deltas):
+        """Add `deltas` to user `user_id`'s counters, in the database.
+
+        e.g. User.bump_counts(3, followers_count=1, likes_count=-1)
+        """
+
+        cls.query.filter_by(id=user_id).update({
+            getattr(cls, counter): getattr(cls, counter) + delta
+            for counter, delta in deltas.items()
+        })
+
+    def release_counts(self):
+        """Take this (about to be deleted) user out of everyone else's counts."""
+
+        (User.query
+         .filter(User.id.in_(db.session
+                             .query(Follows.user_being_followed_id)
+                             .filter(Follows.user_following_id == self.id)))
+         .update({User.followers_count: User.followers_count - 1},
+                 synchronize_session=False))
+
+        (User.query
+         .filter(User.id.in_(db.session
+                             .query(Follows.user_following_id)
+                             .filter(Follows.user_being_followed_id == self.id)))
+         .update({User.following_count: User.following_count - 1},
+                 synchronize_session=False))
+
+        likes_lost = (db.session
+                      .query(db.func.count(Likes.id))
+                      .join(Message, Message.id == Likes.message_id)
+                      .filter(Message.user_id == self.id)
+                      .filter(Likes.user_id == User.id)
+                      .as_scalar())
+
+        likers = (db.session
+                  .query(Likes.user_id)
+                  .join(Message, Message.id == Likes.message_id)
+                  .filter(Message.user_id == self.id))
+
+        (User.query
+         .filter(User.id.in_(likers))
+         .update({User.likes_count: User.likes_count - likes_lost},
+                 synchronize_session=False))
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute every user's (or just `user_ids`') counters from the
+        source tables."""
+
+        def count(column, match):
+            return (db.session
+                    .query(db.func.count(column))
+                    .filter(match == cls.id)
+                    .as_scalar())
+
+        users = cls.query
+        if user_ids is not None:
+            users = users.filter(cls.id.in_(user_ids))
+
+        users.update({
+            cls.messages_count: count(Message.id, Message.user_id),
+            cls.following_count: count(Follows.user_being_followed_id,
+                                       Follows.user_following_id),
+            cls.followers_count: count(Follows.user_following_id,
+                                       Follows.user_being_followed_id),
+            cls.likes_count: count(Likes.id, Likes.user_id),
+        }, synchronize_session=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url=None):
@@ -137,7 +368,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -149,6 +380,21 @@ class User(db.Model):
         db.session.add(user)
         return user
 
+    def check_password(self, password):
+        """Is `password` this user's password?
+
+        A password hashed at an old cost is rehashed at the current one
+        (the caller commits it).
+        """
+
+        if not passwords.check(self.password, password):
+            return False
+
+        if passwords.needs_rehash(self.password):
+            self.password = passwords.hash(password)
+
+        return True
+
     @classmethod
     def authenticate(cls, username, password):
         """Find user with `username` and `password`.
@@ -162,14 +408,22 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
 
+# Indexes behind user search (see search.py): username prefixes and bio
+# words can both be matched without scanning the users table.
+db.event.listen(User.__table__, 'after_create', db.DDL("""
+    CREATE INDEX IF NOT EXISTS ix_users_username_prefix
+        ON users (lower(username) text_pattern_ops);
+    CREATE INDEX IF NOT EXISTS ix_users_bio_search
+        ON users USING gin (to_tsvector('simple', coalesce(bio, '')));
+""").execute_if(dialect='postgresql'))
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -188,7 +442,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +453,261 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # profile and likes pages read a user's messages newest first,
+    # keyset-paged on (timestamp, id)
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp',
+                 user_id, timestamp.desc(), id.desc()),
+    )
+
+    def release_counts(self):
+        """Take this (about to be deleted) message out of its likers'
+        counts; their likes rows go with it by cascade.
+
+        Returns the likers' ids.
+        """
+
+        likers = [user_id for user_id, in (db.session
+                                           .query(Likes.user_id)
+                                           .filter(Likes.message_id == self.id))]
+
+        if likers:
+            (User.query
+             .filter(User.id.in_(likers))
+             .update({User.likes_count: User.likes_count - 1},
+                     synchronize_session=False))
+
+        return likers
+
+
+class TimelineEntry(db.Model):
+    """Precomputed home-timeline row: message `message_id` shows up for
+    `user_id`.
+
+    Rows are written when a message is posted (fan-out-on-write) and when
+    a follow is added, so the home page only does an indexed range read.
+    Celebrities' messages aren't pushed to followers under the hybrid
+    timeline engine (see timelines.py).
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_timestamp',
+                 user_id, timestamp.desc(), message_id.desc()),
+    )
+
+    @classmethod
+    def _insert(cls):
+        """An INSERT into timelines that skips rows already there.
+
+        Deliveries, follow backfills and demotions can race or be
+        retried, and each may find some of its rows already written.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            return postgresql.insert(cls.__table__).on_conflict_do_nothing()
+
+        return cls.__table__.insert().prefix_with('OR IGNORE', dialect='sqlite')
+
+    @classmethod
+    def fan_out(cls, message, to_followers=True):
+        """Push `message` into its author's timeline and (unless told not
+        to) every follower's."""
+
+        db.session.execute(cls._insert().values(
+            user_id=message.user_id,
+            message_id=message.id,
+            timestamp=message.timestamp,
+        ))
+
+        if to_followers:
+            cls.push_to_followers(message)
+
+    @classmethod
+    def push_to_followers(cls, message):
+        """Push `message` into every follower's timeline."""
+
+        db.session.execute(cls._insert().from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            db.select([
+                Follows.user_following_id,
+                db.literal(message.id),
+                db.literal(message.timestamp),
+            ])
+            .where(Follows.user_being_followed_id == message.user_id)
+            .where(Follows.user_following_id != message.user_id)))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Drop a deleted message from every timeline it was pushed to."""
+
+        cls.query.filter_by(message_id=message_id).delete(
+            synchronize_session=False)
+
+    @classmethod
+    def add_follow(cls, follower_id, followed_id):
+        """Backfill `follower_id`'s timeline with `followed_id`'s messages."""
+
+        db.session.execute(cls._insert().from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            db.select([
+                db.literal(follower_id),
+                Message.id,
+                Message.timestamp,
+            ])
+            .where(Message.user_id == followed_id)))
+
+    @classmethod
+    def remove_follow(cls, follower_id, followed_id):
+        """Take `followed_id`'s messages out of `follower_id`'s timeline."""
+
+        authored = (db.session
+                    .query(Message.id)
+                    .filter(Message.user_id == followed_id))
+
+        (cls.query
+         .filter(cls.user_id == follower_id)
+         .filter(cls.message_id.in_(authored))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def backfill_followers(cls, author_id):
+        """Push any of `author_id`'s messages their followers are missing."""
+
+        missing = (db.select([
+                       Follows.user_following_id,
+                       Message.id,
+                       Message.timestamp,
+                   ])
+                   .select_from(Message.__table__.join(
+                       Follows.__table__,
+                       Follows.user_being_followed_id == Message.user_id))
+                   .where(Message.user_id == author_id)
+                   .where(~db.exists()
+                          .where(cls.user_id == Follows.user_following_id)
+                          .where(cls.message_id == Message.id)))
+
+        db.session.execute(cls._insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], missing))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from the follows and messages tables."""
+
+        cls.query.delete(synchronize_session=False)
+
+        own = db.select([Message.user_id, Message.id, Message.timestamp])
+        followed = (db.select([
+                        Follows.user_following_id,
+                        Message.id,
+                        Message.timestamp,
+                    ])
+                    .select_from(Message.__table__.join(
+                        Follows.__table__,
+                        Follows.user_being_followed_id == Message.user_id)))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            db.union(own, followed)))
+
+
+class Job(db.Model):
+    """A queued side effect of a write, run by a worker (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    task = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # keyword arguments for the task, as JSON
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # a job enqueued again under the same key is dropped
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued -> running -> done, or back to queued to retry, or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+        server_default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # workers claim the oldest due queued jobs; stats count the jobs
+    # not done without reading the (many more) done ones
+    __table_args__ = (
+        db.Index('ix_jobs_queued', run_at, id,
+                 postgresql_where=db.text("status = 'queued'")),
+        db.Index('ix_jobs_pending', status,
+                 postgresql_where=db.text("status <> 'done'")),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +717,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    passwords.init_app(app)
@@ -0,0 +1,72 @@
+"""Keyset (cursor) pagination for Warbler message and user lists."""
+
+from datetime import datetime
+
+from models import db
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(message):
+    """Make a `?before=` cursor pointing just past `message`."""
+
+    return f"{message.timestamp.strftime(CURSOR_FORMAT)}-{message.id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (timestamp, id) pair.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    stamp, _, message_id = cursor.partition('-')
+    return datetime.strptime(stamp, CURSOR_FORMAT), int(message_id)
+
+
+def keyset_page(query, timestamp_col, id_col, before=None, per_page=20):
+    """Get one page of messages, newest first, and the cursor for the next.
+
+    Pages are keyed on (timestamp, id) rather than OFFSET, so the database
+    seeks straight to the cursor no matter how deep into history it is.
+    `timestamp_col`/`id_col` are the columns to order on; they must carry
+    the same values as each row's `.timestamp` and `.id`.
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+
+    if before:
+        timestamp, message_id = decode_cursor(before)
+        # a row comparison, not the equivalent OR: Postgres only seeks
+        # an index on (..., timestamp DESC, id DESC) with the former
+        query = query.filter(db.tuple_(timestamp_col, id_col)
+                             < db.tuple_(timestamp, message_id))
+
+    # grab one extra row so we know whether there's another page
+    messages = (query
+                .order_by(timestamp_col.desc(), id_col.desc())
+                .limit(per_page + 1)
+                .all())
+
+    if len(messages) <= per_page:
+        return messages, None
+
+    messages = messages[:per_page]
+    return messages, encode_cursor(messages[-1])
+
+
+def id_page(query, id_col, after=None, per_page=30):
+    """Get one page of rows in `id_col` order, starting after id `after`.
+
+    Returns (rows, next_after); next_after is None on the last page.
+    """
+
+    if after is not None:
+        query = query.filter(id_col > after)
+
+    rows = query.order_by(id_col).limit(per_page + 1).all()
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    return rows, rows[-1].id
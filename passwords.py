@@ -0,0 +1,135 @@
+"""Password hashing on a bounded pool of worker processes.
+
+A bcrypt hash or check takes a few hundred milliseconds of pure CPU at
+the default cost. Done inline, a burst of logins ties up every web
+worker; here at most PASSWORD_WORKERS run at once, in their own
+processes, and once PASSWORD_MAX_PENDING are queued further requests
+fail fast with PasswordHasherBusy instead of piling up.
+
+Configured from the Flask app (see PasswordHasher.init_app):
+
+    BCRYPT_LOG_ROUNDS       cost of new hashes (12)
+    PASSWORD_WORKERS        pool size; 0 hashes inline (cpu count)
+    PASSWORD_MAX_PENDING    hashes queued or running before we refuse
+                            (4 per worker)
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already queued; try again shortly."""
+
+
+def hash_password(password, rounds):
+    """bcrypt hash (as text) of `password` at cost `rounds`."""
+
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match bcrypt hash `hashed`?"""
+
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def hash_rounds(hashed):
+    """The cost factor a bcrypt hash was made with ("$2b$12$..." -> 12)."""
+
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Hash and check passwords on a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self.workers = os.cpu_count() or 1
+        self.max_pending = 4 * self.workers
+
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._counts = dict(hashed=0, checked=0, rejected=0)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.configure(
+            rounds=app.config.setdefault('BCRYPT_LOG_ROUNDS', self.rounds),
+            workers=app.config.setdefault('PASSWORD_WORKERS', self.workers),
+            max_pending=app.config.setdefault('PASSWORD_MAX_PENDING', None))
+
+    def configure(self, rounds=None, workers=None, max_pending=None):
+        """Change the cost or pool size (restarting the pool if need be)."""
+
+        if rounds is not None:
+            self.rounds = rounds
+
+        if workers is not None and workers != self.workers:
+            self.shutdown()
+            self.workers = workers
+
+        self.max_pending = max_pending or 4 * max(self.workers, 1)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                # spawned, not forked: the web process has threads and
+                # database connections the workers mustn't inherit
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            self._counts['rejected'] += 1
+            raise PasswordHasherBusy()
+
+        try:
+            return self._executor().submit(fn, *args).result()
+        finally:
+            slots.release()
+
+    def hash(self, password):
+        """A new hash of `password` at the configured cost."""
+
+        self._counts['hashed'] += 1
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        self._counts['checked'] += 1
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than we now use?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def stats(self):
+        return dict(self._counts, workers=self.workers,
+                    max_pending=self.max_pending, rounds=self.rounds)
+
+    def shutdown(self):
+        """Stop the worker processes (a new pool starts on next use)."""
+
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
@@ -0,0 +1,200 @@
+"""Sampling request profiler.
+
+Profiling is off unless a request asks for it with a signed header
+
+    X-Profile: <flask profile-token>
+
+or is picked at random (PROFILE_SAMPLE_RATE, a fraction of requests).
+While a profiled request runs, a background thread samples its stack
+every PROFILE_INTERVAL seconds; when it finishes, the samples are
+written to PROFILE_DIR in the collapsed-stack format
+
+    app.py:homepage;templating.py:render_template;... 12
+
+that flamegraph.pl or speedscope turn into a flame graph. Each profile
+also gets a line in PROFILE_DIR/index.jsonl, with how long the request
+spent in the before_request hooks, the view, Jinja rendering (part of
+the view's time) and the after_request hooks; the same timings go back
+in a Server-Timing header.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, request, template_rendered, before_render_template
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+HEADER = 'X-Profile'
+PHASES = ['before_request', 'view', 'render', 'after_request']
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks seen on thread `thread_id` every `interval` s."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class RequestProfile:
+    """A profiled request: its sampler and phase timings."""
+
+    def __init__(self, interval):
+        self.started = time.perf_counter()
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.rendering = 0
+        self.render_started = None
+        self.sampler = Sampler(threading.get_ident(), interval)
+        self.sampler.start()
+
+    def server_timing(self):
+        return ", ".join(f"{phase};dur={seconds * 1000:.1f}"
+                         for phase, seconds in self.timings.items())
+
+
+class Profiler:
+    """Profiles the requests that ask for it (see module docstring)."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+
+        # the phases are timed around Flask's own steps, so every hook
+        # (whenever it was registered) lands in the right one
+        self._wrap(app, 'preprocess_request', 'before_request', start=True)
+        self._wrap(app, 'dispatch_request', 'view')
+        self._wrap(app, 'process_response', 'after_request', finish=True)
+
+        template_rendered.connect(self._rendered, app)
+        before_render_template.connect(self._rendering, app)
+        app.teardown_request(self._teardown)
+
+    def _serializer(self):
+        return URLSafeTimedSerializer(self.app.config['SECRET_KEY'],
+                                      salt='profile')
+
+    def token(self):
+        """A value for the X-Profile header that turns profiling on."""
+
+        return self._serializer().dumps('profile')
+
+    def wanted(self):
+        """Should the current request be profiled?"""
+
+        token = request.headers.get(HEADER)
+        if token:
+            try:
+                self._serializer().loads(
+                    token, max_age=self.app.config['PROFILE_TOKEN_MAX_AGE'])
+                return True
+            except BadSignature:
+                pass
+
+        return random.random() < self.app.config['PROFILE_SAMPLE_RATE']
+
+    def _wrap(self, app, method, phase, start=False, finish=False):
+        original = getattr(app, method)
+
+        def timed(*args, **kwargs):
+            if start and self.wanted():
+                g.profile = RequestProfile(self.app.config['PROFILE_INTERVAL'])
+
+            profile = g.get('profile')
+            if profile is None:
+                return original(*args, **kwargs)
+
+            started = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            finally:
+                profile.timings[phase] += time.perf_counter() - started
+
+            if finish:
+                result.headers['Server-Timing'] = profile.server_timing()
+                self._finish()
+
+            return result
+
+        setattr(app, method, timed)
+
+    # templates render others (message cards), so only the outermost
+    # render is timed
+
+    def _rendering(self, app, template, context):
+        profile = g.get('profile')
+        if profile is not None:
+            if not profile.rendering:
+                profile.render_started = time.perf_counter()
+            profile.rendering += 1
+
+    def _rendered(self, app, template, context):
+        profile = g.get('profile')
+        if profile is not None and profile.rendering:
+            profile.rendering -= 1
+            if not profile.rendering:
+                profile.timings['render'] += time.perf_counter() - profile.render_started
+
+    def _teardown(self, error):
+        # a request whose after_request hooks failed still gets written
+        self._finish()
+
+    def _finish(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+
+        stacks = profile.sampler.stop()
+        total = time.perf_counter() - profile.started
+
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+
+        name = (f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-"
+                f"{request.endpoint or 'unknown'}.collapsed")
+        with open(os.path.join(directory, name), 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        record = dict(file=name, method=request.method, path=request.path,
+                      endpoint=request.endpoint, samples=sum(stacks.values()),
+                      total_ms=round(total * 1000, 2),
+                      **{f"{phase}_ms": round(seconds * 1000, 2)
+                         for phase, seconds in profile.timings.items()})
+        with open(os.path.join(directory, 'index.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + "\n")
@@ -0,0 +1,197 @@
+"""Per-endpoint SQL statistics.
+
+Every statement run while handling a request is timed (SQLAlchemy's
+before/after_cursor_execute events) and tallied against the request's
+endpoint: queries, database time, rows returned and the slowest
+statement seen. `QueryStats.metrics()` renders the totals in the
+Prometheus text format for /metrics. Only the slowest statement's time
+is exported; the statement itself is logged when it's first seen, as
+its text would make a new series every time it changed.
+
+Each request is also held to a query budget (QUERY_BUDGET, or a view's
+own from @query_budget); going over it is logged, or with
+QUERY_BUDGET_ACTION = 'raise', is an error, so tests catch new N+1s.
+
+Totals are per process, like the other in-process stats; a streamed
+response's queries after the view returns aren't counted.
+"""
+
+import re
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """A request ran more queries than its budget allows."""
+
+
+def query_budget(queries):
+    """Allow a view `queries` SQL statements per request."""
+
+    def decorate(view):
+        view.query_budget = queries
+        return view
+
+    return decorate
+
+
+class RequestQueries:
+    """Statements run so far by the current request."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.statements = []
+
+    def record(self, statement, seconds, rows):
+        self.count += 1
+        self.seconds += seconds
+        self.rows += max(rows, 0)
+        self.statements.append((seconds, statement))
+
+
+class EndpointStats:
+    """Running totals for one endpoint."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.most_queries = 0
+        self.over_budget = 0
+        self.slowest = (0.0, '')
+
+    def add(self, queries, over_budget):
+        """Count a request; True if it ran a new slowest statement."""
+
+        slowest = self.slowest
+        self.requests += 1
+        self.queries += queries.count
+        self.seconds += queries.seconds
+        self.rows += queries.rows
+        self.most_queries = max(self.most_queries, queries.count)
+        self.over_budget += over_budget
+        self.slowest = max([self.slowest] + queries.statements)
+
+        return self.slowest is not slowest
+
+
+class QueryStats:
+    """Times each request's SQL and keeps totals per endpoint."""
+
+    def __init__(self, app=None, engine=None):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+        if app is not None:
+            self.init_app(app, engine)
+
+    def init_app(self, app, engine):
+        self.app = app
+        app.config.setdefault('QUERY_BUDGET', None)
+        app.config.setdefault('QUERY_BUDGET_ACTION', 'log')
+
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+
+        if has_request_context() and 'queries' in g:
+            g.queries.record(statement, seconds, cursor.rowcount)
+
+    def _start_request(self):
+        g.queries = RequestQueries()
+
+    def _end_request(self, resp):
+        # popped, so a request failed by its budget isn't counted twice
+        # when the error response goes through here again
+        queries = g.pop('queries', None)
+        if queries is None:
+            return resp
+
+        endpoint = request.endpoint or 'unknown'
+        view = self.app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', self.app.config['QUERY_BUDGET'])
+        over_budget = budget is not None and queries.count > budget
+
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            slower = stats.add(queries, over_budget)
+            seconds, statement = stats.slowest
+
+        if slower:
+            self.app.logger.info("Slowest query yet for %s (%.6fs): %s", endpoint,
+                                 seconds, " ".join(statement.split()))
+
+        if over_budget:
+            message = (f"{request.method} {request.path} ({endpoint}) ran "
+                       f"{queries.count} queries; its budget is {budget}")
+
+            if self.app.config['QUERY_BUDGET_ACTION'] == 'raise':
+                raise QueryBudgetExceeded(message)
+
+            self.app.logger.warning("%s:\n%s", message, "\n".join(
+                statement for _, statement in queries.statements))
+
+        return resp
+
+    def clear(self):
+        with self._lock:
+            self.endpoints.clear()
+
+    def metrics(self):
+        """The totals in the Prometheus text exposition format."""
+
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+
+        lines = []
+
+        def family(name, kind, description, value):
+            lines.append(f"# HELP warbler_{name} {description}")
+            lines.append(f"# TYPE warbler_{name} {kind}")
+            for endpoint, stats in endpoints:
+                labels, number = value(endpoint, stats)
+                labels = ",".join(f'{key}="{escape(label)}"'
+                                  for key, label in labels.items())
+                lines.append(f"warbler_{name}{{{labels}}} {number}")
+
+        family('requests_total', 'counter', "Requests handled.",
+               lambda e, s: ({'endpoint': e}, s.requests))
+        family('db_queries_total', 'counter', "SQL statements run.",
+               lambda e, s: ({'endpoint': e}, s.queries))
+        family('db_seconds_total', 'counter', "Time spent running SQL.",
+               lambda e, s: ({'endpoint': e}, round(s.seconds, 6)))
+        family('db_rows_total', 'counter', "Rows returned or changed by SQL.",
+               lambda e, s: ({'endpoint': e}, s.rows))
+        family('db_queries_per_request_max', 'gauge',
+               "Most SQL statements run by one request.",
+               lambda e, s: ({'endpoint': e}, s.most_queries))
+        family('query_budget_exceeded_total', 'counter',
+               "Requests that ran more queries than their budget.",
+               lambda e, s: ({'endpoint': e}, s.over_budget))
+        family('db_slowest_query_seconds', 'gauge',
+               "How long the slowest SQL statement run took.",
+               lambda e, s: ({'endpoint': e}, round(s.slowest[0], 6)))
+
+        return "\n".join(lines) + "\n"
+
+
+def escape(label):
+    """A label value as Prometheus needs it: one line, escaped."""
+
+    label = re.sub(r'\s+', ' ', label).strip()
+    return label.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,130 @@
+"""Login throttling.
+
+Failed logins are counted per username and per client IP over a sliding
+window; once either passes its limit, further attempts are turned away
+before User.authenticate runs, so they cost neither a database lookup
+nor a bcrypt check.
+
+Each attempt is counted (with an atomic incr) before its password is
+checked, and refunded if it succeeds, so a burst of concurrent attempts
+can't all get past the limit before the first of them has failed.
+
+Counts live in a cache.Cache: the default in-process LRUCache limits
+each web process separately, a SocketCache (RATE_LIMIT_CACHE_URL =
+socket://...) shares one count between them.
+"""
+
+import threading
+import time
+
+
+class SlidingWindow:
+    """Approximate count of events per key over the last `window` seconds.
+
+    Events are counted in fixed buckets `window` long; the estimate is
+    the current bucket plus the part of the previous one still inside
+    the window. Two cache keys per counter, no per-event storage.
+    """
+
+    def __init__(self, cache, name, window):
+        self.cache = cache
+        self.name = name
+        self.window = window
+
+    def _key(self, key, bucket):
+        return f"ratelimit:{self.name}:{key}:{bucket}"
+
+    def hit(self, key, now=None):
+        """Count an event for `key`.
+
+        Returns (bucket, count including this event); the bucket is what
+        refund() needs.
+        """
+
+        bucket, into = divmod((time.time() if now is None else now) / self.window, 1)
+        bucket = int(bucket)
+
+        # an unreachable shared cache counts nothing rather than failing
+        current = self.cache.incr(self._key(key, bucket), ttl=2 * self.window) or 0
+        previous = self.cache.get(self._key(key, bucket - 1)) or 0
+
+        return bucket, previous * (1 - into) + current
+
+    def refund(self, key, bucket):
+        """Take back an event hit() counted in `bucket`."""
+
+        self.cache.incr(self._key(key, bucket), -1, ttl=2 * self.window)
+
+    def count(self, key, now=None):
+        """Events for `key` in the window ending `now`."""
+
+        bucket, into = divmod((time.time() if now is None else now) / self.window, 1)
+        current = self.cache.get(self._key(key, int(bucket))) or 0
+        previous = self.cache.get(self._key(key, int(bucket) - 1)) or 0
+
+        return previous * (1 - into) + current
+
+
+class LoginLimiter:
+    """Per-username and per-IP limits on failed logins."""
+
+    def __init__(self, cache, per_username=5, per_ip=20, window=300):
+        self.cache = cache
+        self.per_username = per_username
+        self.per_ip = per_ip
+        self.usernames = SlidingWindow(cache, 'login-username', window)
+        self.ips = SlidingWindow(cache, 'login-ip', window)
+
+        self._lock = threading.Lock()
+        self._counts = dict(allowed=0, throttled=0, failures=0)
+        self._check_seconds = 0.0
+
+    def attempt(self, username, ip):
+        """Reserve a login attempt, counted as failed until refund()ed.
+
+        Returns the reservation, or None if this name or address is over
+        its limit (in which case nothing stays counted).
+        """
+
+        username = username.lower()
+        user_bucket, by_username = self.usernames.hit(username)
+        ip_bucket, by_ip = self.ips.hit(ip)
+        reservation = [(self.usernames, username, user_bucket),
+                       (self.ips, ip, ip_bucket)]
+
+        throttled = by_username > self.per_username or by_ip > self.per_ip
+        if throttled:
+            self.refund(reservation)
+
+        with self._lock:
+            self._counts['throttled' if throttled else 'allowed'] += 1
+
+        return None if throttled else reservation
+
+    def refund(self, reservation):
+        """Uncount a reserved attempt (it succeeded, or never got checked)."""
+
+        for window, key, bucket in reservation:
+            window.refund(key, bucket)
+
+    def failed(self, seconds):
+        """Record how long checking a failed attempt took."""
+
+        with self._lock:
+            self._counts['failures'] += 1
+            self._check_seconds += seconds
+
+    def stats(self):
+        """Counters, plus the checking time throttling saved.
+
+        That's every throttled attempt at the average cost of a failed
+        check (lookup and bcrypt) so far.
+        """
+
+        with self._lock:
+            failures = self._counts['failures']
+            average = self._check_seconds / failures if failures else 0.0
+
+            return dict(self._counts,
+                        average_check_seconds=round(average, 4),
+                        check_seconds_saved=round(average * self._counts['throttled'], 3))
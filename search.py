@@ -0,0 +1,175 @@
+"""User search backends for the `/users?q=` directory."""
+
+import re
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+from models import db, User
+
+# Exact username hits beat username prefixes, which beat bio matches.
+EXACT, PREFIX, BIO = 3, 2, 1
+
+
+def search_words(q):
+    """Lowercased words of a search string, punctuation dropped."""
+
+    return re.findall(r'\w+', q.lower())
+
+
+class PostgresUserSearch:
+    """Search backed by the Postgres indexes made in models.py.
+
+    Usernames match on prefix through the `lower(username)
+    text_pattern_ops` index; bios match word prefixes through the
+    full-text GIN index. Neither needs a scan of `users`.
+
+    Only up to `limit` candidates are taken from each index before
+    ranking, so a short, common prefix doesn't rank every user it
+    matches. Username candidates are the first in the index's order;
+    bio candidates are whichever the index finds first.
+    """
+
+    def search(self, q, limit):
+        """Up to `limit` users matching `q`, best matches first."""
+
+        words = search_words(q)
+        if not words:
+            return []
+
+        username = db.func.lower(User.username)
+        bio = db.func.to_tsvector('simple', db.func.coalesce(User.bio, ''))
+        bio_query = db.func.to_tsquery(
+            'simple', ' & '.join(f"{word}:*" for word in words))
+
+        term = q.strip().lower()
+        prefix = term.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_') + '%'
+
+        rank = db.case(
+            [(username == term, EXACT),
+             (username.like(prefix, escape='\\'), PREFIX)],
+            else_=db.func.ts_rank(bio, bio_query),
+        )
+
+        # read in index order, so the scan stops after `limit` rows
+        by_username = (db.session
+                       .query(User.id)
+                       .filter(username.like(prefix, escape='\\'))
+                       .order_by(db.text("lower(users.username) USING ~<~"))
+                       .limit(limit)
+                       .subquery())
+        by_bio = (db.session
+                  .query(User.id)
+                  .filter(bio.op('@@')(bio_query))
+                  .limit(limit)
+                  .subquery())
+        candidates = db.union(db.select([by_username.c.id]),
+                              db.select([by_bio.c.id]))
+
+        return (User.query
+                .filter(User.id.in_(candidates))
+                .order_by(rank.desc(), User.username)
+                .limit(limit)
+                .all())
+
+
+class PrefixIndex:
+    """In-memory sorted index of username and bio words, for prefix lookup.
+
+    Built from (id, username, bio) rows; lookups bisect into the sorted
+    word list, so they don't touch the database at all.
+    """
+
+    def __init__(self, rows):
+        entries = []
+
+        for user_id, username, bio in rows:
+            entries.append((username.lower(), user_id, True))
+            for word in search_words(bio or ''):
+                entries.append((word, user_id, False))
+
+        entries.sort()
+        self._words = [word for word, _, _ in entries]
+        self._entries = entries
+
+    def _matches(self, prefix):
+        """Yield (word, user_id, is_username) for words starting `prefix`."""
+
+        i = bisect_left(self._words, prefix)
+        while i < len(self._words) and self._words[i].startswith(prefix):
+            yield self._entries[i]
+            i += 1
+
+    def search(self, q, limit):
+        """Up to `limit` (user_id, rank) pairs matching `q`, best first."""
+
+        words = search_words(q)
+        term = q.strip().lower()
+        ranks = {}
+
+        if term:
+            for word, user_id, is_username in self._matches(term):
+                if is_username:
+                    ranks[user_id] = EXACT if word == term else PREFIX
+
+        # every word has to hit the bio for a bio match
+        bio_ids = None
+        for word in words:
+            hits = {user_id for _, user_id, is_username in self._matches(word)
+                    if not is_username}
+            bio_ids = hits if bio_ids is None else bio_ids & hits
+
+        for user_id in bio_ids or ():
+            ranks.setdefault(user_id, BIO)
+
+        ranked = sorted(ranks.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit]
+
+
+class PrefixIndexUserSearch:
+    """Search over an in-memory PrefixIndex (for SQLite, e.g. in tests).
+
+    The index is rebuilt lazily after any user is inserted, updated or
+    deleted through the ORM.
+    """
+
+    def __init__(self):
+        self._index = None
+
+        for change in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(User, change, self._invalidate)
+
+    def _invalidate(self, mapper, connection, target):
+        self._index = None
+
+    def search(self, q, limit):
+        """Up to `limit` users matching `q`, best matches first."""
+
+        if self._index is None:
+            self._index = PrefixIndex(
+                db.session.query(User.id, User.username, User.bio))
+
+        ranked = self._index.search(q, limit)
+        if not ranked:
+            return []
+
+        users = {user.id: user
+                 for user in User.query.filter(User.id.in_(
+                     [user_id for user_id, _ in ranked]))}
+        return [users[user_id] for user_id, _ in ranked if user_id in users]
+
+
+BACKENDS = {
+    'postgresql': PostgresUserSearch,
+    'prefix': PrefixIndexUserSearch,
+}
+
+
+def make_user_search(name):
+    """Make the search backend called `name`.
+
+    `name` is a key of BACKENDS or a database dialect name; anything but
+    Postgres (e.g. SQLite) gets the in-memory prefix index.
+    """
+
+    return BACKENDS.get(name, PrefixIndexUserSearch)()
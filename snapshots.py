@@ -0,0 +1,68 @@
+"""Plain, cacheable copies of the rows Warbler pages render.
+
+Cached pages hold dicts (so any cache backend can store them); these
+helpers turn rows into those dicts and back into objects the templates
+can use like the originals.
+"""
+
+from datetime import datetime
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+class Snapshot:
+    """Attribute access over a snapshot's fields."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"<Snapshot {self.__dict__}>"
+
+
+def snapshot_user(user):
+    """The directory-card fields of `user`, as a dict."""
+
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def restore_user(data):
+    """A user-like object from snapshot_user()'s dict."""
+
+    return Snapshot(**data)
+
+
+def snapshot_message(msg, with_author=True):
+    """`msg` as a dict; with its author's card fields unless told not to."""
+
+    data = {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.strftime(TIMESTAMP_FORMAT),
+        'user_id': msg.user_id,
+    }
+
+    if with_author:
+        data['user'] = {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        }
+
+    return data
+
+
+def restore_message(data, author=None):
+    """A message-like object from snapshot_message()'s dict.
+
+    Pass `author` when the snapshot was taken without one (e.g. every
+    message on a profile page has the same, already-loaded author).
+    """
+
+    fields = dict(data)
+    fields['timestamp'] = datetime.strptime(data['timestamp'], TIMESTAMP_FORMAT)
+    fields['user'] = author if author is not None else Snapshot(**data['user'])
+
+    return Snapshot(**fields)
@@ -0,0 +1,150 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+# Are built files named by their content, and stylesheets pointed at them?
+# Are text assets pre-compressed, and served that way when accepted?
+# Are hero images resized (never up) with WebP copies?
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipUnless
+
+import assets
+from assets import Manifest, build
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, static_assets, static_url
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+CSS = b"""
+body { background: url("/static/images/bg.png"); }
+.hero { background-image: url(/static/images/warbler-hero.jpg); }
+""" + b".padding { margin: 0; }\n" * 50
+
+
+def image(width, height, format):
+    """Bytes of a blank `width` x `height` image."""
+
+    out = io.BytesIO()
+    assets.Image.new('RGB', (width, height), 'teal').save(out, format)
+    return out.getvalue()
+
+
+class AssetBuildTestCase(TestCase):
+    """Build a small static/ into a temporary directory."""
+
+    def setUp(self):
+        self.static = tempfile.mkdtemp()
+
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+
+        with open(os.path.join(self.static, 'stylesheets', 'style.css'), 'wb') as f:
+            f.write(CSS)
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b"not really a png")
+
+    def tearDown(self):
+        shutil.rmtree(self.static)
+
+    def read(self, path):
+        with open(os.path.join(self.static, path), 'rb') as f:
+            return f.read()
+
+    def test_fingerprints(self):
+        """Are files hashed by content, and stylesheet urls rewritten?"""
+
+        manifest = build(self.static)
+
+        bg = manifest['files']['images/bg.png']
+        self.assertRegex(bg, r'^dist/images/bg\.[0-9a-f]{12}\.png$')
+
+        css = self.read(manifest['files']['stylesheets/style.css'])
+        self.assertIn(f'url("/static/{bg}")'.encode(), css)
+        # not a static file we have, so left alone
+        self.assertIn(b"url(/static/images/warbler-hero.jpg)", css)
+
+        # rebuilding the same content gives the same names
+        self.assertEqual(build(self.static)['files'], manifest['files'])
+
+        loaded = Manifest(self.static)
+        self.assertEqual(loaded.url('images/bg.png'), f"/static/{bg}")
+        self.assertIsNone(loaded.url('images/nope.png'))
+        self.assertEqual(Manifest(tempfile.gettempdir() + '/no-such-dir').files, {})
+
+    def test_compressed(self):
+        """Are text assets pre-compressed (and images not)?"""
+
+        manifest = build(self.static)
+        css = manifest['files']['stylesheets/style.css']
+
+        self.assertIn('gzip', manifest['encodings'][css])
+        self.assertEqual(gzip.decompress(self.read(css + '.gz')), self.read(css))
+        self.assertNotIn(manifest['files']['images/bg.png'], manifest['encodings'])
+
+    def test_served_compressed(self):
+        """Does the static route send the gzip copy to browsers that take it?"""
+
+        manifest = build(self.static)
+        css = manifest['files']['stylesheets/style.css']
+
+        static_folder = app.static_folder
+        app.static_folder = static_assets.static_dir = self.static
+        static_assets.reload()
+
+        try:
+            with app.test_client() as client:
+                resp = client.get(f'/static/{css}', headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(resp.mimetype, 'text/css')
+                self.assertIn('immutable', resp.headers['Cache-Control'])
+                self.assertEqual(gzip.decompress(resp.get_data()), self.read(css))
+                resp.close()
+
+                resp = client.get(f'/static/{css}')
+                self.assertNotIn('Content-Encoding', resp.headers)
+                self.assertIn('Accept-Encoding', resp.headers['Vary'])
+                resp.close()
+
+            with app.test_request_context():
+                self.assertEqual(static_url('stylesheets/style.css'), f'/static/{css}')
+        finally:
+            app.static_folder = static_assets.static_dir = static_folder
+            static_assets.reload()
+
+    @skipUnless(assets.Image, "needs Pillow")
+    def test_hero_variants(self):
+        """Are hero images resized, never up, with WebP copies?"""
+
+        with open(os.path.join(self.static, 'images', 'warbler-hero.jpg'), 'wb') as f:
+            f.write(image(1000, 500, 'JPEG'))
+
+        manifest = build(self.static, hero_widths=(640, 1280))
+        variants = manifest['variants']['images/warbler-hero.jpg']
+
+        self.assertEqual(sorted(variants, key=int), ['640', '1000'])
+        self.assertEqual(assets.image_width(self.read(variants['640']['webp'])), 640)
+        self.assertEqual(manifest['files']['images/warbler-hero.jpg'],
+                         variants['1000']['jpeg'])
+
+        loaded = Manifest(self.static)
+        self.assertEqual(loaded.hero('/static/images/warbler-hero.jpg', 300),
+                         {'src': f"/static/{variants['640']['jpeg']}",
+                          'webp': f"/static/{variants['640']['webp']}"})
+        self.assertEqual(loaded.hero('/static/images/warbler-hero.jpg', 5000)['src'],
+                         f"/static/{variants['1000']['jpeg']}")
+        self.assertEqual(loaded.hero('http://example.com/me.jpg', 640),
+                         {'src': 'http://example.com/me.jpg', 'webp': None})
@@ -0,0 +1,166 @@
+"""Page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+# Does the LRU evict the least recently used entry, and expire by TTL?
+# Does bumping a namespace's generation invalidate its keys?
+# Does a SocketCache share a server's cache, and miss when it's gone?
+# Is a backend missing part of the interface refused when it's made?
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cache import Cache, LRUCache, SocketCache, make_cache, make_cache_server
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process backend."""
+
+    def test_eviction(self):
+        """Is the least recently used entry evicted first?"""
+
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 2)
+
+    def test_ttl(self):
+        """Do entries expire after their TTL?"""
+
+        cache = LRUCache(default_ttl=0.05)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+
+        time.sleep(0.1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_incr(self):
+        """Does incr count up from 0, keeping the first TTL?"""
+
+        cache = LRUCache()
+        self.assertEqual(cache.incr('n', ttl=0.05), 1)
+        self.assertEqual(cache.incr('n', 2, ttl=60), 3)
+
+        time.sleep(0.1)
+        self.assertEqual(cache.incr('n'), 1)
+
+    def test_generations(self):
+        """Does bump() invalidate every key in a namespace, and only it?"""
+
+        cache = LRUCache()
+        cache.set(cache.key('timeline:1', 'p1'), 'old')
+        cache.set(cache.key('timeline:2', 'p1'), 'other')
+
+        cache.bump('timeline:1')
+
+        self.assertIsNone(cache.get(cache.key('timeline:1', 'p1')))
+        self.assertEqual(cache.get(cache.key('timeline:2', 'p1')), 'other')
+
+        calls = []
+        compute = lambda: calls.append(1) or 'new'
+        self.assertEqual(cache.get_or_set(cache.key('timeline:1', 'p1'), compute), 'new')
+        self.assertEqual(cache.get_or_set(cache.key('timeline:1', 'p1'), compute), 'new')
+        self.assertEqual(len(calls), 1)
+
+    def test_get_many(self):
+        """Does get_many return just the cached keys?"""
+
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', [2])
+
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': [2]})
+
+    def test_incomplete_backend(self):
+        """Can't a backend without incr() be made?"""
+
+        class NoIncr(Cache):
+            def get(self, key):
+                return None
+
+            def set(self, key, value, ttl=None):
+                pass
+
+            def delete(self, key):
+                pass
+
+            def stats(self):
+                return {}
+
+        with self.assertRaises(TypeError):
+            NoIncr()
+
+    def test_make_cache(self):
+        """Does the URL pick the backend (and say if it's shared)?"""
+
+        self.assertIsInstance(make_cache('memory://'), LRUCache)
+        self.assertIsInstance(make_cache('socket:///tmp/x'), SocketCache)
+        self.assertFalse(make_cache('memory://').shared)
+        self.assertTrue(make_cache('socket:///tmp/x').shared)
+
+
+class SocketCacheTestCase(TestCase):
+    """Test the shared backend against a server on a temporary socket."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.url = f"socket://{os.path.join(self.tmp.name, 'cache.sock')}"
+
+        self.server = make_cache_server(self.url, LRUCache(max_size=10))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def test_shared(self):
+        """Do two clients see each other's writes?"""
+
+        one, two = SocketCache(self.url), SocketCache(self.url)
+
+        one.set('page', {'messages': [1, 2, 3]})
+        self.assertEqual(two.get('page'), {'messages': [1, 2, 3]})
+
+        self.assertEqual(one.incr('n'), 1)
+        self.assertEqual(two.incr('n'), 2)
+
+        self.assertEqual(two.get_many(['page', 'n', 'missing']),
+                         {'page': {'messages': [1, 2, 3]}, 'n': 2})
+
+        two.delete('page')
+        self.assertIsNone(one.get('page'))
+
+        stats = one.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+        self.assertEqual(stats['server']['hits'], 3)
+
+    def test_server_gone(self):
+        """Does a client without a server just miss?"""
+
+        cache = SocketCache(f"socket://{os.path.join(self.tmp.name, 'none.sock')}")
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_or_set('a', lambda: 2), 2)
+        self.assertEqual(cache.get_many(['a', 'b']), {})
+        self.assertGreater(cache.stats()['errors'], 0)
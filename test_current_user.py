@@ -0,0 +1,132 @@
+"""Current user (g.user) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_current_user.py
+
+# Does CurrentUser.load pick up the user's columns?
+# Do the lazy follow / like id sets come back right?
+# Does the cache serve a hot user without reloading, and forget() reload it?
+# Does it stay bounded, dropping the least recently seen users?
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from current_user import CurrentUser, CurrentUserCache
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class CurrentUserTestCase(TestCase):
+    """Test CurrentUser and CurrentUserCache."""
+
+    def setUp(self):
+        """Create two users, u1 following u2 and liking u2's message."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="u1@test.com", username="u1", password="HASHED_PASSWORD")
+        self.u2 = User(email="u2@test.com", username="u2", password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.m = Message(text="Hello", user_id=self.u2.id)
+        db.session.add(self.m)
+        db.session.add(Follows(user_being_followed_id=self.u2.id,
+                               user_following_id=self.u1.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.u1.id, message_id=self.m.id))
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback on exit"""
+
+        db.session.rollback()
+
+    def test_load(self):
+        """Does load() pick up the user's columns, and None for no user?"""
+
+        current = CurrentUser.load(self.u1.id)
+
+        self.assertEqual(current.id, self.u1.id)
+        self.assertEqual(current.username, "u1")
+        self.assertEqual(current.image_url, "/static/images/default-pic.png")
+        self.assertFalse(hasattr(current, 'password'))
+
+        self.assertIsNone(CurrentUser.load(self.u2.id + 1))
+
+    def test_follow_and_like_sets(self):
+        """Do the lazy id sets and follow checks agree with the tables?"""
+
+        current = CurrentUser.load(self.u1.id)
+
+        self.assertTrue(current.is_following(self.u2))
+        self.assertEqual(current.following_among([self.u1.id, self.u2.id]), {self.u2.id})
+
+        self.assertEqual(current.liked_among([self.m.id, self.m.id + 1]), {self.m.id})
+
+        self.assertEqual(current.following_ids, {self.u2.id})
+        self.assertEqual(current.liked_ids, {self.m.id})
+
+        # once loaded, the set answers follow checks itself
+        self.assertTrue(current.is_following(self.u2))
+        self.assertFalse(current.is_following(self.u1))
+        self.assertEqual(current.liked_among([self.m.id + 1]), set())
+
+    def test_cache(self):
+        """Does the cache hold a user until forgotten?"""
+
+        cache = CurrentUserCache(ttl=60)
+        self.assertEqual(cache.get(self.u1.id).username, "u1")
+
+        self.u1.username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(cache.get(self.u1.id).username, "u1")
+
+        cache.forget(self.u1.id)
+        self.assertEqual(cache.get(self.u1.id).username, "renamed")
+
+    def test_cache_bounded(self):
+        """Does a full cache drop its least recently seen user?"""
+
+        cache = CurrentUserCache(ttl=60, max_size=1)
+        cache.get(self.u1.id)
+        cache.get(self.u2.id)
+
+        self.u1.username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(cache.get(self.u1.id).username, "renamed")
+        self.assertEqual(cache._entries.stats()['size'], 1)
+
+    def test_cache_disabled(self):
+        """Does a ttl of 0 always reload?"""
+
+        cache = CurrentUserCache(ttl=0)
+        cache.get(self.u1.id)
+
+        self.u1.username = "renamed"
+        db.session.commit()
+
+        self.assertEqual(cache.get(self.u1.id).username, "renamed")
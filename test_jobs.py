@@ -0,0 +1,216 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+# Does posting a message leave its delivery to a job, done by a worker?
+# Is a job enqueued twice under the same idempotency key only run once?
+# Does delivery skip followers a follow's backfill already reached?
+# Is a failing job retried with a backoff, then marked failed?
+# Is a job whose worker died requeued?
+# Are old done jobs pruned even while the queue is busy?
+# Does JOBS_EAGER run a request's jobs before it returns?
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, jobs, page_cache, CURR_USER_KEY
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+calls = []
+
+
+@jobs.task('test_flaky')
+def flaky(fail_times):
+    """Fails its first `fail_times` runs."""
+
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError("not yet")
+
+
+class JobQueueTestCase(TestCase):
+    """Test the job queue."""
+
+    def setUp(self):
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        page_cache.clear()
+        calls.clear()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.author.id,
+                               user_following_id=self.reader.id))
+        db.session.commit()
+
+        # requests end the session, detaching these
+        self.author_id, self.reader_id = self.author.id, self.reader.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['JOBS_EAGER'] = False
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def done(self):
+        return Job.query.filter_by(status='done').count()
+
+    def timeline(self, user_id):
+        return [entry.message_id for entry in
+                TimelineEntry.query.filter_by(user_id=user_id)]
+
+    def test_deliver_message(self):
+        """Does a worker push a posted message to followers, once?"""
+
+        self.login(self.author_id)
+        resp = self.client.post("/messages/new", data={"text": "Hello"})
+        self.assertEqual(resp.status_code, 302)
+
+        msg = Message.query.one()
+        self.assertEqual(self.timeline(self.author_id), [msg.id])
+        self.assertEqual(self.timeline(self.reader_id), [])
+        self.assertEqual(jobs.stats()['queued'], 1)
+
+        # the same key again is a no-op
+        self.assertIsNone(jobs.enqueue('deliver_message',
+                                       key=f"deliver_message:{msg.id}",
+                                       message_id=msg.id))
+        db.session.commit()
+
+        jobs.work(once=True)
+        self.assertEqual(self.timeline(self.reader_id), [msg.id])
+
+        self.assertEqual((jobs.stats()['queued'], self.done()), (0, 1))
+        self.assertIn('warbler_jobs{status="queued"} 0', jobs.metrics())
+        self.assertNotIn('status="done"', jobs.metrics())
+
+    def test_follow_then_post(self):
+        """Does delivery cope with a follow's backfill getting there first?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        other_id = other.id
+
+        self.login(other_id)
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "Hello"})
+        msg_id = Message.query.one().id
+
+        # apply_follow backfills the message before deliver_message runs
+        jobs.work(once=True)
+
+        self.assertEqual(
+            sorted(entry.user_id for entry in
+                   TimelineEntry.query.filter_by(message_id=msg_id)),
+            sorted([self.author_id, self.reader_id, other_id]))
+
+        self.assertEqual((self.done(), jobs.stats()['failed']), (2, 0))
+
+    def test_retries(self):
+        """Is a failing job retried after a backoff, then given up on?"""
+
+        job_id = jobs.enqueue('test_flaky', fail_times=1)
+        db.session.commit()
+
+        jobs.work(once=True)
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn("not yet", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertEqual(jobs.stats()['retrying'], 1)
+
+        # not due yet
+        self.assertEqual(jobs.claim('test'), [])
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        jobs.work(once=True)
+        self.assertEqual(Job.query.get(job_id).status, 'done')
+
+        job_id = jobs.enqueue('test_flaky', fail_times=99)
+        db.session.commit()
+        for _ in range(app.config['JOB_MAX_ATTEMPTS']):
+            Job.query.filter_by(id=job_id).update({Job.run_at: datetime.utcnow()})
+            db.session.commit()
+            jobs.work(once=True)
+
+        self.assertEqual(Job.query.get(job_id).status, 'failed')
+
+    def test_stale(self):
+        """Is a job whose worker stopped answering run again?"""
+
+        job_id = jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+        self.assertEqual(jobs.claim('dead-worker'), [job_id])
+
+        jobs.work(once=True)
+        self.assertEqual(calls, [])
+
+        Job.query.filter_by(id=job_id).update({
+            Job.locked_at: datetime.utcnow() - timedelta(
+                seconds=app.config['JOB_TIMEOUT'] + 1)})
+        db.session.commit()
+
+        jobs.work(once=True)
+        job = Job.query.get(job_id)
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+    def test_prune(self):
+        """Are old done jobs deleted by a worker with jobs to run?"""
+
+        old = jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+        jobs.work(once=True)
+        Job.query.filter_by(id=old).update({
+            Job.finished_at: datetime.utcnow() - timedelta(
+                seconds=app.config['JOB_KEEP_DONE'] + 1)})
+
+        new = jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+
+        jobs._last_prune = 0.0
+        jobs.work(once=True)
+
+        self.assertIsNone(Job.query.get(old))
+        self.assertEqual(Job.query.get(new).status, 'done')
+
+    def test_eager(self):
+        """With JOBS_EAGER, does a follow's backfill happen in the request?"""
+
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="Hi", user_id=other.id)
+        db.session.add(msg)
+        db.session.commit()
+        other_id, msg_id = other.id, msg.id
+
+        app.config['JOBS_EAGER'] = True
+        self.login(self.reader_id)
+        self.client.post(f"/users/follow/{other_id}")
+
+        self.assertEqual(self.timeline(self.reader_id), [msg_id])
+        self.assertEqual(self.done(), 1)
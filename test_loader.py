@@ -0,0 +1,138 @@
+"""CSV loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+# Does a load (by COPY, or in batches) fill every table and the derived
+# timelines and counters?
+# Are the dropped indexes all rebuilt, and the id sequences moved on?
+# Are CSV fields converted to the columns' types for other databases?
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from loader import load, insert_csv, secondary_indexes
+
+db.create_all()
+
+FILES = {
+    'users.csv': """email,username,image_url,password,bio,header_image_url,location
+u1@test.com,u1,/static/images/default-pic.png,HASHED_PASSWORD,,/static/images/warbler-hero.jpg,
+u2@test.com,u2,/static/images/default-pic.png,HASHED_PASSWORD,Hi there,/static/images/warbler-hero.jpg,Nowhere
+u3@test.com,u3,/static/images/default-pic.png,HASHED_PASSWORD,,/static/images/warbler-hero.jpg,
+""",
+    'messages.csv': """text,timestamp,user_id
+"one, with a comma",2017-01-21 11:04:53.522807,1
+two,2017-02-21 11:04:53,2
+three,2017-03-21 11:04:53,2
+""",
+    'follows.csv': """user_being_followed_id,user_following_id
+2,1
+1,3
+""",
+    'likes.csv': """user_id,message_id
+1,2
+1,3
+3,1
+""",
+}
+
+
+class LoaderTestCase(TestCase):
+    """Load a tiny dataset into the test database."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        for name, content in FILES.items():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.directory)
+
+    def check_loaded(self):
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 2)
+        self.assertEqual(Likes.query.count(), 3)
+
+        u1, u2 = User.query.get(1), User.query.get(2)
+        self.assertIsNone(u1.bio)
+        self.assertEqual(u2.bio, "Hi there")
+        self.assertEqual(Message.query.get(1).text, "one, with a comma")
+
+        # u1 sees their own message and u2's two
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 3)
+        self.assertEqual((u1.following_count, u1.likes_count), (1, 2))
+        self.assertEqual((u2.messages_count, u2.followers_count), (2, 1))
+
+        # the sequences carry on after the loaded ids
+        u4 = User.signup(username="u4", email="u4@test.com", password="password")
+        db.session.commit()
+        self.assertEqual(u4.id, 4)
+
+    def test_copy(self):
+        """Does a COPY load fill everything, and put the indexes back?"""
+
+        with db.engine.connect() as connection:
+            before = secondary_indexes(connection, ['users', 'messages', 'follows',
+                                                    'likes', 'timelines'])
+        self.assertTrue(before)
+
+        steps = []
+        load(self.directory, report=lambda step, rows, seconds: steps.append((step, rows)))
+
+        self.assertIn(('messages', 3), steps)
+        self.assertIn(('likes', 3), steps)
+        self.check_loaded()
+
+        with db.engine.connect() as connection:
+            after = secondary_indexes(connection, ['users', 'messages', 'follows',
+                                                   'likes', 'timelines'])
+        self.assertEqual(sorted(before), sorted(after))
+
+    def test_batches(self):
+        """Does a batched load (here, 2 rows at a time) do the same?"""
+
+        steps = []
+        load(self.directory, batch_size=2, use_copy=False,
+             report=lambda step, rows, seconds: steps.append((step, rows)))
+
+        self.assertIn(('users', 3), steps)
+        self.check_loaded()
+
+    def test_batches_sqlite(self):
+        """Do batches load into SQLite, which only takes real datetimes?"""
+
+        engine = create_engine('sqlite://')
+        tables = db.metadata.tables
+        db.metadata.create_all(engine, tables=[tables['users'], tables['messages']])
+
+        with engine.begin() as connection:
+            for name in ['users', 'messages']:
+                insert_csv(connection, tables[name],
+                           os.path.join(self.directory, f"{name}.csv"), batch_size=2)
+
+            text, timestamp = connection.execute(
+                "SELECT text, timestamp FROM messages ORDER BY id").first()
+
+        self.assertEqual(text, "one, with a comma")
+        self.assertEqual(timestamp, str(datetime(2017, 1, 21, 11, 4, 53, 522807)))
@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from flask import template_rendered
+
+from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, page_cache, current_users
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -42,6 +44,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        page_cache.clear()
 
         self.client = app.test_client()
 
@@ -89,6 +92,35 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
 
 
+    def test_show_message_not_modified(self):
+        """Is an unchanged message page a 304, until the viewer follows?"""
+
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, testuser_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other.id
+
+            resp = c.get(f'/messages/{msg_id}')
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.get(f'/messages/{msg_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            c.post(f'/users/follow/{testuser_id}')
+
+            resp = c.get(f'/messages/{msg_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+
     def test_destroy_message(self):
         """Can user delete a message?"""
 
@@ -102,3 +134,154 @@ class MessageViewTestCase(TestCase):
             resp = c.post(f'/messages/{msg.id}/delete')
             
             self.assertEqual(Message.query.all(), [])
+
+
+    def test_destroy_liked_message(self):
+        """Does deleting a liked message take it out of its likers' counts?"""
+
+        u2 = User.signup(username="testuser2", email="test2@test.com",
+                         password="testuser2", image_url=None)
+        db.session.commit()
+
+        m = Message(text="Like me", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+        m_id, u2_id, testuser_id = m.id, u2.id, self.testuser.id
+
+        self.assertEqual(Likes.toggle(u2_id, m_id), 1)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            # u2's likes_count is cached for their next request
+            c.get('/')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f'/messages/{m_id}/delete')
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(u2_id).likes_count, 0)
+        self.assertEqual(current_users.get(u2_id).likes_count, 0)
+
+
+    def test_like_toggle(self):
+        """Does liking toggle, keep likes_count right, and refuse own messages?"""
+
+        u2 = User.signup(username="testuser2", email="test2@test.com",
+                         password="testuser2", image_url=None)
+        u3 = User.signup(username="testuser3", email="test3@test.com",
+                         password="testuser3", image_url=None)
+        db.session.commit()
+
+        m = Message(text="Like me", user_id=u2.id)
+        db.session.add(m)
+        db.session.commit()
+
+        # the requests below close the session, so hold on to plain ids
+        m_id, u2_id, u3_id, testuser_id = m.id, u2.id, u3.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post(f'/users/add_like/{m_id}')
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.filter_by(message_id=m_id).count(), 1)
+            self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+
+            # someone else can like the same message too
+            self.assertEqual(Likes.toggle(u3_id, m_id), 1)
+            db.session.commit()
+            self.assertEqual(Likes.query.filter_by(message_id=m_id).count(), 2)
+
+            resp = c.post(f'/users/add_like/{m_id}')
+            self.assertEqual(Likes.query.filter_by(user_id=testuser_id).count(), 0)
+            self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.post(f'/users/add_like/{m_id}', follow_redirects=True)
+            self.assertIn("You cannot like your own warble!", resp.get_data(as_text=True))
+            self.assertEqual(User.query.get(u2_id).likes_count, 0)
+
+
+    def card_renders(self):
+        """Record the messages whose cards get rendered (not served cached)."""
+
+        rendered = []
+
+        def record(sender, template, context, **extra):
+            if template.name == 'messages/_card.html':
+                rendered.append(context['msg'].id)
+
+        template_rendered.connect(record, app)
+        self.addCleanup(template_rendered.disconnect, record, app)
+        return rendered
+
+
+    def test_message_card_cache(self):
+        """Are message cards cached, and dropped when the message is deleted?"""
+
+        from app import message_cards
+
+        message_cards.clear()
+        rendered = self.card_renders()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Cache me"})
+            msg = Message.query.one()
+            msg_id = msg.id
+
+            resp = c.get(f'/users/{self.testuser.id}')
+            self.assertIn("Cache me", resp.get_data(as_text=True))
+            self.assertEqual(rendered, [msg_id])
+
+            # a second render is served from the cache
+            resp = c.get(f'/users/{self.testuser.id}')
+            self.assertIn("Cache me", resp.get_data(as_text=True))
+            self.assertEqual(rendered, [msg_id])
+
+            generation = message_cards._cards.generation(f"message:{msg_id}")
+            c.post(f'/messages/{msg_id}/delete')
+            self.assertNotEqual(message_cards._cards.generation(f"message:{msg_id}"),
+                                generation)
+
+
+    def test_message_card_cache_bounds(self):
+        """Is the card cache LRU-bounded and keyed on the author's profile?"""
+
+        from fragments import FragmentCache
+
+        cards = FragmentCache(max_size=4)
+        rendered = self.card_renders()
+
+        m1 = Message(text="First", user_id=self.testuser.id)
+        m2 = Message(text="Second", user_id=self.testuser.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        with app.test_request_context():
+            self.assertIn("First", cards.message_card(m1))
+            self.assertIn("Second", cards.message_card(m2))
+            self.assertEqual(cards.stats()['size'], 4)
+            self.assertGreater(cards.stats()['evictions'], 0)
+
+            cards.message_card(m2)
+            self.assertEqual(rendered, [m1.id, m2.id])
+
+            # an author's cards go with one bump
+            cards.forget_author(self.testuser.id)
+            cards.message_card(m2)
+            self.assertEqual(rendered, [m1.id, m2.id, m2.id])
+
+            # a profile change shows up without any explicit invalidation
+            self.testuser.username = "renamed"
+            self.assertIn("@renamed", cards.message_card(m2))
@@ -0,0 +1,140 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrate.py
+
+# Are migration versions unique and in order?
+# Do the migrations apply cleanly on a database made by create_all?
+# Do they bring the original schema up to what create_all makes?
+# Is each migration only applied once?
+
+import os
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from migrate import available_migrations, statements, upgrade
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# the schema as it was before any migration (the original models.py)
+BASELINE_SCHEMA = """
+CREATE TABLE users (
+    id SERIAL PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    username TEXT NOT NULL UNIQUE,
+    image_url TEXT,
+    header_image_url TEXT,
+    bio TEXT,
+    location TEXT,
+    password TEXT NOT NULL
+);
+
+CREATE TABLE follows (
+    user_being_followed_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    user_following_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (user_being_followed_id, user_following_id)
+);
+
+CREATE TABLE messages (
+    id SERIAL PRIMARY KEY,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE TABLE likes (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE
+);
+"""
+
+
+def schema():
+    """{table: (columns, indexes)} for the public schema."""
+
+    tables = {}
+
+    for table, column in db.engine.execute("""
+            SELECT table_name, column_name FROM information_schema.columns
+             WHERE table_schema = 'public' AND table_name <> 'schema_migrations'"""):
+        tables.setdefault(table, (set(), set()))[0].add(column)
+
+    for table, index in db.engine.execute("""
+            SELECT tablename, indexname FROM pg_indexes
+             WHERE schemaname = 'public' AND tablename <> 'schema_migrations'"""):
+        tables[table][1].add(index)
+
+    return tables
+
+
+def reset_schema():
+    db.session.remove()
+    db.engine.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+
+
+class MigrateTestCase(TestCase):
+    """Test the migration runner against the test database."""
+
+    def setUp(self):
+        db.session.remove()
+        db.engine.execute("DROP TABLE IF EXISTS schema_migrations")
+
+    def test_versions(self):
+        """Are versions unique and sorted?"""
+
+        versions = [version for version, _, _ in available_migrations()]
+
+        self.assertTrue(versions)
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_upgrade(self):
+        """Does upgrade apply everything once, on an up-to-date schema?"""
+
+        applied = upgrade(db.engine)
+        self.assertEqual([version for version, _ in applied],
+                         [version for version, _, _ in available_migrations()])
+
+        self.assertEqual(upgrade(db.engine), [])
+
+    def test_upgrade_baseline(self):
+        """Do the migrations turn the original schema into create_all's?"""
+
+        reset_schema()
+        try:
+            db.engine.execute(BASELINE_SCHEMA)
+            upgrade(db.engine)
+            migrated = schema()
+        finally:
+            reset_schema()
+            db.create_all()
+
+        self.assertEqual(migrated, schema())
+
+    def test_statements(self):
+        """Is a no-transaction migration split into its statements?"""
+
+        sql = ("-- a comment; not a statement\n"
+               "CREATE INDEX CONCURRENTLY a ON t (x);\n\n"
+               "DROP INDEX CONCURRENTLY b;\n-- trailing comment\n")
+
+        self.assertEqual(statements(sql), ["-- a comment; not a statement\n"
+                                           "CREATE INDEX CONCURRENTLY a ON t (x)",
+                                           "DROP INDEX CONCURRENTLY b"])
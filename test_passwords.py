@@ -0,0 +1,67 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+# Do hashes check out, inline and on the worker pool?
+# Is a hash at a different cost flagged for rehashing?
+# Are hashes refused once the queue is full?
+
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy, hash_rounds
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test PasswordHasher at a low cost, so it's quick."""
+
+    def test_inline(self):
+        """With no workers, are hashes made and checked in-process?"""
+
+        hasher = PasswordHasher()
+        hasher.configure(rounds=4, workers=0)
+
+        hashed = hasher.hash("secret")
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(hasher.check(hashed, "secret"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+
+    def test_pool(self):
+        """Do hashes made on the pool check out?"""
+
+        hasher = PasswordHasher()
+        hasher.configure(rounds=4, workers=1)
+        try:
+            hashed = hasher.hash("secret")
+            self.assertTrue(hasher.check(hashed, "secret"))
+            self.assertFalse(hasher.check(hashed, "wrong"))
+            self.assertEqual(hasher.stats()['checked'], 2)
+        finally:
+            hasher.shutdown()
+
+    def test_needs_rehash(self):
+        """Is a hash flagged once the cost changes?"""
+
+        hasher = PasswordHasher()
+        hasher.configure(rounds=4, workers=0)
+        hashed = hasher.hash("secret")
+
+        self.assertFalse(hasher.needs_rehash(hashed))
+        hasher.configure(rounds=5)
+        self.assertTrue(hasher.needs_rehash(hashed))
+
+    def test_busy(self):
+        """Is a hash refused, without running, when the queue is full?"""
+
+        hasher = PasswordHasher()
+        hasher.configure(rounds=4, workers=1, max_pending=1)
+
+        # stand in for a hash already in flight
+        hasher._slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("secret")
+
+        self.assertEqual(hasher.stats()['rejected'], 1)
+        self.assertIsNone(hasher._pool)
@@ -0,0 +1,96 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+# Is a request with a signed X-Profile header profiled, and one with a
+# forged header not?
+# Does PROFILE_SAMPLE_RATE pick requests without a header?
+# Are the phase timings in Server-Timing and the profile index?
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, profiler, page_cache, CURR_USER_KEY
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class ProfilerTestCase(TestCase):
+    """Test the sampling profiler."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        page_cache.clear()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        self.directory = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.directory.name
+        app.config['PROFILE_INTERVAL'] = 0.001
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def tearDown(self):
+        app.config['PROFILE_SAMPLE_RATE'] = 0.0
+        self.directory.cleanup()
+
+    def profiles(self):
+        path = os.path.join(self.directory.name, 'index.jsonl')
+        if not os.path.exists(path):
+            return []
+
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_signed_header(self):
+        """Is only a request with a valid X-Profile token profiled?"""
+
+        resp = self.client.get("/", headers={'X-Profile': 'forged'})
+        self.assertNotIn('Server-Timing', resp.headers)
+        self.assertEqual(self.profiles(), [])
+
+        resp = self.client.get("/", headers={'X-Profile': profiler.token()})
+        self.assertEqual(resp.status_code, 200)
+
+        timing = resp.headers['Server-Timing']
+        for phase in ['before_request', 'view', 'render', 'after_request']:
+            self.assertIn(f"{phase};dur=", timing)
+
+        profile, = self.profiles()
+        self.assertEqual(profile['endpoint'], 'homepage')
+        self.assertGreater(profile['render_ms'], 0)
+        self.assertLessEqual(profile['render_ms'], profile['view_ms'])
+        self.assertGreaterEqual(profile['total_ms'], profile['view_ms'])
+
+        # collapsed stacks: "frame;frame;... count" lines
+        with open(os.path.join(self.directory.name, profile['file'])) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                self.assertTrue(int(count) > 0)
+                self.assertIn(':', stack)
+
+    def test_sample_rate(self):
+        """Does PROFILE_SAMPLE_RATE profile requests without the header?"""
+
+        app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.client.get(f"/users/{self.user.id}")
+        self.client.get(f"/users/{self.user.id}")
+
+        self.assertEqual([p['endpoint'] for p in self.profiles()],
+                         ['users_show', 'users_show'])
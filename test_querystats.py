@@ -0,0 +1,122 @@
+"""SQL statistics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_querystats.py
+
+# Are a request's queries counted against its endpoint?
+# Does /metrics list them in the Prometheus text format, and only for
+# admins or with the stats token?
+# Is going over the query budget logged, or an error when asked?
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, query_stats, page_cache, CURR_USER_KEY
+from querystats import escape
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['STATS_TOKEN'] = 'stats-token'
+
+AUTHORIZED = {'Authorization': 'Bearer stats-token'}
+
+
+class QueryStatsTestCase(TestCase):
+    """Test the per-endpoint SQL statistics."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+        page_cache.clear()
+        query_stats.clear()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        # requests end the session, detaching the user
+        self.user_id = self.user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['QUERY_BUDGET'] = 20
+        app.config['QUERY_BUDGET_ACTION'] = 'log'
+        db.session.rollback()
+
+    def test_endpoint_totals(self):
+        """Are a profile page's queries, rows and slowest statement kept?"""
+
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            self.client.get(f"/users/{self.user_id}")
+        self.assertIn("Slowest query yet for users_show", logs.output[0])
+        self.client.get(f"/users/{self.user_id}")
+
+        stats = query_stats.endpoints['users_show']
+        self.assertEqual(stats.requests, 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.rows, 0)
+        self.assertGreater(stats.seconds, 0)
+        self.assertIn('SELECT', stats.slowest[1])
+
+    def test_metrics(self):
+        """Is /metrics in the Prometheus text format?"""
+
+        self.client.get(f"/users/{self.user_id}")
+        resp = self.client.get("/metrics", headers=AUTHORIZED)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain; version=0.0.4'))
+
+        text = resp.get_data(as_text=True)
+        self.assertIn("# TYPE warbler_db_queries_total counter", text)
+        self.assertIn('warbler_requests_total{endpoint="users_show"} 1', text)
+        self.assertIn('warbler_db_slowest_query_seconds{endpoint="users_show"} ', text)
+        self.assertNotIn('statement=', text)
+
+        self.assertEqual(escape('SELECT "a"\n  FROM b'), 'SELECT \\"a\\" FROM b')
+
+    def test_budget(self):
+        """Is a request over budget logged, or with 'raise', a 500?"""
+
+        app.config['QUERY_BUDGET'] = 0
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            resp = self.client.get(f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("its budget is 0", logs.output[0])
+
+        app.config['QUERY_BUDGET_ACTION'] = 'raise'
+        resp = self.client.get("/users")
+        self.assertEqual(resp.status_code, 500)
+
+        self.assertEqual(query_stats.endpoints['users_show'].over_budget, 1)
+        self.assertEqual(query_stats.endpoints['list_users'].over_budget, 1)
+
+    def test_stats_restricted(self):
+        """Are the stats endpoints only for admins or the token's holder?"""
+
+        for url in ["/metrics", "/cache/stats", "/login/stats"]:
+            self.assertEqual(self.client.get(url).status_code, 403)
+            self.assertEqual(self.client.get(url, headers={
+                'Authorization': 'Bearer wrong'}).status_code, 403)
+            self.assertEqual(self.client.get(url, headers={
+                'Authorization': 'Bearer é'}).status_code, 403)
+            self.assertEqual(self.client.get(url, headers=AUTHORIZED).status_code, 200)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+        app.config['ADMIN_USERNAMES'] = {'testuser'}
+        try:
+            self.assertEqual(self.client.get("/metrics").status_code, 200)
+        finally:
+            app.config['ADMIN_USERNAMES'] = set()
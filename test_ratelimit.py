@@ -0,0 +1,81 @@
+"""Login throttling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+# Does the sliding window count recent events and forget old ones?
+# Are logins throttled per username and per IP, and the saving counted?
+# Are attempts counted before they're checked, and successes refunded?
+
+from unittest import TestCase
+
+from cache import LRUCache
+from ratelimit import SlidingWindow, LoginLimiter
+
+
+class SlidingWindowTestCase(TestCase):
+    """Test the sliding window counter with explicit times."""
+
+    def test_window(self):
+        """Does the count slide off as the window moves on?"""
+
+        window = SlidingWindow(LRUCache(), 'test', window=10)
+
+        for now in (100, 101, 105):
+            window.hit('a', now=now)
+
+        self.assertEqual(window.count('a', now=109), 3)
+        self.assertEqual(window.count('b', now=109), 0)
+
+        # halfway through the next bucket, half the old one still counts
+        self.assertAlmostEqual(window.count('a', now=115), 1.5)
+        self.assertEqual(window.count('a', now=125), 0)
+
+
+class LoginLimiterTestCase(TestCase):
+    """Test LoginLimiter's limits and counters."""
+
+    def test_per_username(self):
+        """Is a username throttled after its failures, whatever the IP?"""
+
+        limiter = LoginLimiter(LRUCache(), per_username=2, per_ip=100)
+
+        for ip in ('1.1.1.1', '2.2.2.2'):
+            self.assertTrue(limiter.attempt('Alice', ip))
+            limiter.failed(0.25)
+
+        self.assertIsNone(limiter.attempt('alice', '3.3.3.3'))
+        self.assertTrue(limiter.attempt('bob', '3.3.3.3'))
+
+        stats = limiter.stats()
+        self.assertEqual(stats['throttled'], 1)
+        self.assertEqual(stats['average_check_seconds'], 0.25)
+        self.assertEqual(stats['check_seconds_saved'], 0.25)
+
+    def test_per_ip(self):
+        """Is an IP throttled after failing across many usernames?"""
+
+        limiter = LoginLimiter(LRUCache(), per_username=100, per_ip=3)
+
+        for i in range(3):
+            self.assertTrue(limiter.attempt(f"user{i}", '1.1.1.1'))
+            limiter.failed(0.1)
+
+        self.assertIsNone(limiter.attempt('someone-else', '1.1.1.1'))
+        self.assertTrue(limiter.attempt('someone-else', '2.2.2.2'))
+
+    def test_reserved(self):
+        """Do unchecked attempts count, and refunded ones stop counting?"""
+
+        limiter = LoginLimiter(LRUCache(), per_username=2, per_ip=100)
+
+        # a burst: none has failed yet, but only two get through
+        attempts = [limiter.attempt('alice', '1.1.1.1') for _ in range(3)]
+        self.assertEqual([bool(attempt) for attempt in attempts], [True, True, False])
+
+        # both succeed, so the name is free again
+        for attempt in attempts[:2]:
+            limiter.refund(attempt)
+        self.assertTrue(limiter.attempt('alice', '1.1.1.1'))
+        self.assertEqual(limiter.usernames.count('alice'), 1)
@@ -0,0 +1,130 @@
+"""User search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+# Does an exact username beat a username prefix, which beats a bio match?
+# Do multi-word searches need every word in the bio?
+# Is the number of results capped, keeping the best matches?
+# Do the Postgres and in-memory backends agree?
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from search import PrefixIndex, PostgresUserSearch, PrefixIndexUserSearch, EXACT, PREFIX, BIO
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+USERS = [
+    (1, "bird", "Just a bird"),
+    (2, "birdwatcher", "I like owls"),
+    (3, "owl_fan", "Birdsong enthusiast and night owl"),
+    (4, "hawk", None),
+]
+
+
+class PrefixIndexTestCase(TestCase):
+    """Test the in-memory PrefixIndex on its own."""
+
+    def setUp(self):
+        self.index = PrefixIndex(USERS)
+
+    def test_ranking(self):
+        """Does exact beat prefix beat bio?"""
+
+        self.assertEqual(self.index.search("bird", 10),
+                         [(1, EXACT), (2, PREFIX), (3, BIO)])
+
+    def test_case_insensitive(self):
+        """Does case not matter?"""
+
+        self.assertEqual(self.index.search("HAWK", 10), [(4, EXACT)])
+
+    def test_all_words_in_bio(self):
+        """Do multi-word bio searches need every word?"""
+
+        self.assertEqual(self.index.search("night owl", 10), [(3, BIO)])
+        self.assertEqual(self.index.search("owls", 10), [(2, BIO)])
+
+    def test_limit(self):
+        """Are results capped?"""
+
+        self.assertEqual(len(self.index.search("bird", 2)), 2)
+        self.assertEqual(self.index.search("zebra", 10), [])
+
+
+class UserSearchTestCase(TestCase):
+    """Test both backends against the database."""
+
+    def setUp(self):
+        User.query.delete()
+
+        for user_id, username, bio in USERS:
+            db.session.add(User(username=username, bio=bio,
+                                email=f"{username}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback on exit"""
+
+        db.session.rollback()
+
+    def test_backends_agree(self):
+        """Do the Postgres and in-memory searches rank the same way?"""
+
+        for backend in (PostgresUserSearch(), PrefixIndexUserSearch()):
+            found = [u.username for u in backend.search("bird", 10)]
+            self.assertEqual(found, ["bird", "birdwatcher", "owl_fan"])
+
+            found = [u.username for u in backend.search("owl", 10)]
+            self.assertEqual(found[0], "owl_fan")
+            self.assertEqual(set(found), {"owl_fan", "birdwatcher"})
+
+            self.assertEqual(backend.search("100%", 10), [])
+
+    def test_postgres_limit(self):
+        """Does the Postgres search keep the best matches under a limit?"""
+
+        backend = PostgresUserSearch()
+
+        for i in range(5):
+            db.session.add(User(username=f"birdy{i}", bio="Bird bird bird",
+                                email=f"birdy{i}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.assertEqual([u.username for u in backend.search("bird", 3)],
+                         ["bird", "birdwatcher", "birdy0"])
+        self.assertEqual([u.username for u in backend.search("owl", 1)],
+                         ["owl_fan"])
+
+    def test_list_users_search(self):
+        """Does /users?q= show ranked matches only?"""
+
+        with app.test_client() as client:
+            resp = client.get('/users?q=bird')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@birdwatcher", html)
+            self.assertNotIn("@hawk", html)
+            self.assertLess(html.index("@bird<"), html.index("@birdwatcher"))
@@ -0,0 +1,127 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+# Does posting a message push it into the author's and followers' timelines?
+# Does following a user backfill their messages into the follower's timeline?
+# Does unfollowing a user take their messages back out?
+# Does deleting a message remove it from every timeline?
+# Does rebuild() recompute the same timelines from scratch?
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineModelTestCase(TestCase):
+    """Test TimelineEntry model."""
+
+    def setUp(self):
+        """Create two users, u2 following u1."""
+
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="u1@test.com", username="u1", password="HASHED_PASSWORD")
+        self.u2 = User(email="u2@test.com", username="u2", password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.u2.id))
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback on exit"""
+
+        db.session.rollback()
+
+    def post(self, user, text="Hello"):
+        """Post a message the way messages_add does."""
+
+        msg = Message(text=text, user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def timeline(self, user):
+        """Set of message ids in `user`'s timeline."""
+
+        return {e.message_id for e in TimelineEntry.query.filter_by(user_id=user.id)}
+
+    def test_fan_out(self):
+        """Does posting push to the author and followers only?"""
+
+        m = self.post(self.u1)
+
+        self.assertEqual(self.timeline(self.u1), {m.id})
+        self.assertEqual(self.timeline(self.u2), {m.id})
+
+        m2 = self.post(self.u2)
+
+        self.assertEqual(self.timeline(self.u1), {m.id})
+        self.assertEqual(self.timeline(self.u2), {m.id, m2.id})
+
+    def test_follow_and_unfollow(self):
+        """Do follows backfill and unfollows clear the follower's timeline?"""
+
+        m = self.post(self.u2)
+
+        db.session.add(Follows(user_being_followed_id=self.u2.id,
+                               user_following_id=self.u1.id))
+        TimelineEntry.add_follow(self.u1.id, self.u2.id)
+        db.session.commit()
+
+        self.assertEqual(self.timeline(self.u1), {m.id})
+
+        TimelineEntry.remove_follow(self.u1.id, self.u2.id)
+        db.session.commit()
+
+        self.assertEqual(self.timeline(self.u1), set())
+
+    def test_remove_message(self):
+        """Does deleting a message take it out of every timeline?"""
+
+        m = self.post(self.u1)
+        TimelineEntry.remove_message(m.id)
+        db.session.delete(m)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_rebuild(self):
+        """Does rebuild() match what fan-out produced?"""
+
+        m1 = self.post(self.u1)
+        m2 = self.post(self.u2)
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(self.timeline(self.u1), {m1.id})
+        self.assertEqual(self.timeline(self.u2), {m1.id, m2.id})
@@ -0,0 +1,186 @@
+"""Timeline engine tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+# Does the merge engine page through the same messages as the push one,
+# including past what the per-author buffers hold?
+# Do new and deleted messages show up in the buffers, without being
+# pushed to followers?
+# Are celebrities' messages kept out of followers' timelines, but still
+# merged into their pages, and pushed again once they're demoted?
+# Does the app refuse to merge buffers held in a per-process cache?
+
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import LRUCache
+from current_user import CurrentUser
+from timelines import RecentMessages, PushTimeline, MergeTimeline, HybridTimeline
+
+db.create_all()
+
+
+class TimelineEngineTestCase(TestCase):
+    """Test the timeline engines against each other."""
+
+    def setUp(self):
+        """A reader following three authors, who post interleaved."""
+
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.users = [User(email=f"u{i}@test.com", username=f"u{i}",
+                           password="HASHED_PASSWORD") for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+        self.reader, *self.authors, self.stranger = self.users
+        for author in self.authors:
+            db.session.add(Follows(user_being_followed_id=author.id,
+                                   user_following_id=self.reader.id))
+
+        # uneven: u1 posts most, and two messages share a timestamp
+        start = datetime(2020, 1, 1)
+        for i in range(30):
+            author = self.authors[0 if i % 3 else i % 2 + 1]
+            db.session.add(Message(text=f"m{i}", user_id=author.id,
+                                   timestamp=start + timedelta(minutes=i // 2 * 2)))
+        db.session.add(Message(text="hidden", user_id=self.stranger.id,
+                               timestamp=start))
+        db.session.commit()
+        TimelineEntry.rebuild()
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.recent = RecentMessages(LRUCache(), size=4)
+        self.merge = MergeTimeline(self.recent)
+        self.push = PushTimeline()
+        self.hybrid = HybridTimeline(self.recent, celebrity_followers=2)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def pages(self, engine, per_page=5):
+        """Every page of the reader's timeline, as lists of ids."""
+
+        reader = CurrentUser.load(self.reader.id)
+        pages, before = [], None
+
+        while True:
+            messages, before = engine.page(reader, before=before, per_page=per_page)
+            pages.append([msg.id for msg in messages])
+            if before is None:
+                return pages
+
+    def test_same_pages(self):
+        """Does merging give the same pages as the precomputed timeline?"""
+
+        expected = self.pages(self.push)
+        self.assertEqual(sum(len(page) for page in expected), 30)
+        self.assertEqual(self.pages(self.merge), expected)
+
+        # and again with every buffer big enough to hold it all
+        self.recent.size = 50
+        self.recent.cache.clear()
+        self.assertEqual(self.pages(self.merge), expected)
+
+    def test_buffer_updates(self):
+        """Are posted and deleted messages reflected in the buffers?"""
+
+        author = self.authors[1]
+        before = self.recent.get_many([author.id])[author.id]
+
+        msg = Message(text="new", user_id=author.id)
+        db.session.add(msg)
+        db.session.flush()
+        self.merge.posted(msg)
+        self.merge.deliver(msg)
+        db.session.commit()
+        self.recent.add(msg)
+
+        # merged on read, so only the author's own timeline has it
+        self.assertEqual([entry.user_id for entry in
+                          TimelineEntry.query.filter_by(message_id=msg.id)],
+                         [author.id])
+
+        buffer = self.recent.get_many([author.id])[author.id]
+        self.assertEqual(buffer[0][1], msg.id)
+        self.assertEqual(buffer[1:], before[:3])
+
+        reader = CurrentUser.load(self.reader.id)
+        messages, _ = self.merge.page(reader, per_page=5)
+        self.assertEqual(messages[0].id, msg.id)
+
+        db.session.delete(msg)
+        db.session.commit()
+        self.recent.remove(msg)
+        self.assertEqual(self.recent.get_many([author.id])[author.id], before)
+
+    def test_hybrid(self):
+        """Are celebrities merged in on read, and pushed once demoted?"""
+
+        expected = self.pages(self.push)
+        self.assertEqual(self.pages(self.hybrid), expected)
+
+        # a second follower makes u1 a celebrity
+        celebrity = self.authors[0]
+        db.session.add(Follows(user_being_followed_id=celebrity.id,
+                               user_following_id=self.stranger.id))
+        User.bump_counts(celebrity.id, followers_count=1)
+        self.hybrid.followers_changed(celebrity.id)
+        db.session.commit()
+        self.assertTrue(User.query.get(celebrity.id).celebrity)
+
+        msg = Message(text="famous", user_id=celebrity.id)
+        db.session.add(msg)
+        db.session.flush()
+        self.hybrid.posted(msg)
+        self.hybrid.deliver(msg)
+        db.session.commit()
+        self.recent.add(msg)
+
+        self.assertEqual([entry.user_id for entry in
+                          TimelineEntry.query.filter_by(message_id=msg.id)],
+                         [celebrity.id])
+
+        # pushed before the promotion and merged after: no duplicates
+        pages = self.pages(self.hybrid)
+        self.assertEqual(pages[0][0], msg.id)
+        self.assertEqual(sum(pages, []), [msg.id] + sum(expected, []))
+
+        # and losing them again gets the message pushed to the reader
+        (Follows.query
+         .filter_by(user_being_followed_id=celebrity.id,
+                    user_following_id=self.stranger.id)
+         .delete())
+        User.bump_counts(celebrity.id, followers_count=-1)
+        self.hybrid.followers_changed(celebrity.id)
+        db.session.commit()
+        self.assertFalse(User.query.get(celebrity.id).celebrity)
+        self.assertEqual(sorted(entry.user_id for entry in
+                                TimelineEntry.query.filter_by(message_id=msg.id)),
+                         sorted([celebrity.id, self.reader.id]))
+        self.assertEqual(self.pages(self.push), pages)
+
+    def test_needs_shared_cache(self):
+        """Does the app refuse 'hybrid' with a per-process cache?"""
+
+        env = dict(os.environ, TIMELINE_ENGINE='hybrid', CACHE_URL='memory://')
+        result = subprocess.run([sys.executable, '-c', 'import app'], env=env,
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("needs a shared cache", result.stderr)
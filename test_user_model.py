@@ -16,6 +16,7 @@
 # Does User.authenticate successfully return a user when given a valid username and password?
 # Does User.authenticate fail to return a user when the username is invalid?
 # Does User.authenticate fail to return a user when the password is invalid?
+# Does User.authenticate rehash a password made at an old cost?
 
 
 import os
@@ -23,7 +24,7 @@ from unittest import TestCase
 
 from psycopg2 import IntegrityError
 
-from models import db, User, Message, Follows, Likes
+from models import db, User, Message, Follows, Likes, passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -224,3 +225,89 @@ class UserModelTestCase(TestCase):
         db.session.commit()
 
         self.assertEqual(User.authenticate(username="TestUser", password="HSHD_PWD"), False)
+
+
+    def test_user_authenticate_rehash(self):
+        """Does User.authenticate rehash a password made at an old cost?"""
+
+        rounds = passwords.rounds
+        passwords.configure(rounds=4)
+        try:
+            u = User.signup(username="TestUser", email="test@test.com", password="HASHED_PASSWORD")
+            db.session.commit()
+            self.assertTrue(u.password.startswith("$2b$04$"))
+
+            passwords.configure(rounds=5)
+            self.assertEqual(User.authenticate(username="TestUser", password="HASHED_PASSWORD"), u)
+            self.assertTrue(u.password.startswith("$2b$05$"))
+
+            # and the new hash still checks out
+            self.assertEqual(User.authenticate(username="TestUser", password="HASHED_PASSWORD"), u)
+        finally:
+            passwords.configure(rounds=rounds)
+
+
+    def test_user_bump_counts(self):
+        """Does User.bump_counts add to the counter columns?"""
+
+        u = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+
+        User.bump_counts(u.id, followers_count=2, likes_count=1)
+        User.bump_counts(u.id, followers_count=-1)
+        db.session.commit()
+
+        self.assertEqual(u.followers_count, 1)
+        self.assertEqual(u.likes_count, 1)
+        self.assertEqual(u.messages_count, 0)
+
+
+    def test_user_reconcile_counts(self):
+        """Does User.reconcile_counts recompute counters from the source tables?"""
+
+        u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        m = Message(text="Hello", user_id=u2.id)
+        db.session.add(m)
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=u1.id, message_id=m.id))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual((u1.messages_count, u1.following_count, u1.followers_count, u1.likes_count),
+                         (0, 1, 0, 1))
+        self.assertEqual((u2.messages_count, u2.following_count, u2.followers_count, u2.likes_count),
+                         (1, 0, 1, 0))
+
+        # deleting u2 takes them out of u1's following and likes counts
+        u2.release_counts()
+        db.session.delete(m)
+        db.session.delete(u2)
+        db.session.commit()
+
+        self.assertEqual((u1.following_count, u1.likes_count), (0, 0))
+
+
+    def test_user_following_among(self):
+        """Does following_among pick out just the followed ids?"""
+
+        u1 = User(email="test1@test.com", username="testuser1", password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD")
+        u3 = User(email="test3@test.com", username="testuser3", password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+        self.assertEqual(u1.following_among([u2.id, u3.id]), {u2.id})
+        self.assertEqual(u1.following_among([]), set())
+        self.assertEqual(u2.following_among([u1.id, u3.id]), set())
@@ -3,11 +3,13 @@
 # beginning code copied from test_message_views.py
 
 import os
+from contextlib import contextmanager
 from unittest import TestCase
 
 from flask import session
+from sqlalchemy import event
 
-from models import db, connect_db, Message, User, Follows, Likes
+from models import db, connect_db, Message, User, Follows, Likes, TimelineEntry, passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -18,7 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, current_users, page_cache, login_limiter
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,6 +33,25 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['STATS_TOKEN'] = 'stats-token'
+
+AUTHORIZED = {'Authorization': 'Bearer stats-token'}
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the `with` block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
 
 
 class UserViewTestCase(TestCase):
@@ -41,6 +62,8 @@ class UserViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        page_cache.clear()
+        login_limiter.cache.clear()
 
         self.client = app.test_client()
 
@@ -110,6 +133,44 @@ class UserViewTestCase(TestCase):
             self.assertIn("Hello, testuser", html)
 
 
+    def test_login_throttled(self):
+        """ Test repeated failed logins are turned away before checking"""
+        with app.test_client() as client:
+            for _ in range(app.config['LOGIN_FAILURES_PER_USERNAME']):
+                resp = client.post('/login', data={'username': 'testuser',
+                                                   'password': 'wrong!'})
+                self.assertIn("Invalid credentials", resp.get_data(as_text=True))
+
+            checked = passwords.stats()['checked']
+            resp = client.post('/login', data={'username': 'testuser',
+                                               'password': 'testuser'})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Too many failed logins", resp.get_data(as_text=True))
+            self.assertEqual(passwords.stats()['checked'], checked)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+            stats = client.get('/login/stats', headers=AUTHORIZED).get_json()
+            self.assertEqual(stats['throttled'], 1)
+            self.assertGreater(stats['check_seconds_saved'], 0)
+
+
+    def test_login_busy(self):
+        """ Test logins are turned away while the password queue is full"""
+        with app.test_client() as client:
+            passwords.configure(max_pending=1)
+            passwords._slots.acquire()
+            try:
+                resp = client.post('/login', data={'username': 'testuser',
+                                                   'password': 'testuser'},
+                                   follow_redirects=True)
+            finally:
+                passwords.configure(max_pending=app.config['PASSWORD_MAX_PENDING'])
+
+            self.assertIn("Please try again in a moment", resp.get_data(as_text=True))
+            self.assertNotIn(CURR_USER_KEY, session)
+
+
     def test_logout(self):
         """ Test the signup view GET route with data."""
         with app.test_client() as client:
@@ -137,6 +198,84 @@ class UserViewTestCase(TestCase):
             self.assertIn("@testuser", html)
 
 
+    def test_list_users_pagination(self):
+        """ Test the directory pages through users by id"""
+        with app.test_client() as client:
+            per_page = app.config['USERS_PER_PAGE']
+
+            for i in range(per_page):
+                db.session.add(User(username=f"user{i}", email=f"user{i}@test.com",
+                                    password="password"))
+            db.session.commit()
+
+            resp = client.get('/users')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card-link"'), per_page)
+            self.assertIn("@testuser", html)
+
+            last = User.query.order_by(User.id.desc()).first()
+            self.assertNotIn(f"@{last.username}<", html)
+            self.assertIn('id="load-more"', html)
+
+            after = html.split('?after=')[1].split('"')[0]
+            resp = client.get(f'/users?after={after}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card-link"'), 1)
+            self.assertIn(f"@{last.username}<", html)
+            self.assertNotIn('id="load-more"', html)
+
+
+    def test_list_users_cached(self):
+        """ Test the directory page is cached until someone signs up"""
+        with app.test_client() as client:
+            client.get('/users')
+            with count_queries() as statements:
+                html = client.get('/users').get_data(as_text=True)
+
+            self.assertEqual(statements, [])
+            self.assertIn("@testuser", html)
+            self.assertGreater(client.get('/cache/stats', headers=AUTHORIZED).get_json()['hits'], 0)
+
+            client.post('/signup', data={"username": "newbie",
+                                         "email": "newbie@test.com",
+                                         "password": "password"})
+            client.get('/logout')
+
+            html = client.get('/users').get_data(as_text=True)
+            self.assertIn("@newbie", html)
+
+
+    def test_export_users(self):
+        """ Test the CSV export is admin-only and streams every user"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = client.get('/users/export.csv')
+            self.assertEqual(resp.status_code, 302)
+
+            app.config['ADMIN_USERNAMES'] = {"testuser"}
+            app.config['EXPORT_BATCH_SIZE'] = 1
+            try:
+                db.session.add(User(username="testuser2", email="test2@test.com",
+                                    password="password"))
+                db.session.commit()
+
+                resp = client.get('/users/export.csv')
+                lines = resp.get_data(as_text=True).splitlines()
+            finally:
+                app.config['ADMIN_USERNAMES'] = set()
+                app.config['EXPORT_BATCH_SIZE'] = 1000
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/csv')
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(lines[0].startswith("id,username,email"))
+            self.assertIn("testuser2", lines[2])
+
+
     def test_users_show(self):
         """ Test user show profile ROUTE"""
         with app.test_client() as client:
@@ -152,8 +291,156 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             # check that our username is in the html
             self.assertIn("@testuser", html)
+
+
+    def test_users_show_pagination(self):
+        """ Test the profile page pages through messages with ?before= cursors"""
+        with app.test_client() as client:
+            per_page = app.config['MESSAGES_PER_PAGE']
+
+            for i in range(per_page + 5):
+                db.session.add(Message(text=f"warble {i}", user_id=self.testuser.id))
+            db.session.commit()
+
+            resp = client.get(f'/users/{self.testuser.id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="message-link"'), per_page)
+            self.assertIn('id="load-more"', html)
+
+            # follow the load more link to the second (last) page
+            cursor = html.split('?before=')[1].split('"')[0]
+            resp = client.get(f'/users/{self.testuser.id}?before={cursor}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="message-link"'), 5)
+            self.assertNotIn('id="load-more"', html)
+
+            # a garbled cursor is a bad request
+            resp = client.get(f'/users/{self.testuser.id}?before=nonsense')
+            self.assertEqual(resp.status_code, 400)
+
+
+    def test_message_lists_query_count(self):
+        """ Test timeline, profile and likes pages run a fixed number of queries"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            authors = []
+
+            def add_messages(n):
+                # every message gets its own author, so a lazy msg.user
+                # load can't be answered from the identity map
+                for i in range(len(authors), len(authors) + n):
+                    author = User(username=f"author{i}", email=f"author{i}@test.com",
+                                  password="password")
+                    db.session.add(author)
+                    db.session.flush()
+                    authors.append(author)
+
+                    db.session.add(Follows(user_being_followed_id=author.id,
+                                           user_following_id=self.testuser.id))
+                    msg = Message(text=f"warble {i}", user_id=author.id)
+                    db.session.add(msg)
+                    db.session.flush()
+                    TimelineEntry.fan_out(msg)
+                    db.session.add(Likes(user_id=self.testuser.id, message_id=msg.id))
+                db.session.commit()
+
+            add_messages(2)
+            urls = ['/', f'/users/{authors[0].id}', f'/users/{self.testuser.id}/likes']
+
+            def query_counts():
+                counts = []
+                for url in urls:
+                    page_cache.clear()
+                    with count_queries() as statements:
+                        resp = client.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    counts.append(len(statements))
+                return counts
+
+            # don't let the current-user cache make the first request differ
+            current_users.ttl = 0
+            try:
+                few = query_counts()
+
+                add_messages(10)
+                many = query_counts()
+            finally:
+                current_users.ttl = app.config['CURRENT_USER_TTL']
+
+            self.assertEqual(few, many)
     
 
+    def test_users_show_not_modified(self):
+        """ Test an unchanged profile is a 304, until the user posts"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            url = f'/users/{self.testuser.id}'
+            etag = client.get(url).headers['ETag']
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.post('/messages/new', data={"text": "news"})
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("news", resp.get_data(as_text=True))
+
+
+    def test_users_show_etag_matches_body(self):
+        """ Test the ETag follows the (cached) page served, not the database"""
+        with app.test_client() as client:
+            url = f'/users/{self.testuser.id}'
+            etag = client.get(url).headers['ETag']
+
+            # posted through another process: this one's cached page is stale
+            db.session.add(Message(text="elsewhere", user_id=self.testuser.id))
+            db.session.commit()
+
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # once the cached page expires, the ETag moves on with it
+            page_cache.clear()
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("elsewhere", resp.get_data(as_text=True))
+
+
+    def test_users_show_if_modified_since(self):
+        """ Test a date alone never gets a 304 (the bio can change without one)"""
+        with app.test_client() as client:
+            url = f'/users/{self.testuser.id}'
+            resp = client.get(url)
+            self.assertNotIn('Last-Modified', resp.headers)
+
+            resp = client.get(url, headers={
+                'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(resp.status_code, 200)
+
+
+    def test_cache_headers(self):
+        """ Test fingerprinted static files are immutable and pages aren't cached"""
+        with app.test_client() as client:
+            html = client.get('/login').get_data(as_text=True)
+            self.assertIn('/static/stylesheets/style.css?v=', html)
+
+            css = html.split('href="')[1:]
+            css = next(href.split('"')[0] for href in css if 'style.css' in href)
+            resp = client.get(css)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            resp.close()
+
+            resp = client.get('/login')
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+
 #############################################
     def test_show_following(self):
         """ Test list user show following GET route"""
@@ -248,6 +535,29 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
 
 
+    def test_stop_following_twice(self):
+        """Does a repeated unfollow leave the counts alone?"""
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            u2 = User(username="testuser2", email="test2@test.com", password="password")
+            db.session.add(u2)
+            db.session.commit()
+            u2_id = u2.id
+
+            client.post(f'/users/follow/{u2_id}')
+            client.post(f'/users/stop-following/{u2_id}')
+            resp = client.post(f'/users/stop-following/{u2_id}')
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
+            self.assertEqual(User.query.get(u2_id).followers_count, 0)
+
+            resp = client.post('/users/stop-following/999999')
+            self.assertEqual(resp.status_code, 404)
+
+
     def test_add_remove_likes(self):
         """ Test likes POST route"""
         with app.test_client() as client:
@@ -0,0 +1,352 @@
+"""Home timeline engines.
+
+TIMELINE_ENGINE picks how the home page finds the messages of everyone
+a user follows:
+
+- 'push' (fan-out-on-write): each message is copied into its followers'
+  TimelineEntry rows when it's posted, so a page is one indexed range
+  read. Cheap to read; posting costs a row per follower.
+
+- 'merge' (fan-out-on-read): each author's most recent messages are
+  kept in a buffer in the page cache (RecentMessages), and a page is a
+  k-way heap merge of the buffers of everyone the user follows. Pages
+  reaching back past what the buffers hold are read with one IN query.
+
+- 'hybrid' (the default with a shared cache): authors are classified
+  by follower count. Most authors' messages are pushed as above; those
+  of celebrities (CELEBRITY_FOLLOWERS or more followers) are not, so
+  one post from a huge account isn't a write storm. Each page merges
+  the reader's pushed timeline with their followed celebrities'
+  buffers. Authors are reclassified as they gain and lose followers.
+
+'merge' and 'hybrid' need a cache every web process shares (a socket://
+CACHE_URL): a buffer updated by the process a message was posted in
+would otherwise stay stale in the others. With a per-process cache the
+default is 'push'.
+
+'merge' doesn't push messages to followers, and 'hybrid' doesn't push
+celebrities', so switching from either to 'push' (or from 'merge' to
+'hybrid') needs `flask rebuild-timelines` first. Switching to 'merge'
+needs no rebuild.
+"""
+
+import heapq
+from itertools import islice
+
+from models import db, User, Message, Follows, TimelineEntry
+from pagination import keyset_page, encode_cursor, decode_cursor
+from snapshots import TIMESTAMP_FORMAT
+
+# a celebrity goes back to being pushed below this fraction of the
+# threshold, so an author near it doesn't flip on every follow
+DEMOTE_FRACTION = 0.9
+
+
+def cursor_entry(before):
+    """The entry a `?before=` cursor points just past; None for no cursor.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    if not before:
+        return None
+
+    timestamp, message_id = decode_cursor(before)
+    return [timestamp.strftime(TIMESTAMP_FORMAT), message_id]
+
+
+def newest_entries(query, timestamp_col, id_col, before, limit):
+    """Up to `limit` entries from `query` (of `timestamp` and `id`
+    columns), newest first, starting past the `before` cursor."""
+
+    rows, _ = keyset_page(query, timestamp_col, id_col, before=before, per_page=limit)
+
+    return [[row.timestamp.strftime(TIMESTAMP_FORMAT), row.id] for row in rows]
+
+
+def messages_page(entries, per_page):
+    """(messages, next_cursor) for up to `per_page` + 1 merged entries."""
+
+    ids = [message_id for _, message_id in entries[:per_page]]
+    found = {msg.id: msg for msg in (Message
+                                     .query
+                                     .filter(Message.id.in_(ids))
+                                     .options(db.joinedload(Message.user)))}
+
+    # a buffer may briefly list a message deleted by another process
+    messages = [found[message_id] for message_id in ids if message_id in found]
+
+    if len(entries) <= per_page or not messages:
+        return messages, None
+
+    return messages, encode_cursor(messages[-1])
+
+
+class RecentMessages:
+    """The `size` newest messages of each author, as [timestamp, id]
+    lists (newest first) in `cache`.
+
+    A buffer shorter than `size` is everything its author has posted; a
+    full one covers their messages back to its last entry.
+    """
+
+    def __init__(self, cache, size=50, ttl=300):
+        self.cache = cache
+        self.size = size
+        self.ttl = ttl
+
+    def _key(self, author_id):
+        return f"recent:{author_id}"
+
+    def get_many(self, author_ids):
+        """{author id: buffer} for `author_ids`, loading any not cached."""
+
+        cached = self.cache.get_many([self._key(author_id) for author_id in author_ids])
+        buffers = {author_id: cached[self._key(author_id)] for author_id in author_ids
+                   if self._key(author_id) in cached}
+
+        missing = [author_id for author_id in author_ids
+                   if author_id not in buffers]
+        if missing:
+            loaded = self.load(missing)
+            for author_id in missing:
+                buffers[author_id] = loaded.get(author_id, [])
+                self.cache.set(self._key(author_id), buffers[author_id],
+                               ttl=self.ttl)
+
+        return buffers
+
+    def load(self, author_ids):
+        """Read the buffers of `author_ids` from the messages table."""
+
+        if db.engine.dialect.name == 'postgresql':
+            # one index range read per author
+            rows = db.session.execute("""
+                SELECT authors.id, recent.id, recent.timestamp
+                  FROM unnest(:ids) AS authors(id)
+                 CROSS JOIN LATERAL (
+                       SELECT messages.id, messages.timestamp
+                         FROM messages
+                        WHERE messages.user_id = authors.id
+                        ORDER BY messages.timestamp DESC, messages.id DESC
+                        LIMIT :size) AS recent
+            """, {'ids': list(author_ids), 'size': self.size})
+
+        else:
+            rank = (db.func.row_number()
+                    .over(partition_by=Message.user_id,
+                          order_by=(Message.timestamp.desc(), Message.id.desc()))
+                    .label('rank'))
+            ranked = (db.session
+                      .query(Message.user_id, Message.id, Message.timestamp, rank)
+                      .filter(Message.user_id.in_(author_ids))
+                      .subquery())
+            rows = (db.session
+                    .query(ranked.c.user_id, ranked.c.id, ranked.c.timestamp)
+                    .filter(ranked.c.rank <= self.size))
+
+        buffers = {}
+        for author_id, message_id, timestamp in rows:
+            buffers.setdefault(author_id, []).append(
+                [timestamp.strftime(TIMESTAMP_FORMAT), message_id])
+
+        for buffer in buffers.values():
+            buffer.sort(reverse=True)
+
+        return buffers
+
+    def add(self, message):
+        """Make a new message show up in its author's buffer."""
+
+        # a read-modify-write here would let concurrent posts (in other
+        # processes) drop each other's entries; reloading can't
+        self.cache.delete(self._key(message.user_id))
+
+    def remove(self, message):
+        """Drop a deleted message from its author's buffer."""
+
+        # a full buffer would have to be topped up from older messages,
+        # so it's simply reloaded next time
+        self.cache.delete(self._key(message.user_id))
+
+
+class PushTimeline:
+    """Pages read from the precomputed TimelineEntry rows."""
+
+    def posted(self, message):
+        """Put a new message in its author's own timeline."""
+
+        TimelineEntry.fan_out(message, to_followers=False)
+
+    def deliver(self, message):
+        """Put a posted message in its author's followers' timelines
+        (in the deliver_message job)."""
+
+        TimelineEntry.push_to_followers(message)
+
+    def followers_changed(self, author_id):
+        """`author_id` gained or lost a follower (in the apply_follow job)."""
+
+    def page(self, user, before=None, per_page=20):
+        """(messages, next_cursor) for `user`'s home page."""
+
+        return keyset_page(
+            (Message
+             .query
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == user.id)
+             .options(db.joinedload(Message.user))),
+            TimelineEntry.timestamp, TimelineEntry.message_id,
+            before=before, per_page=per_page)
+
+
+class MergeTimeline(PushTimeline):
+    """Pages merged from the followed authors' RecentMessages buffers."""
+
+    def __init__(self, recent):
+        self.recent = recent
+
+    def deliver(self, message):
+        """Nothing to push: pages are merged from the buffers on read."""
+
+    def author_entries(self, author_ids, before, limit):
+        """Up to `limit` entries of `author_ids`' messages, newest first,
+        starting past the `before` cursor.
+
+        Merged from the authors' buffers when they reach back far
+        enough; otherwise read from the messages table.
+        """
+
+        buffers = self.recent.get_many(sorted(author_ids))
+        cursor = cursor_entry(before)
+
+        streams = [[entry for entry in buffer if entry < cursor] if cursor else buffer
+                   for buffer in buffers.values()]
+        entries = list(islice(heapq.merge(*streams, reverse=True), limit))
+
+        # below the newest last entry of any full buffer, some author's
+        # messages may be missing; past that, ask the database
+        horizon = max((buffer[-1] for buffer in buffers.values()
+                       if len(buffer) >= self.recent.size), default=None)
+        if horizon is not None and (len(entries) < limit or entries[-1] < horizon):
+            return newest_entries(
+                (db.session
+                 .query(Message.timestamp, Message.id)
+                 .filter(Message.user_id.in_(sorted(author_ids)))),
+                Message.timestamp, Message.id, before, limit)
+
+        return entries
+
+    def page(self, user, before=None, per_page=20):
+        """(messages, next_cursor) for `user`'s home page.
+
+        `user` is a CurrentUser; only its `following_ids` are merged.
+        """
+
+        authors = set(user.following_ids) | {user.id}
+        return messages_page(self.author_entries(authors, before, per_page + 1),
+                             per_page)
+
+
+class HybridTimeline(MergeTimeline):
+    """Pushed timelines, with celebrities' messages merged in on read."""
+
+    def __init__(self, recent, celebrity_followers=10000):
+        super().__init__(recent)
+        self.celebrity_followers = celebrity_followers
+
+    def deliver(self, message):
+        celebrity = (db.session
+                     .query(User.celebrity)
+                     .filter(User.id == message.user_id)
+                     .scalar())
+
+        # celebrities' messages only go in their own timeline
+        if not celebrity:
+            TimelineEntry.push_to_followers(message)
+
+    def followers_changed(self, author_id):
+        """Reclassify `author_id` if their follower count crossed the line."""
+
+        count, celebrity = (db.session
+                            .query(User.followers_count, User.celebrity)
+                            .filter(User.id == author_id)
+                            .one())
+
+        if not celebrity and count >= self.celebrity_followers:
+            self.set_celebrity(author_id, True)
+        elif celebrity and count < self.celebrity_followers * DEMOTE_FRACTION:
+            self.set_celebrity(author_id, False)
+
+    def set_celebrity(self, author_id, celebrity):
+        """Start merging (True) or pushing (False) `author_id`'s messages."""
+
+        User.query.filter_by(id=author_id).update({User.celebrity: celebrity})
+
+        # messages posted as a celebrity never reached the followers'
+        # timelines; ones already pushed can stay (pages drop duplicates)
+        if not celebrity:
+            TimelineEntry.backfill_followers(author_id)
+
+    def reclassify_all(self):
+        """Reclassify every author (e.g. after a threshold change).
+
+        Returns (promoted, demoted) counts.
+        """
+
+        promoted = (User.query
+                    .filter(~User.celebrity)
+                    .filter(User.followers_count >= self.celebrity_followers)
+                    .update({User.celebrity: True}, synchronize_session=False))
+
+        demoted = [user_id for user_id, in (
+            db.session
+            .query(User.id)
+            .filter(User.celebrity)
+            .filter(User.followers_count
+                    < self.celebrity_followers * DEMOTE_FRACTION))]
+        for user_id in demoted:
+            self.set_celebrity(user_id, False)
+
+        return promoted, len(demoted)
+
+    def page(self, user, before=None, per_page=20):
+        """(messages, next_cursor) for `user`'s home page."""
+
+        pushed = newest_entries(
+            (db.session
+             .query(TimelineEntry.timestamp, TimelineEntry.message_id.label('id'))
+             .filter(TimelineEntry.user_id == user.id)),
+            TimelineEntry.timestamp, TimelineEntry.message_id, before, per_page + 1)
+
+        celebrities = [followed_id for followed_id, in (
+            db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user.id)
+            .filter(User.celebrity))]
+        pulled = (self.author_entries(celebrities, before, per_page + 1)
+                  if celebrities else [])
+
+        entries, seen = [], set()
+        for entry in heapq.merge(pushed, pulled, reverse=True):
+            if entry[1] not in seen:
+                seen.add(entry[1])
+                entries.append(entry)
+
+        return messages_page(entries[:per_page + 1], per_page)
+
+
+ENGINES = ['push', 'merge', 'hybrid']
+
+
+def make_timeline(name, recent, celebrity_followers=10000):
+    """Make the timeline engine called `name` (see ENGINES)."""
+
+    if name == 'merge':
+        return MergeTimeline(recent)
+
+    if name == 'hybrid':
+        return HybridTimeline(recent, celebrity_followers)
+
+    return PushTimeline()